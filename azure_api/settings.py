@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "azure_api_app.tracing.TracingMiddleware",
+    "azure_api_app.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -84,7 +86,7 @@ WSGI_APPLICATION = "azure_api.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.environ.get('SQLITE_PATH', BASE_DIR / "db.sqlite3"),
     }
 }
 
@@ -133,20 +135,90 @@ CORS_ALLOW_ALL_ORIGINS = True
 #CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS').split(',')
 
 
+# Serve chat and stripe endpoints with async views; only under ASGI (azure_api.asgi, e.g. gunicorn -k uvicorn.workers.UvicornWorker)
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'false').lower() == 'true'
+
+# Exact-match cache for repeated chat completions at low temperature (per web worker process)
+CHAT_COMPLETION_CACHE_ENABLED = os.environ.get('CHAT_COMPLETION_CACHE_ENABLED', 'false').lower() == 'true'
+CHAT_COMPLETION_CACHE_MAX_BYTES = int(os.environ.get('CHAT_COMPLETION_CACHE_MAX_BYTES', 32 * 2 ** 20))
+CHAT_COMPLETION_CACHE_TTL = int(os.environ.get('CHAT_COMPLETION_CACHE_TTL', 3600))
+CHAT_COMPLETION_CACHE_MAX_TEMPERATURE = float(os.environ.get('CHAT_COMPLETION_CACHE_MAX_TEMPERATURE', 0.2))
+
+# Background scribe jobs (per web worker process)
+SCRIBE_JOB_WORKERS = int(os.environ.get('SCRIBE_JOB_WORKERS', 4))
+SCRIBE_JOB_QUEUE_SIZE = int(os.environ.get('SCRIBE_JOB_QUEUE_SIZE', 32))
+SCRIBE_JOB_MAX_ATTEMPTS = int(os.environ.get('SCRIBE_JOB_MAX_ATTEMPTS', 3))
+# Unfinished jobs untouched for this long are considered interrupted and resumed
+SCRIBE_JOB_STALE_SECONDS = int(os.environ.get('SCRIBE_JOB_STALE_SECONDS', 600))
+# Queued and running jobs hold a lease renewed every third of this, recovery only resumes jobs whose lease expired
+SCRIBE_JOB_LEASE_SECONDS = int(os.environ.get('SCRIBE_JOB_LEASE_SECONDS', 120))
+# Jobs waiting for the Assembly AI webhook are left alone this long before recovery polls the transcript instead
+SCRIBE_JOB_WEBHOOK_WAIT_SECONDS = int(os.environ.get('SCRIBE_JOB_WEBHOOK_WAIT_SECONDS', 3600))
+SCRIBE_JOB_RECOVERY_INTERVAL = int(os.environ.get('SCRIBE_JOB_RECOVERY_INTERVAL', 300))
+
+# Bearer token required by the /metrics view (it answers 403 to everyone while unset)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Requests sent with `X-Profile-Token: <PROFILE_TOKEN>`, and a PROFILE_SAMPLE_RATE share of all requests, are profiled into PROFILE_DIR
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', BASE_DIR / 'azure_api_app' / 'profiles')
+
+# Stripe auto pay top-ups queued by billed jobs and charged by a background worker
+TOP_UP_POLL_INTERVAL = int(os.environ.get('TOP_UP_POLL_INTERVAL', 5))
+TOP_UP_MAX_ATTEMPTS = int(os.environ.get('TOP_UP_MAX_ATTEMPTS', 3))
+TOP_UP_STALE_SECONDS = int(os.environ.get('TOP_UP_STALE_SECONDS', 300))
+# Only the web worker holding an flock on this file polls the queue, another takes over if it exits
+TOP_UP_LOCK_FILE = os.environ.get('TOP_UP_LOCK_FILE', BASE_DIR / 'top_up_worker.lock')
+
+# Forward uploaded audio to Assembly AI while it is received instead of saving it to audio_files/.
+# Only for uploads with patient_name and visit_type in the query string (validated before the body is read),
+# others are saved as usual. The audio hash is only known once it was streamed, so a transcript cache hit
+# skips the transcription but not the upload in this mode
+SCRIBE_STREAMING_UPLOAD = os.environ.get('SCRIBE_STREAMING_UPLOAD', 'false').lower() == 'true'
+
+# Public url of the AssemblyAIWebhook view (e.g. https://<host>/assemblyai/webhook/), polling is used when either is unset
+ASSEMBLY_AI_WEBHOOK_URL = os.environ.get('ASSEMBLY_AI_WEBHOOK_URL', '')
+ASSEMBLY_AI_WEBHOOK_SECRET = os.environ.get('ASSEMBLY_AI_WEBHOOK_SECRET', '')
+
+# Transcribe with Whisper (chunked for long recordings) when Assembly AI fails. Needs the saved audio file, so
+# streamed uploads can't fall back and saved ones are kept until the transcript is done
+SCRIBE_WHISPER_FALLBACK = os.environ.get('SCRIBE_WHISPER_FALLBACK', 'false').lower() == 'true'
+
+
+# error.log is written as JSON lines by a queue listener thread and rotated at LOG_MAX_BYTES
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'ERROR')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# Identical records let through per window, the rest are counted and dropped (0 turns this off)
+LOG_REPEAT_BURST = int(os.environ.get('LOG_REPEAT_BURST', 5))
+LOG_REPEAT_WINDOW = int(os.environ.get('LOG_REPEAT_WINDOW', 60))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'repeated_errors': {
+            '()': 'azure_api_app.log_handlers.RepeatedErrorFilter',
+            'burst': LOG_REPEAT_BURST,
+            'window': LOG_REPEAT_WINDOW,
+        },
+    },
     'handlers': {
         'file': {
-            'level': 'ERROR',
-            'class': 'logging.FileHandler',
+            'level': LOG_LEVEL,
+            'class': 'azure_api_app.log_handlers.QueuedJsonFileHandler',
             'filename': BASE_DIR / 'error.log',
+            'max_bytes': LOG_MAX_BYTES,
+            'backup_count': LOG_BACKUP_COUNT,
+            'filters': ['repeated_errors'],
         },
     },
     'loggers': {
         '': {
             'handlers': ['file'],
-            'level': 'ERROR',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
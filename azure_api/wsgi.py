@@ -14,3 +14,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "azure_api.settings")
 
 application = get_wsgi_application()
+
+# Connect to firestore now rather than on the first request
+from azure_api_app.firebase_client import warm_up  # noqa: E402
+
+warm_up()
+
+# Resume scribe jobs interrupted by the previous shutdown and charge queued top-ups
+from azure_api_app.job_executor import start_job_recovery, start_top_up_worker  # noqa: E402
+
+start_job_recovery()
+start_top_up_worker()
@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from azure_api_app.models import ScribeJob, TopUpRequest
+
+
+@admin.register(ScribeJob)
+class ScribeJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user_id', 'visit_type', 'stage', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('stage',)
+    search_fields = ('id', 'user_id', 'transcript_id')
+
+
+@admin.register(TopUpRequest)
+class TopUpRequestAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user_id', 'credit', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('id', 'user_id', 'stripe_customer_id')
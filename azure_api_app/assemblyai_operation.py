@@ -1,16 +1,45 @@
 import os
 import json
-import requests
+import time
 from dotenv import load_dotenv
 
+# Shared connection pools
+from azure_api_app.http_client import get_session, get_timeout
+
+# Tracing
+from azure_api_app.tracing import trace_methods
+
+# Upstream concurrency, rate limit and retries
+from azure_api_app.upstream_limiter import request_with_retries, UpstreamBusy
+
 load_dotenv()
 
+@trace_methods
 class AssemblyAIOperation:
 
-    BASE_URL = "https://api.assemblyai.com/v2"
+    # Point ASSEMBLY_AI_BASE_URL at a local stub server to run without the real API
+    BASE_URL = os.environ.get('ASSEMBLY_AI_BASE_URL', "https://api.assemblyai.com/v2")
     UPLOAD_URL = f"{BASE_URL}/upload"
     TRANSCRIPT_URL = f"{BASE_URL}/transcript"
 
+    WEBHOOK_AUTH_HEADER = "X-Scribe-Webhook-Secret"
+
+    # Sent with every transcript request, also part of the transcript cache key
+    TRANSCRIPTION_SETTINGS = {
+        "language_code": "en_us",
+        "disfluencies": True,
+        "speaker_labels": True,
+        "punctuate": True,
+    }
+
+    # Adaptive polling: the first wait is a share of the audio duration, later ones back off
+    POLL_FIRST_WAIT_RATIO = 0.1
+    POLL_MIN_INTERVAL = 1
+    POLL_MAX_INTERVAL = 15
+    POLL_BACKOFF = 1.5
+    POLL_DEADLINE_BASE = 300
+    POLL_DEADLINE_RATIO = 2
+
     def __init__(self):
         ASSEMBLY_AI_TOKEN = os.environ.get('ASSEMBLY_AI_TOKEN')
         headers = {
@@ -18,13 +47,17 @@ class AssemblyAIOperation:
             "Content-Type": "application/json"
         }
         self.headers = headers
+        self.session = get_session('assemblyai')
 
 
     def upload_file(self, file_path):
         try:
-            audio_file = open(file_path, "rb") 
-        
-            response = requests.post(self.UPLOAD_URL, headers=self.headers, data=audio_file)
+            def send():
+                # Every attempt uploads the file from the start
+                with open(file_path, "rb") as audio_file:
+                    return self.session.post(self.UPLOAD_URL, headers=self.headers, data=audio_file, timeout=get_timeout())
+
+            response = request_with_retries('assemblyai', send)
 
             response_data = False
             if response.status_code == 200:
@@ -34,17 +67,40 @@ class AssemblyAIOperation:
             return False
     
 
-    def transcribe_file(self, upload_url):
+    def upload_stream(self, chunks):
+        """Upload audio from an iterator of byte chunks (sent with chunked transfer encoding)"""
+        try:
+            # Sent past the limiter: the chunks arrive as fast as the client uploads them, a slot held
+            # for that long would starve the transcript requests. They can only be read once, so no retries either
+            response = self.session.post(self.UPLOAD_URL, headers=self.headers, data=chunks, timeout=get_timeout())
+
+            response_data = False
+            if response.status_code == 200:
+                response_data = response.json()
+            return response_data
+        except:
+            return False
+    
+
+    def transcribe_file(self, upload_url, webhook_url=None, webhook_secret=None):
         try:
             data = {
                 "audio_url": upload_url, 
-                "language_code": "en_us",
-                "disfluencies": True,
-                "speaker_labels": True,
-                "punctuate": True,
+                **self.TRANSCRIPTION_SETTINGS,
             }
 
-            transcript_response = requests.post(self.TRANSCRIPT_URL, json=data, headers=self.headers)
+            # Assembly AI calls this url once the transcript is ready
+            if webhook_url:
+                data["webhook_url"] = webhook_url
+                if webhook_secret:
+                    data["webhook_auth_header_name"] = self.WEBHOOK_AUTH_HEADER
+                    data["webhook_auth_header_value"] = webhook_secret
+
+            # A 500 may have created the transcript anyway, only responses that certainly didn't are resent
+            transcript_response = request_with_retries(
+                'assemblyai', lambda: self.session.post(self.TRANSCRIPT_URL, json=data, headers=self.headers, timeout=get_timeout()),
+                retry_statuses=(429, 502, 503, 504),
+            )
 
             response_data = False
             if transcript_response.status_code == 200:
@@ -58,9 +114,38 @@ class AssemblyAIOperation:
         try:
             polling_url = f"{self.TRANSCRIPT_URL}/{transcript_id}"
 
-            transcription_response = requests.get(polling_url, headers=self.headers)
+            transcription_response = request_with_retries('assemblyai', lambda: self.session.get(polling_url, headers=self.headers, timeout=get_timeout()))
 
             transcription_result = transcription_response.json()
             return transcription_result
+        except UpstreamBusy:
+            # No Assembly AI capacity right now, the transcript is still being worked on: poll again later
+            return {'status': 'processing'}
         except Exception as e:
-            return {'status': 'error', 'error': str(e)}
\ No newline at end of file
+            return {'status': 'error', 'error': str(e)}
+
+
+    def wait_for_transcript(self, transcript_id, audio_duration=0, on_poll=None):
+        """Poll until the transcript is completed or errored, backing off between checks.
+
+        Gives up with an error status after POLL_DEADLINE_BASE seconds plus
+        POLL_DEADLINE_RATIO times the expected audio duration.
+        """
+        deadline = time.monotonic() + self.POLL_DEADLINE_BASE + self.POLL_DEADLINE_RATIO * audio_duration
+        interval = min(max(audio_duration * self.POLL_FIRST_WAIT_RATIO, self.POLL_MIN_INTERVAL), self.POLL_MAX_INTERVAL)
+
+        while True:
+            transcription_result = self.polling_transcript(transcript_id)
+            transcription_status = transcription_result.get('status', None)
+            if transcription_status in (None, 'completed', 'error'):
+                return transcription_result
+
+            if on_poll:
+                on_poll()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {'status': 'error', 'error': f'Transcript {transcript_id} not completed before the polling deadline'}
+
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.POLL_BACKOFF, self.POLL_MAX_INTERVAL)
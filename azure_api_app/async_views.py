@@ -0,0 +1,213 @@
+# From django
+from django.views import View
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+# From rest_framework
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+
+# From openai_operation
+from azure_api_app.openai_operation import AsyncOpenAIOperation
+
+# From utils
+from azure_api_app.utils import handle_async_exceptions
+
+# Firebase Authorization
+from azure_api_app.firebase_auth import AsyncFirebaseAuthorization
+
+# Firebase operations
+from azure_api_app.firebase_operation import AsyncFirebaseOperations
+
+# Stripe Operations
+from azure_api_app.stripe_operation import AsyncStripeOperation
+from azure_api_app.stripe_responses import (
+    CUSTOMER_ID_NOT_FOUND, PRICE_ID_NOT_FOUND, SUBSCRIPTION_ID_NOT_FOUND, SUBSCRIPTION_NOT_FOUND, error_response, get_required_value,
+    get_customer_data_response, get_payment_methods_response, get_billing_portal_session_response, get_checkout_session_response,
+    get_cancel_subscription_response,
+)
+
+# Chat completion cache
+from azure_api_app.completion_cache import get_cached_completion, cache_completion, CACHE_HEADER
+
+# Other
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAPIView(View):
+    """Async counterpart of the DRF APIView for the upstream-bound endpoints (served with ASYNC_VIEWS under ASGI).
+
+    Checks `permission_classes` like DRF does and exposes the parsed body as `request.data`.
+    """
+
+    permission_classes = [AsyncFirebaseAuthorization]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        for permission_class in self.permission_classes:
+            try:
+                is_permitted = await permission_class().has_permission(request)
+            except AuthenticationFailed as e:
+                return JsonResponse({'detail': str(e.detail)}, status=status.HTTP_403_FORBIDDEN)
+
+            if not is_permitted:
+                return JsonResponse({'detail': "Authentication credentials were not provided."}, status=status.HTTP_403_FORBIDDEN)
+
+        request.data = self.parse_data(request)
+        return await super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def parse_data(request):
+        if request.method == 'GET':
+            return request.GET
+        if request.content_type == 'application/json':
+            return json.loads(request.body or b'{}')
+        return request.POST
+
+
+class ChatBotCompletion(AsyncAPIView):
+    """Generate GPT responses for input given
+
+    Args:
+        model: GPT model name (required)
+        messages: Message list (required)
+        temperature: temperature value for gpt model
+        presence_penalty: presence penalty value
+        stream: `true` to relay the completion as server-sent events while it is generated
+
+    Returns:
+        Response return by GPT model
+    """
+
+    @handle_async_exceptions()
+    async def post(self, request, *args, **kwargs):
+        # Get Data
+        model = request.data.get('model', '').strip() # Required
+        messages = request.data.get('messages', [])  # Required
+        messages = json.loads(messages) if isinstance(messages, str) else messages
+        temperature = float(request.data.get('temperature', 0.8))
+        presence_penalty = float(request.data.get('presence_penalty', 0))
+        is_stream = str(request.data.get('stream', '')).strip().lower() == 'true'
+
+        # Validation
+        if (not model) or (not messages):
+            return JsonResponse({'status': 'error', 'message': "Model or user message not found..!"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Call GPT API to get response
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "presence_penalty": presence_penalty,
+        }
+        open_ai_object = AsyncOpenAIOperation()
+
+        if is_stream:
+            return await self.stream_response(open_ai_object, payload)
+
+        # Repeated deterministic requests are answered from the cache
+        cached_response = get_cached_completion(payload)
+        if cached_response is not None:
+            return JsonResponse(cached_response, status=status.HTTP_200_OK, headers={CACHE_HEADER: 'HIT'})
+
+        res_status, response = await open_ai_object.generate_gpt_response(json.dumps(payload))
+
+        # Return response
+        if not res_status:
+            return JsonResponse({'status': 'error', 'message': response or "Something Went Wrong..! Response Not Generated..!"},
+                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        cache_completion(payload, response)
+        return JsonResponse(response, status=status.HTTP_200_OK, headers={CACHE_HEADER: 'MISS'})
+
+
+    async def stream_response(self, open_ai_object, payload):
+        payload["stream"] = True
+        res_status, response = await open_ai_object.open_gpt_stream(json.dumps(payload))
+        if not res_status:
+            return JsonResponse({'status': 'error', 'message': response or "Something Went Wrong..! Response Not Generated..!"},
+                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        streaming_response = StreamingHttpResponse(open_ai_object.iter_gpt_stream(response), content_type='text/event-stream')
+        streaming_response['Cache-Control'] = 'no-cache'
+        streaming_response['X-Accel-Buffering'] = 'no'
+        return streaming_response
+
+
+class StripeCustomerData(AsyncAPIView):
+
+    @handle_async_exceptions()
+    async def get(self, request, *args, **kwargs):
+        # Get customer_id of stripe from firebase
+        stripe_customer_id = await AsyncFirebaseOperations().get_stripe_customer_id(request.user_id)
+        if not stripe_customer_id:
+            return JsonResponse(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        # Get customer data (default payment method expanded in the same call) using stripe_customer_id
+        customer_data = await AsyncStripeOperation().get_customer_data(stripe_customer_id, expand_payment_method=True)
+        return JsonResponse(**get_customer_data_response(customer_data))
+
+
+class StripeListPaymentMethods(AsyncAPIView):
+
+    @handle_async_exceptions()
+    async def get(self, request, *args, **kwargs):
+        # Get customer_id of stripe from firebase
+        stripe_customer_id = await AsyncFirebaseOperations().get_stripe_customer_id(request.user_id)
+        if not stripe_customer_id:
+            return JsonResponse(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        payment_method_data = await AsyncStripeOperation().get_payment_methods(stripe_customer_id)
+        return JsonResponse(**get_payment_methods_response(payment_method_data))
+
+
+class StripeBillingPortalSessions(AsyncAPIView):
+
+    @handle_async_exceptions()
+    async def get(self, request, *args, **kwargs):
+        # Get customer_id of stripe from firebase
+        stripe_customer_id = await AsyncFirebaseOperations().get_stripe_customer_id(request.user_id)
+        if not stripe_customer_id:
+            return JsonResponse(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        billing_portal_session_data = await AsyncStripeOperation().get_billing_portal_session(stripe_customer_id)
+        return JsonResponse(**get_billing_portal_session_response(billing_portal_session_data))
+
+
+class StripeCheckoutSessions(AsyncAPIView):
+
+    @handle_async_exceptions()
+    async def post(self, request, *args, **kwargs):
+        price_id = get_required_value(request.data, 'price_id') # Required
+        if not price_id:
+            return JsonResponse(**error_response(PRICE_ID_NOT_FOUND))
+
+        # Get customer_id of stripe from firebase
+        stripe_customer_id = await AsyncFirebaseOperations().get_stripe_customer_id(request.user_id)
+        if not stripe_customer_id:
+            return JsonResponse(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        checkout_session_data = await AsyncStripeOperation().checkout_session(stripe_customer_id, price_id)
+        return JsonResponse(**get_checkout_session_response(checkout_session_data))
+
+
+class StripeCancelSubscription(AsyncAPIView):
+
+    @handle_async_exceptions()
+    async def post(self, request, *args, **kwargs):
+        subscription_id = get_required_value(request.data, 'subscription_id') # Required
+        if not subscription_id:
+            return JsonResponse(**error_response(SUBSCRIPTION_ID_NOT_FOUND))
+
+        # Check user has subscription with provided subscription id
+        if not await AsyncFirebaseOperations().check_subscription(request.user_id, subscription_id):
+            return JsonResponse(**error_response(SUBSCRIPTION_NOT_FOUND))
+
+        cancel_subscription_data = await AsyncStripeOperation().cancel_subscription(subscription_id)
+        return JsonResponse(**get_cancel_subscription_response(cancel_subscription_data))
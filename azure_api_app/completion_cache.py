@@ -0,0 +1,52 @@
+# From django
+from django.conf import settings
+
+# Other
+import json
+import hashlib
+import threading
+from cachetools import TTLCache
+
+CACHE_HEADER = 'X-Cache'
+
+# Global variables
+completion_cache = TTLCache(
+    maxsize=settings.CHAT_COMPLETION_CACHE_MAX_BYTES,
+    ttl=settings.CHAT_COMPLETION_CACHE_TTL,
+    getsizeof=lambda entry: entry[1],
+)
+completion_cache_lock = threading.Lock()
+
+
+def get_cache_key(payload):
+    """Canonical hash of a chat completion payload (key order and whitespace don't matter)"""
+    canonical_payload = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical_payload.encode()).hexdigest()
+
+
+def is_cacheable(payload):
+    """Only near-deterministic, non-streamed completions are worth replaying"""
+    if not settings.CHAT_COMPLETION_CACHE_ENABLED or payload.get("stream"):
+        return False
+    return float(payload.get("temperature", 1)) <= settings.CHAT_COMPLETION_CACHE_MAX_TEMPERATURE
+
+
+def get_cached_completion(payload):
+    if not is_cacheable(payload):
+        return None
+
+    with completion_cache_lock:
+        entry = completion_cache.get(get_cache_key(payload))
+    return entry[0] if entry else None
+
+
+def cache_completion(payload, response):
+    if not is_cacheable(payload):
+        return
+
+    size = len(json.dumps(response))
+    if size > completion_cache.maxsize:
+        return
+
+    with completion_cache_lock:
+        completion_cache[get_cache_key(payload)] = (response, size)
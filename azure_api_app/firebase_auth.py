@@ -1,45 +1,114 @@
 # Firestore to work with firebase
-from firebase_admin import credentials, firestore, initialize_app, auth
+from firebase_admin import auth
+
+# Shared firebase app and firestore client
+from azure_api_app.firebase_client import get_firebase_app, get_firestore_client
 
 # From rest_framework 
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import permissions
 
+# Tracing
+from azure_api_app.tracing import trace_methods
+
 # Other
 import os
+import time
+import hashlib
+import threading
+from cachetools import TLRUCache
+from asgiref.sync import sync_to_async
+
+# Verified tokens are cached until their `exp` claim
+TOKEN_CACHE_SIZE = int(os.environ.get('FIREBASE_TOKEN_CACHE_SIZE', 4096))
 
 # Global variables
-firebase_initialized = False
+token_cache = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=lambda _key, claims, _now: claims.get('exp', 0), timer=time.time)
+token_cache_lock = threading.Lock()
+
+
+def verify_id_token(token):
+    """Decoded claims of a Firebase ID token, served from the cache while the token is valid.
+
+    Misses go through `auth.verify_id_token`, whose public signing certs are
+    kept by firebase_admin for as long as Google's Cache-Control allows.
+    """
+    claims = get_cached_claims(token)
+    if claims:
+        return claims
+
+    claims = auth.verify_id_token(token, app=get_firebase_app())
+    with token_cache_lock:
+        token_cache[hash_token(token)] = claims
+    return claims
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_cached_claims(token):
+    with token_cache_lock:
+        return token_cache.get(hash_token(token))
+
+
+def get_bearer_token(request):
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.split(' ')[-1]
+
+
+class FirebaseUser:
+    """Authenticated user built from the token claims; the full user record is fetched only when used.
+
+    Only `record` and the properties below fetch it, any other attribute is an AttributeError as usual.
+    """
+
+    is_authenticated = True
+    is_anonymous = False
 
+    def __init__(self, uid, claims):
+        self.uid = uid
+        self.claims = claims
+        self._record = None
 
-def initialize_firestore_client():
-    """ Initialize Firebase app and Firestore client """
-    global firebase_initialized
-    if not firebase_initialized:
-        current_directory = os.path.dirname(os.path.realpath(__file__))
-        json_file_path = os.path.join(current_directory, "firebase_cred/serviceAccountKey.json")
+    @property
+    def record(self):
+        if self._record is None:
+            self._record = auth.get_user(self.uid, app=get_firebase_app())
+        return self._record
 
-        cred = credentials.Certificate(json_file_path)
-        initialize_app(cred)
-        firebase_initialized = True
-    
-    return firestore.client()
+    @property
+    def email(self):
+        return self.record.email
 
+    @property
+    def display_name(self):
+        return self.record.display_name
 
+    @property
+    def disabled(self):
+        return self.record.disabled
+
+    def __str__(self):
+        return self.uid
+
+
+@trace_methods(exclude=('authenticate',))
 class FirebaseAuthorization(permissions.BasePermission):
 
     def authenticate(self, request):
         try:
-            auth_header = request.headers.get('Authorization')
-            if not auth_header or not auth_header.startswith('Bearer '):
+            token = get_bearer_token(request)
+            if not token:
                 return None
 
-            token = auth_header.split(' ')[-1]
-            db_obj = initialize_firestore_client()
+            db_obj = get_firestore_client()
 
-            decoded_token = auth.verify_id_token(token)
+            decoded_token = verify_id_token(token)
             decoded_user_id = decoded_token['uid']
-            user = auth.get_user(decoded_user_id)
+            user = FirebaseUser(decoded_user_id, decoded_token)
 
             request.user_id = decoded_user_id
             request.db = db_obj
@@ -51,3 +120,28 @@ class FirebaseAuthorization(permissions.BasePermission):
         user = self.authenticate(request)
         request.user = user  # Set the authenticated user in the request
         return user is not None
+
+
+@trace_methods(exclude=('authenticate',))
+class AsyncFirebaseAuthorization:
+    """FirebaseAuthorization for the async views; only cache misses leave the event loop to verify the token"""
+
+    async def authenticate(self, request):
+        try:
+            token = get_bearer_token(request)
+            if not token:
+                return None
+
+            decoded_token = get_cached_claims(token) or await sync_to_async(verify_id_token, thread_sensitive=False)(token)
+            decoded_user_id = decoded_token['uid']
+            user = FirebaseUser(decoded_user_id, decoded_token)
+
+            request.user_id = decoded_user_id
+            return user
+        except Exception as e:
+            raise AuthenticationFailed(f"Token verification failed: {str(e)}")
+
+    async def has_permission(self, request):
+        user = await self.authenticate(request)
+        request.user = user
+        return user is not None
@@ -0,0 +1,66 @@
+# Firestore to work with firebase
+from firebase_admin import credentials, firestore, firestore_async, initialize_app
+
+# Other
+import os
+import logging
+import threading
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+FIREBASE_CREDENTIALS_FILE = os.environ.get('FIREBASE_CREDENTIALS_FILE', os.path.join(current_directory, "firebase_cred/serviceAccountKey.json"))
+
+# Global variables
+firebase_app = None
+firestore_client = None
+async_firestore_client = None
+firebase_lock = threading.Lock()
+
+
+def get_firebase_app():
+    """Initialize the Firebase app once per process"""
+    global firebase_app
+    if firebase_app is None:
+        with firebase_lock:
+            if firebase_app is None:
+                cred = credentials.Certificate(FIREBASE_CREDENTIALS_FILE)
+                firebase_app = initialize_app(cred)
+    return firebase_app
+
+
+def get_firestore_client():
+    """Firestore client shared by auth, views and background jobs in this process"""
+    global firestore_client
+    if firestore_client is None:
+        app = get_firebase_app()
+        with firebase_lock:
+            if firestore_client is None:
+                firestore_client = firestore.client(app)
+    return firestore_client
+
+
+def get_async_firestore_client():
+    """Firestore AsyncClient for the async views; its grpc.aio channel belongs to the serving event loop"""
+    global async_firestore_client
+    if async_firestore_client is None:
+        app = get_firebase_app()
+        with firebase_lock:
+            if async_firestore_client is None:
+                async_firestore_client = firestore_async.client(app)
+    return async_firestore_client
+
+
+def warm_up():
+    """Load credentials, fetch an access token and create the Firestore client before the first request needs them"""
+    try:
+        get_firestore_client()
+        # The emulator takes no access token
+        if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+            get_firebase_app().credential.get_access_token()
+        return True
+    except Exception as e:
+        logger.error('Firebase warm up failed', extra={'error': str(e)})
+        return False
@@ -1,45 +1,86 @@
 # Firestore to work with firebase
-from firebase_admin import credentials, firestore, initialize_app, auth
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP, Increment, transactional
 from google.cloud.firestore_v1.base_query import FieldFilter
 
+# Shared firestore client
+from azure_api_app.firebase_client import get_firestore_client, get_async_firestore_client
+
+# Stage timers
+from azure_api_app.metrics import timed_stage
+
+# Tracing
+from azure_api_app.tracing import trace_methods
+
+# Queued stripe top-ups
+from azure_api_app import job_store
+from azure_api_app.models import TopUpRequest
+
 # Other
 import os
+import asyncio
 import logging
+import threading
 from functools import wraps
-from datetime import datetime
+from cachetools import LRUCache, TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Visit type sections are cached per (user, visit name); a snapshot listener on the user's visits drops stale entries
+VISIT_TYPE_CACHE_SIZE = int(os.environ.get('VISIT_TYPE_CACHE_SIZE', 1024))
+VISIT_TYPE_CACHE_TTL = int(os.environ.get('VISIT_TYPE_CACHE_TTL', 300))
+VISIT_TYPE_CACHE_WATCHES = int(os.environ.get('VISIT_TYPE_CACHE_WATCHES', 256))
+
+
+class VisitTypeWatches(LRUCache):
+    """Snapshot listeners per user; the least recently used one is unsubscribed when the cache is full"""
+
+    def popitem(self):
+        user_id, watch = super().popitem()
+        watch.unsubscribe()
+        return user_id, watch
+
+
 # Global variables
-firebase_initialized = False
+visit_type_cache = TTLCache(maxsize=VISIT_TYPE_CACHE_SIZE, ttl=VISIT_TYPE_CACHE_TTL)
+visit_type_watches = VisitTypeWatches(maxsize=max(VISIT_TYPE_CACHE_WATCHES, 1))
+visit_type_cache_lock = threading.Lock()
+
+
+def invalidate_visit_types(user_id):
+    with visit_type_cache_lock:
+        for key in [key for key in visit_type_cache if key[0] == user_id]:
+            visit_type_cache.pop(key, None)
 
 
 def handle_exceptions(func):
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                logger.error('Firebase operation failed', extra={'operation': func.__qualname__, 'error': str(e)})
+                return False
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            logger.error(f'\n--------------- ERROR (firebase) ---------------\n{datetime.now()}\n{str(e)}\n--------------------------------------------------------------\n')
+            logger.error('Firebase operation failed', extra={'operation': func.__qualname__, 'error': str(e)})
             return False
     return wrapper
 
 
+@trace_methods(exclude=('charge_usage', 'get_usage_charge', 'is_top_up_due', 'credit_top_up', 'watch_visit_types'))
 class FirebaseOperations:
+
+    # Add-on balance charged per generated note when the user has no active subscription
+    JOB_CHARGE = 1.5
     
     def __init__(self, firebase_db=None):
-        if not firebase_db:
-            global firebase_initialized
-            if not firebase_initialized:
-                current_directory = os.path.dirname(os.path.realpath(__file__))
-                json_file_path = os.path.join(current_directory, "firebase_cred/serviceAccountKey.json")
-
-                cred = credentials.Certificate(json_file_path)
-                initialize_app(cred)
-                firebase_initialized = True
-            
-            firebase_db = firestore.client()
-        self.db = firebase_db
+        self.db = firebase_db or get_firestore_client()
         
 
     @handle_exceptions
@@ -53,102 +94,127 @@ class FirebaseOperations:
         return True
 
 
+    @timed_stage('manage_user_balance')
     @handle_exceptions
-    def manage_user_balance(self, data, user_id, stripe_obj):
-        collection_name_1 = "users"  
-        collection_name_2 = "subscriptions"
+    def manage_user_balance(self, data, user_id):
+        """Write the history document and bill the job in one Firestore transaction.
 
-        # Check if user has active subscriptions
-        active_subscription = self.db.collection(collection_name_1) \
-            .document(user_id) \
-            .collection(collection_name_2) \
+        The job is free with an active subscription, otherwise JOB_CHARGE is taken from
+        `add_on_balance` or one of the `remaining_trials` is used, with atomic increments.
+        With auto pay enabled and the balance at its threshold a top-up is queued for the
+        background worker instead of charging the card while the job waits, and the charge
+        may overdraw a positive balance by at most one job until the top-up lands.
+        """
+        user_ref = self.db.collection("users").document(user_id)
+        history_ref = user_ref.collection("history").document()
+
+        usage = self.record_usage(self.db.transaction(), user_ref, history_ref, data)
+        if usage['top_up']:
+            job_store.create_top_up_request(user_id, usage['stripe_customer_id'], usage['credit'])
+
+        return usage['charged'] is not None
+
+
+    @staticmethod
+    @transactional
+    def record_usage(transaction, user_ref, history_ref, data):
+        return FirebaseOperations.charge_usage(transaction, user_ref, history_ref, data)
+
+
+    @staticmethod
+    def charge_usage(transaction, user_ref, history_ref, data):
+        """Body of `record_usage`, reads and writes only through `transaction`"""
+        active_subscription = user_ref.collection("subscriptions") \
             .where(filter=FieldFilter('status', '==', "active")) \
-            .get()
+            .limit(1) \
+            .get(transaction=transaction)
+
+        user_snapshot = user_ref.get(transaction=transaction)
+        user_json = user_snapshot.to_dict() or {}
+
+        transaction.create(history_ref, data)
+
+        charged = FirebaseOperations.get_usage_charge(user_json, bool(active_subscription))
+        if charged == 'balance':
+            transaction.update(user_ref, {'add_on_balance': Increment(-FirebaseOperations.JOB_CHARGE)})
+        elif charged == 'trial':
+            transaction.update(user_ref, {'remaining_trials': Increment(-1)})
+
+        auto_pay_data = user_json.get('auto_pay') or {}
+        return {
+            'charged': charged,
+            'top_up': charged != 'subscription' and FirebaseOperations.is_top_up_due(user_json),
+            'stripe_customer_id': user_json.get("stripeId", ''),
+            'credit': float(auto_pay_data.get('credit', 0) or 0),
+        }
+
+
+    @staticmethod
+    def get_usage_charge(user_data, has_active_subscription):
+        """What pays for a job: 'subscription', 'balance', 'trial', or None when nothing can
+
+        A balance that doesn't cover the charge is only drawn on while a top-up is due and
+        it is still positive, so it goes at most one job below zero; otherwise a trial is used.
+        """
+        add_on_balance = float(user_data.get('add_on_balance', 0))
+        if has_active_subscription:
+            return 'subscription'
+        if add_on_balance > FirebaseOperations.JOB_CHARGE or (FirebaseOperations.is_top_up_due(user_data) and add_on_balance > 0):
+            return 'balance'
+        if user_data.get('remaining_trials', 0) > 0:
+            return 'trial'
+        return None
+
+
+    @staticmethod
+    def is_top_up_due(user_data):
+        """Auto pay is enabled and the add-on balance is at or below its threshold"""
+        auto_pay_data = user_data.get('auto_pay') or {}
+        if not auto_pay_data.get('enable_auto_pay', False):
+            return False
+        return float(user_data.get('add_on_balance', 0)) <= float(auto_pay_data.get('threshold', 0))
 
-        # If active subscription then do nothing
-        if active_subscription:
-            return True
-
-        # If not active subscription then update balance or trials
-        user_snapshot =  self.db.collection(collection_name_1).document(user_id).get()
-        user_json = user_snapshot.to_dict()
-
-        add_on_balance = user_json.get('add_on_balance', 0)
-        remaining_trials = user_json.get('remaining_trials', 0)
-
-        if add_on_balance > 1.5:
-            # Update add on balance
-            update_add_on_balance = add_on_balance - 1.5
-            self.db.collection(collection_name_1).document(user_id).update({
-                'add_on_balance': update_add_on_balance
-            })
-
-            # Update add on balance if auto payment is done
-            auto_payment_status, credit_amount = self.stripe_auto_payment(add_on_balance, user_id, stripe_obj)
-            if auto_payment_status:
-                self.db.collection(collection_name_1).document(user_id).update({
-                    'add_on_balance': update_add_on_balance + float(credit_amount)
-                })
-
-            return True
-        else:
-            # No sufficient balance then update it by auto payment first
-            auto_payment_status, credit_amount = self.stripe_auto_payment(add_on_balance, user_id, stripe_obj)
-            if auto_payment_status:
-                # Add balance by auto payment
-                self.db.collection(collection_name_1).document(user_id).update({
-                    'add_on_balance': add_on_balance + float(credit_amount)
-                })
-                
-                # Retrieve updated balance
-                user_snapshot =  self.db.collection(collection_name_1).document(user_id).get()
-                user_json = user_snapshot.to_dict()
-                new_add_on_balance = user_json.get('add_on_balance', 0)
-
-                # Now minus balance 
-                if new_add_on_balance > 1.5:
-                    new_update_add_on_balance = new_add_on_balance - 1.5
-                    self.db.collection(collection_name_1).document(user_id).update({
-                        'add_on_balance': new_update_add_on_balance
-                    })
-
-                    return True
-
-        if remaining_trials > 0:
-            self.db.collection(collection_name_1).document(user_id).update({
-                'remaining_trials': remaining_trials - 1
-            })
-            return True
-        
-        return False
-    
 
-    def stripe_auto_payment(self, balance, user_id, stripe_obj):
-        try:
-            # Default variable
-            credit_amount = 0
-
-            # Get user data to check if has enable auto pay or not ?
-            collection_name_1 = "users"  
-            user_data = self.db.collection(collection_name_1) \
-                    .document(user_id).get()
-            user_data_dict = user_data.to_dict() if user_data else {}
-
-            # Check auto pay enable or not ?
-            auto_pay_data = user_data_dict.get('auto_pay', {})
-            is_auto_pay_enabled = auto_pay_data.get('enable_auto_pay', False)
-            if is_auto_pay_enabled:
-                threshold = auto_pay_data.get('threshold', 0)
-                if float(balance) <= float(threshold):
-                    credit_amount = auto_pay_data.get('credit', 0)
-                    stripe_customer_id = user_data_dict.get("stripeId", '')
-                    
-                    # Credit amount to stripe
-                    payment_status = stripe_obj.auto_payment(credit_amount, stripe_customer_id)
-                    return payment_status, credit_amount
-            return False, credit_amount
-        except:
-            return False, 0
+    def process_top_up(self, top_up_request, stripe_obj):
+        """Charge a queued top-up and credit the balance; returns (status, credit, stripe customer id).
+
+        The user's auto pay settings and balance are read again, so a top-up that is no
+        longer needed (balance refilled, auto pay turned off) is skipped.
+        """
+        user_ref = self.db.collection("users").document(top_up_request.user_id)
+        user_json = user_ref.get().to_dict() or {}
+
+        auto_pay_data = user_json.get('auto_pay') or {}
+        credit_amount = auto_pay_data.get('credit', 0)
+        stripe_customer_id = user_json.get("stripeId", '')
+        if not self.is_top_up_due(user_json):
+            return TopUpRequest.STATUS_SKIPPED, float(credit_amount or 0), stripe_customer_id
+
+        # Credit amount to stripe
+        payment_status = stripe_obj.auto_payment(credit_amount, stripe_customer_id, idempotency_key=top_up_request.idempotency_key)
+        if not payment_status:
+            return TopUpRequest.STATUS_FAILED, float(credit_amount or 0), stripe_customer_id
+
+        top_up_ref = user_ref.collection("top_ups").document(str(top_up_request.id))
+        self.apply_top_up(self.db.transaction(), user_ref, top_up_ref, float(credit_amount))
+        return TopUpRequest.STATUS_SUCCEEDED, float(credit_amount), stripe_customer_id
+
+
+    @staticmethod
+    @transactional
+    def apply_top_up(transaction, user_ref, top_up_ref, credit_amount):
+        return FirebaseOperations.credit_top_up(transaction, user_ref, top_up_ref, credit_amount)
+
+
+    @staticmethod
+    def credit_top_up(transaction, user_ref, top_up_ref, credit_amount):
+        # The top_ups document makes crediting idempotent when a request is retried after the charge
+        if top_up_ref.get(transaction=transaction).exists:
+            return False
+
+        transaction.create(top_up_ref, {'credit': credit_amount, 'created_at': SERVER_TIMESTAMP})
+        transaction.update(user_ref, {'add_on_balance': Increment(credit_amount)})
+        return True
 
 
 
@@ -169,6 +235,50 @@ class FirebaseOperations:
         return False
 
 
+    @handle_exceptions
+    def get_visit_type_sections(self, visit_type, user_id):
+        """Section definitions of a visit type (cached), False if the visit type does not exist"""
+        cache_key = (user_id, visit_type)
+        with visit_type_cache_lock:
+            sections = visit_type_cache.get(cache_key)
+        if sections is not None:
+            return sections
+
+        visit_type_document = self.get_visit_type(visit_type, user_id)
+        if not visit_type_document:
+            return False
+
+        sections = (visit_type_document.to_dict() or {}).get('sections', [])
+        with visit_type_cache_lock:
+            visit_type_cache[cache_key] = sections
+        self.watch_visit_types(user_id)
+        return sections
+
+
+    def watch_visit_types(self, user_id):
+        """Invalidate the user's cached visit types whenever a document in users/{uid}/visits changes"""
+        if VISIT_TYPE_CACHE_WATCHES <= 0:
+            return
+
+        with visit_type_cache_lock:
+            if user_id in visit_type_watches:
+                return
+
+            # The first snapshot only reports the current state
+            is_initial_snapshot = [True]
+
+            def on_visits_snapshot(_docs, _changes, _read_time):
+                if is_initial_snapshot[0]:
+                    is_initial_snapshot[0] = False
+                    return
+                invalidate_visit_types(user_id)
+
+            visit_type_watches[user_id] = self.db.collection("users") \
+                .document(user_id) \
+                .collection("visits") \
+                .on_snapshot(on_visits_snapshot)
+
+
     @handle_exceptions
     def get_stripe_customer_id(self, user_id):
         collection_name_1 = "users"  
@@ -193,4 +303,39 @@ class FirebaseOperations:
             .get()
         
         active_subscription_data = active_subscription.to_dict()
-        return True if active_subscription_data else False
\ No newline at end of file
+        return True if active_subscription_data else False
+
+
+@trace_methods
+class AsyncFirebaseOperations:
+    """Non-blocking twin of the FirebaseOperations lookups used by the async views"""
+
+    def __init__(self, firebase_db=None):
+        self.db = firebase_db or get_async_firestore_client()
+
+
+    @handle_exceptions
+    async def get_stripe_customer_id(self, user_id):
+        collection_name_1 = "users"  
+        user_data = await self.db.collection(collection_name_1) \
+                .document(user_id).get()
+        
+        user_data_dict = user_data.to_dict() if user_data else {}
+        customer_id = (user_data_dict or {}).get("stripeId", '')
+        return customer_id
+
+
+    @handle_exceptions
+    async def check_subscription(self, user_id, subscription_id):
+        collection_name_1 = "users"  
+        collection_name_2 = "subscriptions"
+
+        # Check if user has subscriptions
+        active_subscription = await self.db.collection(collection_name_1) \
+            .document(user_id) \
+            .collection(collection_name_2) \
+            .document(subscription_id) \
+            .get()
+        
+        active_subscription_data = active_subscription.to_dict()
+        return True if active_subscription_data else False
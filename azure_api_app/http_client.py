@@ -0,0 +1,84 @@
+import os
+import httpx
+import stripe
+import requests
+import threading
+from openai import OpenAI
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+# Upstream latency metrics
+from azure_api_app.metrics import get_requests_hook, get_httpx_event_hooks
+
+load_dotenv()
+
+# Connection pool per upstream host, shared by every request in the process
+HTTP_POOL_SIZE = int(os.environ.get('UPSTREAM_HTTP_POOL_SIZE', 20))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('UPSTREAM_HTTP_READ_TIMEOUT', 120))
+
+# Global variables
+http_sessions = {}
+async_http_clients = {}
+openai_client = None
+http_clients_lock = threading.Lock()
+
+
+def get_timeout(read_timeout=None):
+    """(connect, read) timeout tuple for requests"""
+    return (HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+
+
+def get_session(upstream):
+    """Keep-alive requests session for an upstream (e.g. 'assemblyai', 'openai', 'stripe')"""
+    session = http_sessions.get(upstream)
+    if session:
+        return session
+
+    with http_clients_lock:
+        if upstream not in http_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(get_requests_hook(upstream))
+            http_sessions[upstream] = session
+        return http_sessions[upstream]
+
+
+def get_openai_client():
+    """OpenAI SDK client backed by one pooled httpx client"""
+    global openai_client
+    if openai_client:
+        return openai_client
+
+    with http_clients_lock:
+        if not openai_client:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks=get_httpx_event_hooks('openai'),
+            )
+            openai_client = OpenAI(api_key=os.environ.get('OPENAI_KEY'), http_client=http_client)
+        return openai_client
+
+
+def get_stripe_http_client():
+    """Stripe SDK http client reusing the pooled 'stripe' session"""
+    return stripe.RequestsClient(timeout=get_timeout(), session=get_session('stripe'))
+
+
+def get_async_client(upstream):
+    """Keep-alive httpx.AsyncClient for an upstream, used by the async views (one event loop per process)"""
+    client = async_http_clients.get(upstream)
+    if client:
+        return client
+
+    with http_clients_lock:
+        if upstream not in async_http_clients:
+            async_http_clients[upstream] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks=get_httpx_event_hooks(upstream, is_async=True),
+            )
+        return async_http_clients[upstream]
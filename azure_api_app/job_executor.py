@@ -0,0 +1,366 @@
+# From django
+from django.conf import settings
+
+# Metrics
+from azure_api_app import metrics
+
+# Tracing
+from azure_api_app import tracing
+
+# Other
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, every web worker then polls the top-up queue
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Global variables
+job_executor = None
+job_executor_lock = threading.Lock()
+job_recovery_started = False
+top_up_worker_started = False
+# Leases taken by this process for the jobs it queued, renewed until a worker claims them
+queued_leases = {}
+queued_leases_lock = threading.Lock()
+lease_renewal_started = False
+
+
+class JobQueueFull(Exception):
+    """Raised when every worker is busy and the waiting queue is already full."""
+
+
+def initialize_worker():
+    """Runs once in every worker process, so the SDKs are imported before the first job arrives."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "azure_api.settings")
+
+    import django
+    django.setup()
+
+    from azure_api_app import task  # noqa: F401
+    from azure_api_app.firebase_client import warm_up
+    warm_up()
+
+
+def get_lease_owner():
+    """Unique lease owner name, e.g. for a queued job or one attempt of a running job"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def start_lease_heartbeat(job_id, owner):
+    """Renew the lease of a running job until the returned event is set"""
+    from django.db import connection
+    from azure_api_app import job_store
+
+    stopped = threading.Event()
+
+    def heartbeat_loop():
+        try:
+            while not stopped.wait(settings.SCRIBE_JOB_LEASE_SECONDS / 3):
+                try:
+                    job_store.renew_job_lease(job_id, owner, settings.SCRIBE_JOB_LEASE_SECONDS)
+                except Exception as e:
+                    logger.error('Scribe job lease renewal failed', extra={'job_id': str(job_id), 'error': str(e)})
+        finally:
+            connection.close()
+
+    threading.Thread(target=heartbeat_loop, name='scribe-job-lease', daemon=True).start()
+    return stopped
+
+
+def run_scribe_job(job_id, queue_owner='', is_resume=False):
+    # Models can only be imported once the worker has set up django
+    from azure_api_app import job_store
+    from azure_api_app.task import TranscriptGPTOperation
+
+    worker = get_lease_owner()
+    job = job_store.claim_job(job_id, worker, settings.SCRIBE_JOB_LEASE_SECONDS, queue_owner, is_resume)
+    if not job:
+        return False
+
+    # A webhook resume goes on with the attempt that handed the job to the webhook
+    if job.attempts == 1 and not is_resume:
+        metrics.observe('scribe_job_queue_seconds', (job.started_at - job.created_at).total_seconds())
+    elif not is_resume:
+        metrics.increment('scribe_retries_total', kind='job_attempt')
+
+    transcript_gpt_task = TranscriptGPTOperation(
+        job.file_path, job.patient_name, job.user_id, job.visit_type,
+        job_id=job.id, transcript_id=job.transcript_id, upload_url=job.upload_url,
+        visit_sections=job.visit_sections, audio_sha256=job.audio_sha256, audio_size=job.audio_size,
+    )
+    heartbeat_stopped = start_lease_heartbeat(job.id, worker)
+    try:
+        # Every attempt is a child of the upload request that created the job
+        with tracing.use_traceparent(job.traceparent):
+            with tracing.span('scribe_job', **{'job.id': str(job.id), 'job.attempt': job.attempts}):
+                return transcript_gpt_task.perform_operation()
+    finally:
+        heartbeat_stopped.set()
+        if transcript_gpt_task.is_transcript_pending:
+            job_store.hand_job_to_webhook(job.id, worker, settings.SCRIBE_JOB_WEBHOOK_WAIT_SECONDS)
+        else:
+            job_store.release_job(job.id, worker)
+        # Worker processes end without atexit, so the job's metrics and spans are written out right away
+        metrics.flush_metrics()
+        tracing.flush_traces()
+
+
+class JobExecutor:
+    """Bounded pool of long-lived worker processes.
+
+    At most `max_workers` jobs run at the same time and at most `queue_size` more
+    wait for a free worker. Anything beyond that is rejected with `JobQueueFull`
+    so the caller can push back on the client instead of piling up work.
+    """
+
+    def __init__(self, max_workers, queue_size):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+
+
+    def get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Spawn instead of fork: gRPC channels and SDK sessions must not be shared with a forked child
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=initialize_worker,
+                )
+            return self._pool
+
+
+    def reset_pool(self, broken_pool):
+        with self._pool_lock:
+            if self._pool is broken_pool:
+                self._pool = None
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+    def submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.increment('scribe_jobs_rejected_total')
+            raise JobQueueFull(f"Job queue is full ({self.max_workers} running, {self.queue_size} waiting)")
+
+        try:
+            pool = self.get_pool()
+            try:
+                future = pool.submit(func, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM killed); start a fresh pool and try once more
+                self.reset_pool(pool)
+                future = self.get_pool().submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(self.on_job_done)
+        return future
+
+
+    def on_job_done(self, future):
+        self._slots.release()
+
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if error:
+            logger.error('Scribe job failed', extra={'error': str(error)})
+
+
+    def shutdown(self, wait=True):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=wait)
+
+
+def get_job_executor():
+    """Return the process-wide executor, creating it on first use."""
+    global job_executor
+    if job_executor is None:
+        with job_executor_lock:
+            if job_executor is None:
+                job_executor = JobExecutor(settings.SCRIBE_JOB_WORKERS, settings.SCRIBE_JOB_QUEUE_SIZE)
+    return job_executor
+
+
+def submit_scribe_job(job_id, is_resume=False):
+    """Queue the job under a lease of this process; returns None when it is already queued or running elsewhere.
+
+    `is_resume` is the webhook resume, which takes over the lease of a job waiting for the webhook.
+    """
+    from azure_api_app import job_store
+
+    owner = get_lease_owner()
+    current_owner = job_store.WEBHOOK_LEASE_OWNER if is_resume else ''
+    if not job_store.lease_job(job_id, owner, settings.SCRIBE_JOB_LEASE_SECONDS, current_owner):
+        return None
+
+    try:
+        future = get_job_executor().submit(run_scribe_job, job_id, owner, is_resume)
+    except Exception:
+        job_store.release_job(job_id, owner)
+        raise
+
+    with queued_leases_lock:
+        queued_leases[job_id] = owner
+    future.add_done_callback(lambda _future: forget_queued_lease(job_id, owner))
+    start_lease_renewal()
+    return future
+
+
+def forget_queued_lease(job_id, owner):
+    with queued_leases_lock:
+        if queued_leases.get(job_id) == owner:
+            del queued_leases[job_id]
+
+
+def start_lease_renewal():
+    """Renew the leases of the jobs waiting in this process' queue, so recovery leaves them alone"""
+    global lease_renewal_started
+    with queued_leases_lock:
+        if lease_renewal_started:
+            return
+        lease_renewal_started = True
+
+    def renewal_loop():
+        from azure_api_app import job_store
+
+        while True:
+            time.sleep(settings.SCRIBE_JOB_LEASE_SECONDS / 3)
+            with queued_leases_lock:
+                leases = list(queued_leases.items())
+            for job_id, owner in leases:
+                try:
+                    # A no-op once the worker claimed the job under its own lease
+                    job_store.renew_job_lease(job_id, owner, settings.SCRIBE_JOB_LEASE_SECONDS)
+                except Exception as e:
+                    logger.error('Scribe job lease renewal failed', extra={'job_id': str(job_id), 'error': str(e)})
+
+    threading.Thread(target=renewal_loop, name='scribe-job-queued-leases', daemon=True).start()
+
+
+def recover_unfinished_jobs():
+    """Resubmit jobs whose lease expired, e.g. because the server restarted mid-job."""
+    from azure_api_app import job_store
+    from azure_api_app.models import ScribeJob
+
+    for job in job_store.get_stale_unfinished_jobs(settings.SCRIBE_JOB_STALE_SECONDS):
+        if job.stage not in ScribeJob.RESUMABLE_STAGES:
+            job_store.update_job_stage(job.id, ScribeJob.STAGE_FAILED, error=f'Interrupted while {job.stage}')
+            continue
+
+        if job.attempts >= settings.SCRIBE_JOB_MAX_ATTEMPTS:
+            job_store.update_job_stage(job.id, ScribeJob.STAGE_FAILED, error=f'Gave up after {job.attempts} attempts')
+            continue
+
+        # The lease taken on submit keeps the recovery of other processes from queuing it too
+        try:
+            submit_scribe_job(job.id)
+        except JobQueueFull:
+            break
+
+
+def start_job_recovery():
+    """Run `recover_unfinished_jobs` now and then every SCRIBE_JOB_RECOVERY_INTERVAL seconds."""
+    global job_recovery_started
+    with job_executor_lock:
+        if job_recovery_started:
+            return
+        job_recovery_started = True
+
+    def recovery_loop():
+        while True:
+            try:
+                recover_unfinished_jobs()
+            except Exception as e:
+                logger.error('Scribe job recovery failed', extra={'error': str(e)})
+            time.sleep(settings.SCRIBE_JOB_RECOVERY_INTERVAL)
+
+    threading.Thread(target=recovery_loop, name='scribe-job-recovery', daemon=True).start()
+
+
+def process_top_up(request_id):
+    """Charge one queued top-up; failed attempts go back to the queue until TOP_UP_MAX_ATTEMPTS."""
+    from azure_api_app import job_store
+    from azure_api_app.models import TopUpRequest
+    from azure_api_app.firebase_operation import FirebaseOperations
+    from azure_api_app.stripe_operation import StripeOperation
+
+    top_up_request = job_store.claim_top_up_request(request_id)
+    if not top_up_request:
+        return False
+
+    try:
+        top_up_status, credit, stripe_customer_id = FirebaseOperations().process_top_up(top_up_request, StripeOperation())
+        job_store.update_top_up_request(top_up_request.id, top_up_status, credit=credit, stripe_customer_id=stripe_customer_id)
+        return top_up_status == TopUpRequest.STATUS_SUCCEEDED
+    except Exception as e:
+        logger.error('Stripe top up failed', extra={'top_up_request_id': request_id, 'error': str(e)})
+        retry_status = TopUpRequest.STATUS_PENDING if top_up_request.attempts < settings.TOP_UP_MAX_ATTEMPTS else TopUpRequest.STATUS_FAILED
+        job_store.update_top_up_request(top_up_request.id, retry_status, error=str(e))
+        return False
+
+
+def try_lock_top_up_worker():
+    """File descriptor holding the top-up worker lock, None while another process holds it
+
+    The lock is kept until the process exits, the kernel then releases it for the next one.
+    """
+    if fcntl is None:
+        return -1
+
+    lock_fd = os.open(settings.TOP_UP_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_fd
+    except BlockingIOError:
+        os.close(lock_fd)
+        return None
+
+
+def start_top_up_worker():
+    """Charge queued Stripe top-ups every TOP_UP_POLL_INTERVAL seconds, off the scribe job path.
+
+    Every web worker starts the thread, but only the one holding TOP_UP_LOCK_FILE polls the queue.
+    """
+    global top_up_worker_started
+    with job_executor_lock:
+        if top_up_worker_started:
+            return
+        top_up_worker_started = True
+
+    def top_up_loop():
+        from azure_api_app import job_store
+
+        lock_fd = None
+        while True:
+            try:
+                if lock_fd is None:
+                    lock_fd = try_lock_top_up_worker()
+                if lock_fd is not None:
+                    for top_up_request in job_store.get_due_top_up_requests(settings.TOP_UP_STALE_SECONDS):
+                        process_top_up(top_up_request.id)
+            except Exception as e:
+                logger.error('Stripe top up worker failed', extra={'error': str(e)})
+            time.sleep(settings.TOP_UP_POLL_INTERVAL)
+
+    threading.Thread(target=top_up_loop, name='stripe-top-up', daemon=True).start()
@@ -0,0 +1,175 @@
+# From django
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+# From models
+from azure_api_app.models import ScribeJob, TopUpRequest
+
+# Other
+from datetime import timedelta
+
+# Lease owner of jobs waiting for the Assembly AI webhook, only the webhook resume takes it over before it expires
+WEBHOOK_LEASE_OWNER = 'webhook'
+
+
+def create_job(user_id, patient_name, visit_type, file_path='', upload_url='', audio_sha256='', visit_sections=None, traceparent='', audio_size=0):
+    return ScribeJob.objects.create(
+        user_id=user_id,
+        patient_name=patient_name,
+        visit_type=visit_type,
+        visit_sections=visit_sections,
+        file_path=file_path,
+        upload_url=upload_url,
+        audio_sha256=audio_sha256,
+        audio_size=audio_size,
+        traceparent=traceparent,
+    )
+
+
+def get_user_job(job_id, user_id):
+    return ScribeJob.objects.filter(pk=job_id, user_id=user_id).first()
+
+
+def get_transcript_job(job_id, transcript_id):
+    if not job_id or not transcript_id:
+        return None
+
+    try:
+        return ScribeJob.objects.filter(pk=job_id, transcript_id=transcript_id).first()
+    except ValidationError:
+        return None
+
+
+def delete_job(job_id):
+    ScribeJob.objects.filter(pk=job_id).delete()
+
+
+def get_free_lease_filter(now, current_owner=''):
+    """Jobs nobody holds a lease on, or whose lease is held by `current_owner`"""
+    is_free = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    if current_owner:
+        is_free |= Q(worker=current_owner)
+    return is_free
+
+
+def lease_job(job_id, owner, lease_seconds, current_owner=''):
+    """Take the lease of an unfinished job; False if someone else holds an unexpired one."""
+    now = timezone.now()
+    return ScribeJob.objects \
+        .filter(get_free_lease_filter(now, current_owner), pk=job_id) \
+        .exclude(stage__in=ScribeJob.FINISHED_STAGES) \
+        .update(worker=owner, claimed_until=now + timedelta(seconds=lease_seconds)) == 1
+
+
+def claim_job(job_id, worker, lease_seconds, queue_owner='', is_resume=False):
+    """Start a new attempt of the job under a lease held by `worker`.
+
+    Returns None if the job is finished or another process holds its lease.
+    `queue_owner` is the lease taken when the job was queued, which is handed over.
+    A resume after the webhook continues the current attempt instead of starting one.
+    """
+    now = timezone.now()
+    fields = {'updated_at': now, 'worker': worker, 'claimed_until': now + timedelta(seconds=lease_seconds)}
+    if not is_resume:
+        fields.update(attempts=F('attempts') + 1, started_at=now)
+
+    is_claimed = ScribeJob.objects \
+        .filter(get_free_lease_filter(now, queue_owner), pk=job_id) \
+        .exclude(stage__in=ScribeJob.FINISHED_STAGES) \
+        .update(**fields)
+    if not is_claimed:
+        return None
+
+    return ScribeJob.objects.get(pk=job_id)
+
+
+def renew_job_lease(job_id, owner, lease_seconds):
+    """Extend the lease while `owner` still holds it; False once it was lost"""
+    return ScribeJob.objects.filter(pk=job_id, worker=owner).update(
+        claimed_until=timezone.now() + timedelta(seconds=lease_seconds),
+    ) == 1
+
+
+def release_job(job_id, owner):
+    ScribeJob.objects.filter(pk=job_id, worker=owner).update(worker='', claimed_until=None)
+
+
+def hand_job_to_webhook(job_id, owner, wait_seconds):
+    """Pass the lease of `owner` to the webhook resume; recovery takes the job back if no webhook came within `wait_seconds`"""
+    now = timezone.now()
+    ScribeJob.objects.filter(pk=job_id, worker=owner).update(
+        worker=WEBHOOK_LEASE_OWNER,
+        claimed_until=now + timedelta(seconds=wait_seconds),
+        updated_at=now,
+    )
+
+
+def update_job_stage(job_id, stage, **fields):
+    now = timezone.now()
+    if stage in ScribeJob.FINISHED_STAGES:
+        fields['finished_at'] = now
+
+    ScribeJob.objects.filter(pk=job_id).update(stage=stage, updated_at=now, **fields)
+
+
+def touch_job(job_id):
+    ScribeJob.objects.filter(pk=job_id).update(updated_at=timezone.now())
+
+
+def get_stale_unfinished_jobs(stale_seconds):
+    """Unfinished jobs whose lease expired (the process holding it died), or that nobody picked up for `stale_seconds`"""
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=stale_seconds)
+    return list(
+        ScribeJob.objects
+        .exclude(stage__in=ScribeJob.FINISHED_STAGES)
+        .filter(Q(claimed_until__lt=now) | Q(claimed_until__isnull=True, updated_at__lt=stale_before))
+        .order_by('created_at')
+    )
+
+
+def create_top_up_request(user_id, stripe_customer_id='', credit=0):
+    """Queue a top-up for the user, or return the one already open for them."""
+    try:
+        with transaction.atomic():
+            return TopUpRequest.objects.create(user_id=user_id, stripe_customer_id=stripe_customer_id, credit=credit)
+    except IntegrityError:
+        return TopUpRequest.objects.filter(user_id=user_id, status__in=TopUpRequest.OPEN_STATUSES).first()
+
+
+def claim_top_up_request(request_id):
+    """Start a new attempt of the top-up; returns None if it is finished or another worker claimed it first."""
+    top_up_request = TopUpRequest.objects.filter(pk=request_id).first()
+    if not top_up_request or top_up_request.status in TopUpRequest.FINISHED_STATUSES:
+        return None
+
+    is_claimed = TopUpRequest.objects.filter(pk=request_id, attempts=top_up_request.attempts).update(
+        status=TopUpRequest.STATUS_PROCESSING,
+        attempts=F('attempts') + 1,
+        updated_at=timezone.now(),
+    )
+    if not is_claimed:
+        return None
+
+    top_up_request.refresh_from_db()
+    return top_up_request
+
+
+def update_top_up_request(request_id, status, **fields):
+    now = timezone.now()
+    if status in TopUpRequest.FINISHED_STATUSES:
+        fields['finished_at'] = now
+
+    TopUpRequest.objects.filter(pk=request_id).update(status=status, updated_at=now, **fields)
+
+
+def get_due_top_up_requests(stale_seconds):
+    """Pending top-ups, plus those stuck in processing (e.g. the server restarted mid-charge)"""
+    stale_before = timezone.now() - timedelta(seconds=stale_seconds)
+    return list(
+        TopUpRequest.objects
+        .filter(Q(status=TopUpRequest.STATUS_PENDING) | Q(status=TopUpRequest.STATUS_PROCESSING, updated_at__lt=stale_before))
+        .order_by('created_at')
+    )
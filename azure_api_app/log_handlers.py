@@ -0,0 +1,219 @@
+"""Queued JSON logging to a rotating file shared by the web workers and the scribe job workers.
+
+Loggers only put records on an in-memory queue (QueuedJsonFileHandler), a
+listener thread per process formats them as one JSON line each and writes
+them to a LockedRotatingFileHandler. The file is locked while a line is
+written or rotated, so processes never interleave or rotate under each other.
+RepeatedErrorFilter lets only a few identical records through per window and
+reports how many were suppressed with the next one, so an upstream outage
+doesn't flood the file.
+"""
+# Other
+import os
+import copy
+import json
+import time
+import queue
+import logging
+import threading
+import traceback
+from datetime import datetime, timezone
+from multiprocessing.util import Finalize
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, rotation is then only safe within one process
+    fcntl = None
+
+# Attributes of every LogRecord, anything else on a record came from `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'trace_id'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the `extra` fields of the record as top level keys"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        trace_id = getattr(record, 'trace_id', '')
+        if trace_id:
+            data["trace_id"] = trace_id
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = record.stack_info
+
+        return json.dumps(data, default=str)
+
+
+class RepeatedErrorFilter(logging.Filter):
+    """Let `burst` identical records through every `window` seconds, later ones are counted and dropped
+
+    Records are identical when logger, level, message and `error` field match.
+    The first record let through after a suppression carries `suppressed`.
+    """
+
+    MAX_KEYS = 1024
+
+    def __init__(self, burst=5, window=60):
+        super().__init__()
+        self.burst = int(burst)
+        self.window = float(window)
+        self.seen = {}
+        self.seen_lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0:
+            return True
+
+        key = (record.name, record.levelno, record.getMessage(), str(getattr(record, 'error', '')))
+        now = time.monotonic()
+        with self.seen_lock:
+            window_start, count, suppressed = self.seen.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                window_start, count = now, 0
+
+            if count >= self.burst:
+                self.seen[key] = (window_start, count, suppressed + 1)
+                return False
+
+            self.seen[key] = (window_start, count + 1, 0)
+            if len(self.seen) > self.MAX_KEYS:
+                self.forget_expired(now)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def forget_expired(self, now):
+        for key, (window_start, _count, _suppressed) in list(self.seen.items()):
+            if now - window_start >= self.window:
+                del self.seen[key]
+
+
+class LockedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that holds an exclusive lock on `<filename>.lock` while it writes or rotates
+
+    A file rotated away by another process is noticed by its inode and reopened.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, encoding='utf-8'):
+        super().__init__(filename, maxBytes=int(max_bytes), backupCount=int(backup_count), encoding=encoding)
+        self.lock_file = open(f"{self.baseFilename}.lock", 'a') if fcntl else None
+
+    def emit(self, record):
+        if self.lock_file is None:
+            return super().emit(record)
+
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.reopen_if_rotated()
+                super().emit(record)
+                self.flush()
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+    def reopen_if_rotated(self):
+        if self.stream is None:
+            return
+
+        try:
+            is_current = os.fstat(self.stream.fileno()).st_ino == os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            is_current = False
+
+        if not is_current:
+            self.stream.close()
+            self.stream = self._open()
+
+    def close(self):
+        super().close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class QueuedJsonFileHandler(QueueHandler):
+    """Puts records on a bounded queue; a listener thread writes them as JSON lines to a LockedRotatingFileHandler
+
+    Logging never waits for the disk. When the queue is full the record is
+    dropped and the count is reported with the next record that fits.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, queue_size=10000):
+        super().__init__(queue.Queue(maxsize=int(queue_size)))
+        self.file_handler = LockedRotatingFileHandler(filename, max_bytes, backup_count)
+        self.file_handler.setFormatter(JsonFormatter())
+        self.listener = QueueListener(self.queue, self.file_handler, respect_handler_level=False)
+        self.listener_lock = threading.Lock()
+        self.listener_started = False
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Runs on the logging thread: merge the args and render the traceback now, the listener only serializes
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = get_trace_id()
+
+        if self.dropped:
+            record.dropped, self.dropped = self.dropped, 0
+        return record
+
+    def enqueue(self, record):
+        self.start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1 + getattr(record, 'dropped', 0)
+
+    def start_listener(self):
+        if self.listener_started:
+            return
+
+        with self.listener_lock:
+            if self.listener_started:
+                return
+            self.listener.start()
+            self.listener_started = True
+        # Write out what is still queued when the process exits; multiprocessing children skip atexit but run finalizers
+        Finalize(self, self.close, exitpriority=10)
+
+    def close(self):
+        with self.listener_lock:
+            if self.listener_started:
+                self.listener.stop()
+                self.listener_started = False
+        self.file_handler.close()
+        super().close()
+
+
+def get_trace_id():
+    # Imported lazily: LOGGING is configured while django is still loading its settings
+    from azure_api_app.tracing import current_span
+    parent = current_span.get()
+    return parent.trace_id if parent else ''
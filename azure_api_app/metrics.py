@@ -0,0 +1,338 @@
+"""Counters and latency histograms shared by the web workers and the scribe job workers.
+
+Every process keeps its metrics in memory and flushes them every
+METRICS_FLUSH_INTERVAL seconds to its own JSON file in METRICS_DIR. The
+/metrics view merges all files into one Prometheus text exposition, so a
+scrape sees the totals of every worker whichever worker answers it.
+
+The file of an exited process is folded into DEAD_PROCESSES_FILE before it is
+removed (like prometheus_client's mark_process_dead), so the merged counters
+never go backwards when workers are recycled.
+"""
+# Other
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, folding is then only safe within one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(current_directory, "metrics_data"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# Files of exited processes are folded into DEAD_PROCESSES_FILE once they are this old
+METRICS_STALE_SECONDS = int(os.environ.get('METRICS_STALE_SECONDS', 3600))
+
+# Seconds; wide enough for a whole scribe job
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+METRICS_FILE_PREFIX = 'metrics-'
+# Totals of every exited process, plus the names of the files already added to them
+DEAD_PROCESSES_FILE = 'dead-processes.json'
+METRICS_LOCK_FILE = 'metrics.lock'
+
+# Global variables
+counters = {}
+histograms = {}
+metrics_lock = threading.Lock()
+metrics_file_name = None
+flush_thread_started = False
+
+
+def get_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """Add to a counter, e.g. increment('scribe_jobs_total', stage='billed')"""
+    key = get_key(name, labels)
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+    start_flush_thread()
+
+
+def observe(name, value, **labels):
+    """Record a value (seconds) in a histogram"""
+    key = get_key(name, labels)
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0, 'count': 0}
+
+        for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bucket:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+    start_flush_thread()
+
+
+def timed_stage(stage):
+    """Time a pipeline step into `scribe_stage_seconds` and count it in `scribe_stage_failures_total` when it returns False or raises"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = False
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                observe('scribe_stage_seconds', time.perf_counter() - start, stage=stage)
+                if result is False:
+                    increment('scribe_stage_failures_total', stage=stage)
+        return wrapper
+
+    return decorator
+
+
+def get_endpoint(url):
+    """URL path with the ids replaced, so e.g. every transcript poll shares one label"""
+    path = urlparse(str(url)).path
+    segments = []
+    for segment in path.split('/'):
+        if re.fullmatch(r'[0-9a-f-]{16,}|[a-z]{2,5}_[A-Za-z0-9_]+|\d+', segment):
+            segment = ':id'
+        segments.append(segment)
+    return '/'.join(segments) or '/'
+
+
+def record_upstream_request(upstream, method, url, status_code, seconds):
+    labels = {'upstream': upstream, 'method': method, 'endpoint': get_endpoint(url)}
+    observe('upstream_request_seconds', seconds, **labels)
+    increment('upstream_requests_total', status=f"{str(status_code)[0]}xx", **labels)
+
+
+def get_requests_hook(upstream):
+    """requests response hook; `elapsed` is the time until the response headers arrived"""
+    def hook(response, *args, **kwargs):
+        record_upstream_request(upstream, response.request.method, response.request.url, response.status_code, response.elapsed.total_seconds())
+        return response
+    return hook
+
+
+def get_httpx_event_hooks(upstream, is_async=False):
+    """httpx event hooks timing each request until its response headers arrived"""
+    def on_request(request):
+        request.extensions['metrics_start'] = time.perf_counter()
+
+    def on_response(response):
+        start = response.request.extensions.get('metrics_start')
+        if start is not None:
+            record_upstream_request(upstream, response.request.method, response.request.url, response.status_code, time.perf_counter() - start)
+
+    if not is_async:
+        return {'request': [on_request], 'response': [on_response]}
+
+    async def on_request_async(request):
+        on_request(request)
+
+    async def on_response_async(response):
+        on_response(response)
+
+    return {'request': [on_request_async], 'response': [on_response_async]}
+
+
+def start_flush_thread():
+    global flush_thread_started
+    if flush_thread_started:
+        return
+
+    with metrics_lock:
+        if flush_thread_started:
+            return
+        flush_thread_started = True
+
+    def flush_loop():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            flush_metrics()
+
+    threading.Thread(target=flush_loop, name='metrics-flush', daemon=True).start()
+    atexit.register(flush_metrics)
+
+
+def flush_metrics():
+    """Write this process' metrics to its file in METRICS_DIR (atomically)"""
+    global metrics_file_name
+    try:
+        with metrics_lock:
+            data = get_metrics_data(counters, histograms)
+            if metrics_file_name is None:
+                # The start time tells a recycled pid from the process that had it before
+                metrics_file_name = f"{METRICS_FILE_PREFIX}{os.getpid()}-{time.time_ns()}.json"
+
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        write_metrics_file(os.path.join(METRICS_DIR, metrics_file_name), data)
+        return True
+    except Exception as e:
+        logger.error('Metrics flush failed', extra={'error': str(e)})
+        return False
+
+
+def get_metrics_data(counters, histograms):
+    """JSON-ready form of counters and histograms, as stored in the metrics files"""
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), {**histogram, 'buckets': list(histogram['buckets'])}] for (name, labels), histogram in histograms.items()],
+    }
+
+
+def write_metrics_file(file_path, data):
+    # Written to a temporary file and renamed, readers never see half a file
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+    with os.fdopen(file_descriptor, 'w') as temporary_file:
+        json.dump(data, temporary_file)
+    os.replace(temporary_path, file_path)
+
+
+def read_metrics_file(file_path):
+    """Data of a metrics file, None when it is gone or unreadable"""
+    try:
+        with open(file_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def add_metrics(merged_counters, merged_histograms, data):
+    for name, labels, value in data.get('counters', []):
+        key = get_key(name, labels)
+        merged_counters[key] = merged_counters.get(key, 0) + value
+
+    for name, labels, histogram in data.get('histograms', []):
+        key = get_key(name, labels)
+        merged = merged_histograms.setdefault(key, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0, 'count': 0})
+        merged['buckets'] = [total + count for total, count in zip(merged['buckets'], histogram['buckets'])]
+        merged['sum'] += histogram['sum']
+        merged['count'] += histogram['count']
+
+
+@contextmanager
+def metrics_dir_lock():
+    """Exclusive across processes while the dead processes' totals are read or changed"""
+    if fcntl is None:
+        yield
+        return
+
+    with open(os.path.join(METRICS_DIR, METRICS_LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def fold_dead_process(file_name, dead_data):
+    """Add an exited process' metrics to `dead_data` and write it out before the process' file is removed
+
+    `dead_data['folded']` lists the files already added, so a file left behind by a crash
+    between the write and the removal is not counted twice. Call with metrics_dir_lock held.
+    """
+    file_path = os.path.join(METRICS_DIR, file_name)
+    folded = [name for name in dead_data.get('folded', []) if os.path.exists(os.path.join(METRICS_DIR, name))]
+    if file_name not in folded:
+        data = read_metrics_file(file_path)
+        if data is None:
+            return dead_data
+
+        dead_counters, dead_histograms = {}, {}
+        add_metrics(dead_counters, dead_histograms, dead_data)
+        add_metrics(dead_counters, dead_histograms, data)
+        dead_data = {**get_metrics_data(dead_counters, dead_histograms), 'folded': folded + [file_name]}
+        write_metrics_file(os.path.join(METRICS_DIR, DEAD_PROCESSES_FILE), dead_data)
+
+    os.remove(file_path)
+    return dead_data
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def collect_metrics():
+    """Sum of the metrics files of every process, exited ones included"""
+    flush_metrics()
+
+    merged_counters = {}
+    merged_histograms = {}
+    # Held while reading too, so a file folded by another worker meanwhile is neither missed nor counted twice
+    with metrics_dir_lock():
+        dead_data = read_metrics_file(os.path.join(METRICS_DIR, DEAD_PROCESSES_FILE)) or {}
+        process_files = []
+        for file_name in os.listdir(METRICS_DIR):
+            if not file_name.startswith(METRICS_FILE_PREFIX) or not file_name.endswith('.json'):
+                continue
+
+            file_path = os.path.join(METRICS_DIR, file_name)
+            try:
+                pid = int(file_name[len(METRICS_FILE_PREFIX):].split('-')[0])
+                if not is_process_alive(pid) and time.time() - os.path.getmtime(file_path) > METRICS_STALE_SECONDS:
+                    dead_data = fold_dead_process(file_name, dead_data)
+                    continue
+            except (OSError, ValueError):
+                continue
+            process_files.append(file_path)
+
+        add_metrics(merged_counters, merged_histograms, dead_data)
+        folded = set(dead_data.get('folded', []))
+        for file_path in process_files:
+            data = read_metrics_file(file_path)
+            # Folded but left behind by a crash before its removal, already in the dead processes' totals
+            if data is not None and os.path.basename(file_path) not in folded:
+                add_metrics(merged_counters, merged_histograms, data)
+
+    return merged_counters, merged_histograms
+
+
+def format_labels(labels, **extra_labels):
+    all_labels = [*labels, *extra_labels.items()]
+    if not all_labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in all_labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render_prometheus():
+    """Prometheus text exposition format (0.0.4) of the merged metrics"""
+    merged_counters, merged_histograms = collect_metrics()
+    lines = []
+
+    for metric_name in sorted({name for name, _labels in merged_counters}):
+        lines.append(f"# TYPE {metric_name} counter")
+        for (name, labels), value in sorted(merged_counters.items()):
+            if name == metric_name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for metric_name in sorted({name for name, _labels in merged_histograms}):
+        lines.append(f"# TYPE {metric_name} histogram")
+        for (name, labels), histogram in sorted(merged_histograms.items()):
+            if name != metric_name:
+                continue
+            # Buckets are stored cumulative, a value is counted in every bucket at or above it
+            for bucket, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+                lines.append(f"{name}_bucket{format_labels(labels, le=bucket)} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+    return '\n'.join(lines) + '\n'
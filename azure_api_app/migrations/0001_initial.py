@@ -0,0 +1,50 @@
+# Generated by Django 5.0.1
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="ScribeJob",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("user_id", models.CharField(db_index=True, max_length=128)),
+                ("patient_name", models.CharField(max_length=255)),
+                ("visit_type", models.CharField(max_length=255)),
+                ("file_path", models.CharField(blank=True, default="", max_length=1024)),
+                ("transcript_id", models.CharField(blank=True, default="", max_length=128)),
+                (
+                    "stage",
+                    models.CharField(
+                        choices=[
+                            ("uploaded", "Uploaded"),
+                            ("transcribing", "Transcribing"),
+                            ("generating", "Generating"),
+                            ("persisting", "Persisting"),
+                            ("billed", "Billed"),
+                            ("failed", "Failed"),
+                        ],
+                        db_index=True,
+                        default="uploaded",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("error", models.TextField(blank=True, default="")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ["-created_at"],
+            },
+        ),
+    ]
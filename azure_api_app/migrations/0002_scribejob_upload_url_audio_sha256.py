@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scribejob",
+            name="upload_url",
+            field=models.CharField(blank=True, default="", max_length=1024),
+        ),
+        migrations.AddField(
+            model_name="scribejob",
+            name="audio_sha256",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
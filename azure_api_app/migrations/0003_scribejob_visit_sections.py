@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0002_scribejob_upload_url_audio_sha256"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scribejob",
+            name="visit_sections",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
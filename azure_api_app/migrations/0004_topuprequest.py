@@ -0,0 +1,54 @@
+# Generated by Django 5.0.1
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0003_scribejob_visit_sections"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TopUpRequest",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("user_id", models.CharField(db_index=True, max_length=128)),
+                ("stripe_customer_id", models.CharField(blank=True, default="", max_length=128)),
+                ("credit", models.FloatField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("processing", "Processing"),
+                            ("succeeded", "Succeeded"),
+                            ("skipped", "Skipped"),
+                            ("failed", "Failed"),
+                        ],
+                        db_index=True,
+                        default="pending",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("error", models.TextField(blank=True, default="")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ["-created_at"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="topuprequest",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status__in", ["pending", "processing"])),
+                fields=("user_id",),
+                name="one_open_top_up_per_user",
+            ),
+        ),
+    ]
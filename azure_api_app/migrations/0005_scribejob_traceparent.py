@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0004_topuprequest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scribejob",
+            name="traceparent",
+            field=models.CharField(blank=True, default="", max_length=55),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0005_scribejob_traceparent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scribejob",
+            name="worker",
+            field=models.CharField(blank=True, default="", max_length=128),
+        ),
+        migrations.AddField(
+            model_name="scribejob",
+            name="claimed_until",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_api_app", "0006_scribejob_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scribejob",
+            name="audio_size",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -1,3 +1,131 @@
 from django.db import models
 
-# Create your models here.
+# Other
+import uuid
+
+
+class ScribeJob(models.Model):
+    """Durable record of one scribe upload and how far its background job got."""
+
+    STAGE_UPLOADED = 'uploaded'
+    STAGE_TRANSCRIBING = 'transcribing'
+    STAGE_GENERATING = 'generating'
+    STAGE_PERSISTING = 'persisting'
+    STAGE_BILLED = 'billed'
+    STAGE_FAILED = 'failed'
+
+    STAGE_CHOICES = [
+        (STAGE_UPLOADED, 'Uploaded'),
+        (STAGE_TRANSCRIBING, 'Transcribing'),
+        (STAGE_GENERATING, 'Generating'),
+        (STAGE_PERSISTING, 'Persisting'),
+        (STAGE_BILLED, 'Billed'),
+        (STAGE_FAILED, 'Failed'),
+    ]
+
+    # A job interrupted while persisting may already be written to firebase and billed, so it is never re-run
+    FINISHED_STAGES = (STAGE_BILLED, STAGE_FAILED)
+    RESUMABLE_STAGES = (STAGE_UPLOADED, STAGE_TRANSCRIBING, STAGE_GENERATING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user_id = models.CharField(max_length=128, db_index=True)
+    patient_name = models.CharField(max_length=255)
+    visit_type = models.CharField(max_length=255)
+    visit_sections = models.JSONField(null=True, blank=True)
+    file_path = models.CharField(max_length=1024, blank=True, default='')
+    upload_url = models.CharField(max_length=1024, blank=True, default='')
+    audio_sha256 = models.CharField(max_length=64, blank=True, default='')
+    # Bytes received from the client, the temporary file is gone in streaming mode and once uploaded
+    audio_size = models.PositiveBigIntegerField(default=0)
+    # W3C traceparent of the upload request, the job's spans continue its trace
+    traceparent = models.CharField(max_length=55, blank=True, default='')
+    transcript_id = models.CharField(max_length=128, blank=True, default='')
+    stage = models.CharField(max_length=16, choices=STAGE_CHOICES, default=STAGE_UPLOADED, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Lease of the process that queued or runs the job, nobody else may run it until it expires
+    worker = models.CharField(max_length=128, blank=True, default='')
+    claimed_until = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.id} ({self.stage})"
+
+    @property
+    def is_finished(self):
+        return self.stage in self.FINISHED_STAGES
+
+    def status_data(self):
+        return {
+            "job_id": str(self.id),
+            "stage": self.stage,
+            "is_finished": self.is_finished,
+            "attempts": self.attempts,
+            "error": self.error,
+            "patient_name": self.patient_name,
+            "visit_type": self.visit_type,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class TopUpRequest(models.Model):
+    """Queued Stripe auto payment for a user whose add-on balance reached the auto pay threshold.
+
+    A user has at most one open (pending or processing) request, so repeated threshold
+    crossings before the charge goes through are coalesced into one payment.
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_SKIPPED, 'Skipped'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    OPEN_STATUSES = (STATUS_PENDING, STATUS_PROCESSING)
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_SKIPPED, STATUS_FAILED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user_id = models.CharField(max_length=128, db_index=True)
+    stripe_customer_id = models.CharField(max_length=128, blank=True, default='')
+    credit = models.FloatField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_id'],
+                condition=models.Q(status__in=['pending', 'processing']),
+                name='one_open_top_up_per_user',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    @property
+    def idempotency_key(self):
+        """Same key on every attempt, so Stripe charges the request at most once"""
+        return f"scribe-top-up-{self.id}"
@@ -1,31 +1,67 @@
 import os
 import json
-import requests
 import logging
-from datetime import datetime
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared connection pools
+from azure_api_app.http_client import get_session, get_async_client, get_timeout
+
+# System prompt builder
+from azure_api_app.prompt_builder import build_scribe_system_prompt, build_fact_extraction_prompt
+
+# Fallback and retry counters
+from azure_api_app import metrics
+
+# Token counting
+from azure_api_app.token_counter import count_tokens, split_transcript
+
+# Tracing
+from azure_api_app.tracing import trace_methods, in_current_context
+
+# Upstream concurrency, rate limit and retries
+from azure_api_app.upstream_limiter import request_with_retries, async_request_with_retries
 
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+@trace_methods(exclude=('get_headers', 'get_section_key'))
 class OpenAIOperation:
 
     BASE_MODEL_FILE = "file-soeaA8uJsLhEN375RvNAbyOT"
     BASE_MODEL = "ft:gpt-3.5-turbo-1106:newgate-software-inc:scribe-ai-model:90MgF1zN"
     
-    # Open ai APIs
-    COMPLETION_URL = "https://api.openai.com/v1/chat/completions"
+    # Open ai APIs (OPENAI_BASE_URL can point at a local stub server)
+    BASE_URL = os.environ.get('OPENAI_BASE_URL', "https://api.openai.com/v1")
+    COMPLETION_URL = f"{BASE_URL}/chat/completions"
+
+    # Sections per concurrent completion for scribe notes (0 keeps the single completion for all sections)
+    SECTION_GROUP_SIZE = int(os.environ.get('SCRIBE_SECTION_GROUP_SIZE', 0))
+    SECTION_CONCURRENCY = int(os.environ.get('SCRIBE_SECTION_CONCURRENCY', 4))
+    SECTION_RETRIES = int(os.environ.get('SCRIBE_SECTION_RETRIES', 1))
+
+    # Transcripts above MAP_REDUCE_TOKENS are condensed chunk by chunk before the notes are generated (0 disables)
+    MAP_REDUCE_TOKENS = int(os.environ.get('SCRIBE_MAP_REDUCE_TOKENS', 12000))
+    MAP_CHUNK_TOKENS = int(os.environ.get('SCRIBE_MAP_CHUNK_TOKENS', 6000))
+
+    DEFAULT_SECTION_TEXT = "We’re sorry, something has gone wrong. Please try later."
 
     def __init__(self):
+        self.headers = self.get_headers()
+        self.session = get_session('openai')
+
+
+    @staticmethod
+    def get_headers():
         OPENAI_KEY = os.environ.get('OPENAI_KEY')
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json',
             'Authorization': f'Bearer {OPENAI_KEY}',
         }
-        self.headers = headers
+        return headers
 
 
     def generate_gpt_response(self, system_prompt=None, user_prompt=None, payload=False, is_only_msg=False, is_json_res=False):
@@ -47,7 +83,7 @@ class OpenAIOperation:
             if not payload:
                 return False, False
 
-            response = requests.request("POST", self.COMPLETION_URL, headers=self.headers, data=payload)
+            response = request_with_retries('openai', lambda: self.session.request("POST", self.COMPLETION_URL, headers=self.headers, data=payload, timeout=get_timeout()))
             response_data = response.json()
 
             if response.status_code == 200:
@@ -56,39 +92,58 @@ class OpenAIOperation:
             else:
                 return False, response_data
         except Exception as e:
-            logger.error(f'\n------------- ERROR (generate gpt response) -------------\n{datetime.now()}\n{str(e)}\n--------------------------------------------------------------\n')
+            logger.error('Generate gpt response failed', extra={'error': str(e)})
             return False, False
 
+
+
+    def open_gpt_stream(self, payload):
+        """Start a streamed completion; returns (True, upstream response) or (False, error data)"""
+        try:
+            # Retried until the stream starts, nothing is resent once events are relayed
+            response = request_with_retries('openai', lambda: self.session.request("POST", self.COMPLETION_URL, headers=self.headers, data=payload, timeout=get_timeout(), stream=True))
+            if response.status_code == 200:
+                return True, response
+
+            response_data = response.json()
+            response.close()
+            return False, response_data
+        except Exception as e:
+            logger.error('Open gpt stream failed', extra={'error': str(e)})
+            return False, False
+
+
+    @staticmethod
+    def iter_gpt_stream(response):
+        """Relay the upstream `data:` events as server-sent events without buffering the body.
+
+        Closing the generator (client disconnected) closes the upstream connection.
+        """
+        try:
+            for line in response.iter_lines(chunk_size=None):
+                if line.startswith(b'data:'):
+                    yield line + b'\n\n'
+        except Exception as e:
+            logger.error('Gpt stream failed', extra={'error': str(e)})
+            yield b'event: error\ndata: {"message": "Stream interrupted"}\n\n'
+        finally:
+            response.close()
+
    
     def generate_scribe_simple_response(self, user_message, system_prompt_list):
 
+        # Long conversations don't fit the model context, generate from the facts extracted from each part instead
+        if self.MAP_REDUCE_TOKENS > 0 and count_tokens(user_message) > self.MAP_REDUCE_TOKENS:
+            metrics.increment('scribe_map_reduce_total')
+            user_message = self.extract_transcript_facts(user_message, system_prompt_list) or user_message
+
+        if self.SECTION_GROUP_SIZE > 0:
+            return self.generate_scribe_sections_response(user_message, system_prompt_list)
+
         scribe_simple_data = []
         try:
-            system_prompt_string = '### Section Definitions:\n'
-
-            # Sections string
-            system_titles = [item["title"] for item in system_prompt_list]
-            title_result_string = ', '.join([f"`'{title}'`" for title in system_titles[:-1]]) + f" and `'{system_titles[-1]}'`"
-            total_sections = len(system_titles)
-            
-            # Sections definitions string in prompt
-            for index, data in enumerate(system_prompt_list):
-                index += 1
-                title = data.get("title", "").lower().replace(" ", "_")
-                body_text = data.get("body_text", "")
-                result_string = f"\n    \"{title}\": \"{body_text}\""
-
-                if index == 1:
-                    system_prompt_string += ('```json\n{' + result_string + ',')
-                
-                elif index == total_sections:
-                    system_prompt_string += (result_string + '\n}\n```')
-
-                else:
-                    system_prompt_string += f'{result_string},'
-            
-            # Generate dynamic system prompt
-            system_messages_content = f"### Task:\nYou will be provided with a CONVERSATION between the healthcare provider and the patient.\nBased on the conversation provide a detailed, comprehensive, and informative response for the sections {title_result_string}.  keeping in mind the definitions and you must have to generate responses for all the {total_sections} sections.\n\n{system_prompt_string}\n\n## Note:\n\tYou have to Extract as much as Possible Details from the CONVERSATION and Provide it in Particular section Using Layperson terms. If you are unable to find the necessary information for Any of the {total_sections} Sections, please WRITE `'UNABLE TO FIND THESE DETAILS'` INSTEAD,\n\n# Response Format:\n\tWrite Your Response in JSON Format (object with the following keys (Section name) and values). as Encodeded JSON String."
+            # Generate dynamic system prompt (compiled once per section list)
+            system_messages_content = build_scribe_system_prompt(system_prompt_list)
            
             # User prompt
             user_message_prompt = f"## CONVERSATION:\n\n{user_message}"
@@ -106,7 +161,8 @@ class OpenAIOperation:
                     }
                     scribe_simple_data.append(gpt_data)
             else:
-                default_gpt_string = "We’re sorry, something has gone wrong. Please try later."
+                default_gpt_string = self.DEFAULT_SECTION_TEXT
+                metrics.increment('scribe_fallbacks_total', len(system_prompt_list), kind='default_section_text')
                 for system_data in system_prompt_list:
                     gpt_title = system_data.get("title", "")
                     if gpt_title:
@@ -121,5 +177,180 @@ class OpenAIOperation:
 
             return True, scribe_simple_data
         except Exception as e:
-            logger.error(f'\n----------- ERROR (generate scribe simple response) -----------\n{datetime.now()}\n{str(e)}\n--------------------------------------------------------------\n')
-            return False, {'status': 'error', 'message': f'Error loading system prompts: {str(e)}'}
\ No newline at end of file
+            logger.error('Generate scribe simple response failed', extra={'error': str(e)})
+            return False, {'status': 'error', 'message': f'Error loading system prompts: {str(e)}'}
+
+
+    def generate_scribe_sections_response(self, user_message, system_prompt_list):
+        """Generate the sections in groups of SECTION_GROUP_SIZE with concurrent completions.
+
+        At most SECTION_CONCURRENCY completions run at once for the job. Sections that
+        come back missing (failed call, malformed JSON or key left out) are regrouped and
+        retried up to SECTION_RETRIES times; whatever is still missing gets the default text.
+        """
+        try:
+            sections = [data for data in system_prompt_list if data.get("title", "")]
+            if not sections:
+                return False, {'status': 'error', 'message': 'No data generated for system prompts.'}
+
+            user_message_prompt = f"## CONVERSATION:\n\n{user_message}"
+            generated_sections = {}
+            pending_sections = sections
+
+            with ThreadPoolExecutor(max_workers=self.SECTION_CONCURRENCY, thread_name_prefix='scribe-sections') as executor:
+                for _attempt in range(self.SECTION_RETRIES + 1):
+                    section_groups = [pending_sections[index:index + self.SECTION_GROUP_SIZE] for index in range(0, len(pending_sections), self.SECTION_GROUP_SIZE)]
+                    for group_response in executor.map(in_current_context(lambda group: self.generate_section_group(user_message_prompt, group)), section_groups):
+                        generated_sections.update(group_response)
+
+                    pending_sections = [data for data in sections if self.get_section_key(data["title"]) not in generated_sections]
+                    if not pending_sections:
+                        break
+                    metrics.increment('scribe_retries_total', len(pending_sections), kind='section')
+
+            if pending_sections:
+                metrics.increment('scribe_fallbacks_total', len(pending_sections), kind='default_section_text')
+            if len(pending_sections) == len(sections):
+                logger.error('Generate scribe sections response failed', extra={'error': 'No section generated'})
+
+            scribe_simple_data = []
+            for system_data in sections:
+                section_key = self.get_section_key(system_data["title"])
+                scribe_simple_data.append({
+                    "title": section_key.replace("_", " ").title(),
+                    "body_text": generated_sections.get(section_key, self.DEFAULT_SECTION_TEXT),
+                })
+            return True, scribe_simple_data
+        except Exception as e:
+            logger.error('Generate scribe sections response failed', extra={'error': str(e)})
+            return False, {'status': 'error', 'message': f'Error loading system prompts: {str(e)}'}
+
+
+    def generate_section_group(self, user_message_prompt, section_group):
+        """{section_key: body_text} for the sections of the group the model answered"""
+        system_messages_content = build_scribe_system_prompt(section_group)
+        gpt_status, gpt_response = self.generate_gpt_response(system_prompt=system_messages_content, user_prompt=user_message_prompt, is_only_msg=True, is_json_res=True)
+        if not gpt_status:
+            return {}
+
+        try:
+            gpt_content_data = json.loads(gpt_response)
+        except (TypeError, ValueError):
+            return {}
+        if not isinstance(gpt_content_data, dict):
+            return {}
+
+        expected_keys = {self.get_section_key(data["title"]) for data in section_group}
+        group_response = {}
+        for gpt_c_title, gpt_c_message in gpt_content_data.items():
+            section_key = self.get_section_key(gpt_c_title)
+            if section_key in expected_keys and gpt_c_message:
+                group_response[section_key] = gpt_c_message
+        return group_response
+
+
+    def extract_transcript_facts(self, user_message, system_prompt_list):
+        """Map step for long transcripts.
+
+        The transcript is split between lines into MAP_CHUNK_TOKENS sized parts, the facts
+        for every section are extracted from the parts concurrently, and the facts are
+        merged per section in conversation order. The merged facts stand in for the
+        conversation when the sections are generated. Returns False if no part succeeded.
+        """
+        try:
+            sections = [data for data in system_prompt_list if data.get("title", "")]
+            transcript_chunks = split_transcript(user_message, self.MAP_CHUNK_TOKENS)
+            total_chunks = len(transcript_chunks)
+            system_messages_content = build_fact_extraction_prompt(sections)
+
+            def extract_chunk_facts(index_chunk):
+                index, transcript_chunk = index_chunk
+                user_message_prompt = f"## CONVERSATION (part {index} of {total_chunks}):\n\n{transcript_chunk}"
+                gpt_status, gpt_response = self.generate_gpt_response(system_prompt=system_messages_content, user_prompt=user_message_prompt, is_only_msg=True, is_json_res=True)
+                if not gpt_status:
+                    return False
+                try:
+                    chunk_facts = json.loads(gpt_response)
+                except (TypeError, ValueError):
+                    return False
+                return chunk_facts if isinstance(chunk_facts, dict) else False
+
+            with ThreadPoolExecutor(max_workers=self.SECTION_CONCURRENCY, thread_name_prefix='scribe-facts') as executor:
+                chunks_facts = list(executor.map(in_current_context(extract_chunk_facts), enumerate(transcript_chunks, start=1)))
+
+            if not any(chunks_facts):
+                return False
+
+            # Reduce: facts of each section in the order of the conversation parts
+            facts_parts = []
+            for system_data in sections:
+                section_key = self.get_section_key(system_data["title"])
+                section_facts = []
+                for chunk_facts in filter(None, chunks_facts):
+                    facts = {self.get_section_key(key): value for key, value in chunk_facts.items()}.get(section_key)
+                    facts = '\n'.join(map(str, facts)) if isinstance(facts, list) else str(facts or '').strip()
+                    if facts:
+                        section_facts.append(facts)
+                facts_parts.append(f"### {system_data['title']}\n" + ('\n'.join(section_facts) or 'No details mentioned.'))
+
+            return "The conversation was too long to include in full. These are the facts extracted from it, grouped by section:\n\n" + '\n\n'.join(facts_parts)
+        except Exception as e:
+            logger.error('Extract transcript facts failed', extra={'error': str(e)})
+            return False
+
+
+    @staticmethod
+    def get_section_key(title):
+        return title.strip().lower().replace(" ", "_")
+
+
+@trace_methods
+class AsyncOpenAIOperation:
+    """Non-blocking twin of OpenAIOperation for the async views"""
+
+    def __init__(self):
+        self.headers = OpenAIOperation.get_headers()
+        self.client = get_async_client('openai')
+
+
+    async def generate_gpt_response(self, payload):
+        try:
+            response = await async_request_with_retries('openai', lambda: self.client.post(OpenAIOperation.COMPLETION_URL, headers=self.headers, content=payload))
+            response_data = response.json()
+
+            if response.status_code == 200:
+                return True, response_data
+            return False, response_data
+        except Exception as e:
+            logger.error('Generate gpt response failed', extra={'error': str(e)})
+            return False, False
+
+
+    async def open_gpt_stream(self, payload):
+        """Start a streamed completion; returns (True, upstream response) or (False, error data)"""
+        try:
+            request = self.client.build_request("POST", OpenAIOperation.COMPLETION_URL, headers=self.headers, content=payload)
+            response = await async_request_with_retries('openai', lambda: self.client.send(request, stream=True))
+            if response.status_code == 200:
+                return True, response
+
+            await response.aread()
+            await response.aclose()
+            return False, response.json()
+        except Exception as e:
+            logger.error('Open gpt stream failed', extra={'error': str(e)})
+            return False, False
+
+
+    @staticmethod
+    async def iter_gpt_stream(response):
+        """Relay the upstream `data:` events as server-sent events, the upstream is closed when the client goes away"""
+        try:
+            async for line in response.aiter_lines():
+                if line.startswith('data:'):
+                    yield f"{line}\n\n"
+        except Exception as e:
+            logger.error('Gpt stream failed', extra={'error': str(e)})
+            yield 'event: error\ndata: {"message": "Stream interrupted"}\n\n'
+        finally:
+            await response.aclose()
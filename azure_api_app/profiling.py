@@ -0,0 +1,272 @@
+"""On-demand profiling of single requests.
+
+ProfilingMiddleware profiles a request when it carries the
+`X-Profile-Token: <PROFILE_TOKEN>` header, or at random for a
+PROFILE_SAMPLE_RATE share of requests. While the request runs, a sampling
+thread reads the request thread's stack from `sys._current_frames()` every
+PROFILE_INTERVAL seconds. Two files are then written to PROFILE_DIR:
+
+- `<profile id>.folded`: the sampled stacks in folded format, for flamegraph.pl or speedscope
+- `<profile id>.json`: the request's timing breakdown (auth, firestore, upstream,
+  serialization, other), built from its tracing spans, and the spans themselves
+
+The profile id is returned in the X-Profile-Id header. The middleware removes
+itself (MiddlewareNotUsed) when neither a token nor a sample rate is set.
+
+Async views share the event loop thread with other requests, so their
+profiles sample every thread of the process and include concurrent work. A
+streamed response (e.g. chat completions) is profiled until its headers are
+returned, not while its body is relayed.
+"""
+# From django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+# Tracing
+from azure_api_app import tracing
+
+# Other
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import random
+import logging
+import secrets
+import threading
+from collections import Counter
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN_HEADER = 'HTTP_X_PROFILE_TOKEN'
+
+# Span name prefixes of each breakdown category, nested spans of the same category are counted once
+BREAKDOWN_CATEGORIES = {
+    'auth': ('FirebaseAuthorization.', 'AsyncFirebaseAuthorization.'),
+    'firestore': ('FirebaseOperations.', 'AsyncFirebaseOperations.'),
+    'upstream': (
+        'OpenAIOperation.', 'AsyncOpenAIOperation.', 'StripeOperation.', 'AsyncStripeOperation.',
+        'AssemblyAIOperation.', 'WhisperAIOperation.',
+    ),
+    'serialization': ('serialization',),
+}
+
+# Global variables
+active_profiles = {}
+active_profiles_lock = threading.Lock()
+
+
+class SamplingProfiler:
+    """Counts the folded stacks of `thread_ids` (every other thread when None) until stopped"""
+
+    def __init__(self, thread_ids=None, interval=0.005):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_thread_id = threading.get_ident()
+        thread_names = {}
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+
+                stack = self.get_folded_stack(frame)
+                if self.thread_ids is None:
+                    if thread_id not in thread_names:
+                        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    stack = f"{thread_names.get(thread_id, thread_id)};{stack}"
+                self.stacks[stack] += 1
+
+    @staticmethod
+    def get_folded_stack(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+
+    def __init__(self, request, reason, thread_ids, interval):
+        self.id = f"{time.strftime('%Y%m%d%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-')[:60]}-{secrets.token_hex(4)}"
+        self.method = request.method
+        self.path = request.path
+        self.reason = reason
+        self.spans = []
+        self.profiler = SamplingProfiler(thread_ids, interval)
+        self.trace_id = None
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def get_breakdown(self):
+        span_categories = {span.span_id: self.get_category(span.name) for span in self.spans}
+        breakdown = {category: 0.0 for category in BREAKDOWN_CATEGORIES}
+        for span in self.spans:
+            category = span_categories[span.span_id]
+            # Only the outermost span of a category counts, e.g. has_permission but not the authenticate inside it
+            if category and span_categories.get(span.parent_id) != category:
+                breakdown[category] += span.duration
+
+        # Concurrent spans (e.g. parallel stripe lookups) can add up to more than the request took
+        breakdown['other'] = max(self.seconds - sum(breakdown.values()), 0.0)
+        return {category: round(seconds, 6) for category, seconds in breakdown.items()}
+
+    @staticmethod
+    def get_category(span_name):
+        for category, prefixes in BREAKDOWN_CATEGORIES.items():
+            if span_name.startswith(prefixes):
+                return category
+        return None
+
+    def save(self, status_code):
+        try:
+            os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+            base_path = os.path.join(settings.PROFILE_DIR, self.id)
+            with open(f"{base_path}.folded", 'w') as folded_file:
+                folded_file.write(self.profiler.folded())
+
+            summary = {
+                "id": self.id,
+                "method": self.method,
+                "path": self.path,
+                "status_code": status_code,
+                "reason": self.reason,
+                "trace_id": self.trace_id,
+                "seconds": round(self.seconds, 6),
+                "samples": self.profiler.samples,
+                "interval": self.profiler.interval,
+                "breakdown": self.get_breakdown(),
+                "spans": [
+                    {"name": span.name, "span_id": span.span_id, "parent_id": span.parent_id, "seconds": round(span.duration, 6), "status_code": span.status_code}
+                    for span in sorted(self.spans, key=lambda span: span.start_ns)
+                ],
+            }
+            with open(f"{base_path}.json", 'w') as summary_file:
+                json.dump(summary, summary_file, indent=2)
+        except Exception as e:
+            logger.error('Request profile save failed', extra={'profile_id': self.id, 'error': str(e)})
+
+
+def collect_span(finished_span):
+    profile = active_profiles.get(finished_span.trace_id)
+    if profile is not None:
+        profile.spans.append(finished_span)
+
+
+class ProfilingMiddleware:
+    """Profiles the requests picked by `get_profile_reason`; every other request only pays for that check"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILE_TOKEN and not settings.PROFILE_SAMPLE_RATE:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+        if collect_span not in tracing.span_listeners:
+            tracing.span_listeners.append(collect_span)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        reason = self.get_profile_reason(request)
+        if not reason:
+            return self.get_response(request)
+
+        profile = RequestProfile(request, reason, {threading.get_ident()}, settings.PROFILE_INTERVAL)
+        token = tracing.recording.set(True)
+        try:
+            with tracing.span('profiled_request') as profile_span:
+                self.start_profile(request, profile, profile_span)
+                try:
+                    response = self.get_response(request)
+                finally:
+                    self.stop_profile(profile)
+        finally:
+            tracing.recording.reset(token)
+        return self.finish_profile(profile, response)
+
+    async def __acall__(self, request):
+        reason = self.get_profile_reason(request)
+        if not reason:
+            return await self.get_response(request)
+
+        profile = RequestProfile(request, reason, None, settings.PROFILE_INTERVAL)
+        token = tracing.recording.set(True)
+        try:
+            with tracing.span('profiled_request') as profile_span:
+                self.start_profile(request, profile, profile_span)
+                try:
+                    response = await self.get_response(request)
+                finally:
+                    self.stop_profile(profile)
+        finally:
+            tracing.recording.reset(token)
+        return self.finish_profile(profile, response)
+
+    @staticmethod
+    def get_profile_reason(request):
+        profile_token = request.META.get(PROFILE_TOKEN_HEADER)
+        if profile_token and settings.PROFILE_TOKEN and hmac.compare_digest(profile_token.encode(), settings.PROFILE_TOKEN.encode()):
+            return 'token'
+        if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            return 'sampled'
+        return None
+
+    @staticmethod
+    def start_profile(request, profile, profile_span):
+        profile.trace_id = profile_span.trace_id
+        with active_profiles_lock:
+            active_profiles[profile.trace_id] = profile
+        request.profile = profile
+        profile.profiler.start()
+
+    @staticmethod
+    def stop_profile(profile):
+        profile.profiler.stop()
+        profile.seconds = time.perf_counter() - profile.start
+        with active_profiles_lock:
+            active_profiles.pop(profile.trace_id, None)
+
+    @staticmethod
+    def finish_profile(profile, response):
+        # Written in the background, the response doesn't wait for the disk
+        threading.Thread(target=profile.save, args=(response.status_code,), name='request-profile-save', daemon=True).start()
+        response['X-Profile-Id'] = profile.id
+        return response
+
+    def process_template_response(self, request, response):
+        """DRF responses are rendered after the view returns, that rendering is the serialization time"""
+        profile = getattr(request, 'profile', None)
+        if profile is None:
+            return response
+
+        serialization_span = tracing.start_detached_span('serialization')
+        response.add_post_render_callback(lambda rendered_response: tracing.end_span(serialization_span))
+        return response
@@ -0,0 +1,101 @@
+# Other
+import os
+import json
+import hashlib
+import threading
+from cachetools import LRUCache
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+SYSTEM_PROMPT_FILE = os.path.join(current_directory, "system_prompt/system_prompt.json")
+SYSTEM_PROMPT_CACHE_SIZE = int(os.environ.get('SYSTEM_PROMPT_CACHE_SIZE', 256))
+
+# Global variables
+static_prompts = None
+compiled_prompts = LRUCache(maxsize=SYSTEM_PROMPT_CACHE_SIZE)
+prompt_lock = threading.Lock()
+
+
+def load_static_prompts():
+    """Provider recommendation and patient instruction prompts, read from disk once per process"""
+    global static_prompts
+    if static_prompts is None:
+        prompts = []
+        if os.path.isfile(SYSTEM_PROMPT_FILE):
+            with open(SYSTEM_PROMPT_FILE, 'r') as file:
+                prompts = json.load(file)
+        static_prompts = prompts
+    return list(static_prompts)
+
+
+def get_sections_key(system_prompt_list):
+    """Hash of the (title, body_text) pairs in their given order"""
+    sections = [[data.get("title", ""), data.get("body_text", "")] for data in system_prompt_list]
+    return hashlib.sha256(json.dumps(sections, ensure_ascii=False).encode()).hexdigest()
+
+
+def build_scribe_system_prompt(system_prompt_list):
+    """System prompt for generate_scribe_simple_response, memoized per section list.
+
+    Sections keep the order they are given in (visit type sections, then the static
+    prompts), so the same visit type always produces a byte-identical prompt and
+    shares the upstream prompt-prefix cache.
+    """
+    sections_key = get_sections_key(system_prompt_list)
+    with prompt_lock:
+        system_prompt = compiled_prompts.get(sections_key)
+    if system_prompt is not None:
+        return system_prompt
+
+    system_prompt = compile_scribe_system_prompt(system_prompt_list)
+    with prompt_lock:
+        compiled_prompts[sections_key] = system_prompt
+    return system_prompt
+
+
+def compile_scribe_system_prompt(system_prompt_list):
+    # Sections string
+    system_titles = [item["title"] for item in system_prompt_list]
+    title_result_string = ', '.join([f"`'{title}'`" for title in system_titles[:-1]]) + f" and `'{system_titles[-1]}'`"
+    total_sections = len(system_titles)
+    if total_sections == 1:
+        title_result_string = f"`'{system_titles[0]}'`"
+
+    # Sections definitions string in prompt
+    prompt_parts = ['### Section Definitions:\n']
+    for index, data in enumerate(system_prompt_list, start=1):
+        title = data.get("title", "").lower().replace(" ", "_")
+        body_text = data.get("body_text", "")
+        result_string = f"\n    \"{title}\": \"{body_text}\""
+
+        if total_sections == 1:
+            prompt_parts.append('```json\n{' + result_string + '\n}\n```')
+
+        elif index == 1:
+            prompt_parts.append('```json\n{' + result_string + ',')
+
+        elif index == total_sections:
+            prompt_parts.append(result_string + '\n}\n```')
+
+        else:
+            prompt_parts.append(f'{result_string},')
+    system_prompt_string = ''.join(prompt_parts)
+
+    return f"### Task:\nYou will be provided with a CONVERSATION between the healthcare provider and the patient.\nBased on the conversation provide a detailed, comprehensive, and informative response for the sections {title_result_string}.  keeping in mind the definitions and you must have to generate responses for all the {total_sections} sections.\n\n{system_prompt_string}\n\n## Note:\n\tYou have to Extract as much as Possible Details from the CONVERSATION and Provide it in Particular section Using Layperson terms. If you are unable to find the necessary information for Any of the {total_sections} Sections, please WRITE `'UNABLE TO FIND THESE DETAILS'` INSTEAD,\n\n# Response Format:\n\tWrite Your Response in JSON Format (object with the following keys (Section name) and values). as Encodeded JSON String."
+
+
+def build_fact_extraction_prompt(system_prompt_list):
+    """System prompt for the map step over long transcripts, identical for every part so it shares the prompt-prefix cache"""
+    sections_key = 'facts:' + get_sections_key(system_prompt_list)
+    with prompt_lock:
+        system_prompt = compiled_prompts.get(sections_key)
+    if system_prompt is not None:
+        return system_prompt
+
+    section_definitions = '\n'.join(
+        f"    \"{data.get('title', '').lower().replace(' ', '_')}\": \"{data.get('body_text', '')}\""
+        for data in system_prompt_list
+    )
+    system_prompt = f"### Task:\nYou will be provided with one part of a long CONVERSATION between the healthcare provider and the patient.\nExtract every detail from this part that belongs to any of the sections below as short factual notes. Do not summarize away details, other parts of the conversation are processed separately.\n\n### Section Definitions:\n```json\n{{\n{section_definitions}\n}}\n```\n\n## Note:\n\tIf this part has nothing for a section, use an empty string for it.\n\n# Response Format:\n\tWrite Your Response in JSON Format (object with the section names above as keys and the notes as string values)."
+    with prompt_lock:
+        compiled_prompts[sections_key] = system_prompt
+    return system_prompt
@@ -1,13 +1,28 @@
 import os
+import uuid
 import stripe
 import logging
 from dotenv import load_dotenv
 
+# Shared connection pools
+from azure_api_app.http_client import get_stripe_http_client, get_async_client
+
+# Concurrency, rate limit and retries shared with the other upstreams
+from azure_api_app.upstream_limiter import async_request_with_retries
+
+# Tracing
+from azure_api_app.tracing import trace_methods
+
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+# Every stripe SDK call goes through the pooled keep-alive session (STRIPE_API_BASE can point at a local stub server)
+stripe.default_http_client = get_stripe_http_client()
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)
 
+
+@trace_methods
 class StripeOperation:
 
     def __init__(self):
@@ -15,8 +30,10 @@ class StripeOperation:
         stripe.api_key = STRIPE_API_KEY
 
 
-    def get_customer_data(self, customer_id):
-        data = stripe.Customer.retrieve(customer_id)
+    def get_customer_data(self, customer_id, expand_payment_method=False):
+        # Expanding returns the default payment method object in the same round trip
+        expand = ['invoice_settings.default_payment_method'] if expand_payment_method else []
+        data = stripe.Customer.retrieve(customer_id, expand=expand)
         return data if data else {}
     
 
@@ -25,21 +42,13 @@ class StripeOperation:
         return data if data else {}
     
 
-    def retrieve_payment_method_data(self, payment_method_id):
-        payment_method_data = stripe.PaymentMethod.retrieve(payment_method_id)
-        s_payment_method_id = payment_method_data.get('id', None) 
-        if s_payment_method_id == payment_method_id:
-            return payment_method_data
-        return {}
-    
-
     def get_payment_method_data(self, customer_id):
-        customer_data = self.get_customer_data(customer_id)
+        # The default payment method comes expanded with the customer, the list is only fetched when there is none
+        customer_data = self.get_customer_data(customer_id, True)
 
         default_payment_method = customer_data.get('invoice_settings', {}).get('default_payment_method', '')
         if default_payment_method:
-            payment_method_data = self.retrieve_payment_method_data(default_payment_method)
-            payment_method_list = [payment_method_data]
+            payment_method_list = [default_payment_method]
         else:
             payment_method_data = self.get_payment_methods(customer_id)
             payment_method_list = payment_method_data.get("data", [])
@@ -47,7 +56,8 @@ class StripeOperation:
         return payment_method_list
 
 
-    def auto_payment(self, amount, customer_id):
+    def auto_payment(self, amount, customer_id, idempotency_key=None):
+        """Charge `amount` to the customer's default card; retries with the same idempotency key never charge twice"""
         payment_method_data_list = self.get_payment_method_data(customer_id)
         payment_method_dict = payment_method_data_list[0] if payment_method_data_list else {}
         payment_method_id = payment_method_dict.get('id', None)
@@ -65,7 +75,8 @@ class StripeOperation:
             automatic_payment_methods={
                     'enabled': True,
                     'allow_redirects': 'never'
-                } 
+                },
+            idempotency_key=idempotency_key,
             )
         
         if payment_intent.status == 'succeeded':
@@ -95,4 +106,91 @@ class StripeOperation:
     @staticmethod
     def cancel_subscription(subscription_id):
         response = stripe.Subscription.cancel(subscription_id)
-        return response if response else {}
\ No newline at end of file
+        return response if response else {}
+
+
+def encode_stripe_params(params, prefix=None):
+    """Flatten nested params into Stripe's form encoding, e.g. line_items[0][price]"""
+    encoded = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            encoded.extend(encode_stripe_params(value, name))
+        elif isinstance(value, bool):
+            encoded.append((name, 'true' if value else 'false'))
+        elif value is not None:
+            encoded.append((name, str(value)))
+    return encoded
+
+
+@trace_methods(exclude=('request',))
+class AsyncStripeOperation:
+    """Non-blocking twin of StripeOperation for the async views, calls the Stripe REST API with httpx
+
+    Requests go through the 'stripe' upstream limiter and are resent on 429/5xx and failed connects.
+    A POST keeps one Idempotency-Key across its retries, so a resent create never makes a second session.
+    """
+
+    def __init__(self):
+        STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY')
+        self.headers = {
+            'Authorization': f'Bearer {STRIPE_API_KEY}',
+            'Stripe-Version': stripe.api_version,
+        }
+        self.base_url = f"{stripe.api_base}/v1"
+        self.client = get_async_client('stripe')
+
+
+    async def request(self, method, path, params=None):
+        encoded_params = encode_stripe_params(params or {})
+        # One key for every attempt of this request
+        headers = {**self.headers, 'Idempotency-Key': str(uuid.uuid4())} if method == 'POST' else self.headers
+
+        def send():
+            if method == 'POST':
+                # httpx only form-encodes a dict, the flattened keys are unique
+                return self.client.request(method, f"{self.base_url}{path}", headers=headers, data=dict(encoded_params))
+            return self.client.request(method, f"{self.base_url}{path}", headers=headers, params=encoded_params)
+
+        response = await async_request_with_retries('stripe', send)
+
+        response_data = response.json()
+        if response.status_code != 200:
+            error = response_data.get('error', {})
+            raise stripe.error.StripeError(error.get('message', 'Stripe request failed'), http_status=response.status_code)
+        return response_data
+
+
+    async def get_customer_data(self, customer_id, expand_payment_method=False):
+        params = {'expand': ['invoice_settings.default_payment_method']} if expand_payment_method else {}
+        data = await self.request('GET', f"/customers/{customer_id}", params)
+        return data if data else {}
+
+
+    async def get_payment_methods(self, customer_id):
+        data = await self.request('GET', f"/customers/{customer_id}/payment_methods")
+        return data if data else {}
+
+
+    async def get_billing_portal_session(self, customer_id):
+        data = await self.request('POST', "/billing_portal/sessions", {'customer': customer_id})
+        return data if data else {}
+
+
+    async def checkout_session(self, customer_id, price_id):
+        data = await self.request('POST', "/checkout/sessions", {
+            'customer': customer_id,
+            'line_items': [{"price": price_id, "quantity": 1}],
+            'mode': "subscription",
+            'currency': "usd",
+            'allow_promotion_codes': True,
+            'success_url': "https://app.scribegenie.io/success",
+            'cancel_url': "https://app.scribegenie.io/cancel",
+        })
+        return data if data else {}
+
+
+    async def cancel_subscription(self, subscription_id):
+        response = await self.request('DELETE', f"/subscriptions/{subscription_id}")
+        return response if response else {}
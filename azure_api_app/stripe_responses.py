@@ -0,0 +1,62 @@
+"""Validation and response shaping shared by the Stripe views of views.py and async_views.py.
+
+The helpers return the keyword arguments of the response, so the DRF views
+answer with `Response(**...)` and the async views with `JsonResponse(**...)`.
+"""
+# From rest_framework
+from rest_framework import status
+
+CUSTOMER_ID_NOT_FOUND = "Stripe customer id not found ..!"
+PRICE_ID_NOT_FOUND = "Price id not found..!"
+SUBSCRIPTION_ID_NOT_FOUND = "Subscription id not found..!"
+SUBSCRIPTION_NOT_FOUND = "User has not subscription with this id..!"
+
+
+def error_response(message, **extra):
+    return {'data': {'status': 'error', 'message': message, **extra}, 'status': status.HTTP_400_BAD_REQUEST}
+
+
+def success_response(data):
+    return {'data': data, 'status': status.HTTP_200_OK}
+
+
+def get_required_value(request_data, key):
+    """Stripped string value of a required body field, '' when missing"""
+    return str(request_data.get(key, '')).strip()
+
+
+def get_customer_data_response(customer_data):
+    """Customer data with the expanded default payment method moved next to it, the customer keeps only its id"""
+    if not customer_data:
+        return error_response("Stripe customer data not found ..!")
+
+    response_data = {'customer_data': customer_data}
+    default_payment_method = (customer_data.get('invoice_settings') or {}).get('default_payment_method', '')
+    if default_payment_method:
+        customer_data['invoice_settings']['default_payment_method'] = default_payment_method.get('id')
+        response_data.update({'default_payment_method': default_payment_method})
+    return success_response(response_data)
+
+
+def get_payment_methods_response(payment_method_data):
+    if not payment_method_data:
+        return error_response("Stripe customer payment methods not found ..!")
+    return success_response(payment_method_data)
+
+
+def get_billing_portal_session_response(billing_portal_session_data):
+    if not billing_portal_session_data:
+        return error_response("Stripe billing portal session not created ..!")
+    return success_response(billing_portal_session_data)
+
+
+def get_checkout_session_response(checkout_session_data):
+    if not checkout_session_data:
+        return error_response("Checkout session data not found ..!")
+    return success_response(checkout_session_data)
+
+
+def get_cancel_subscription_response(cancel_subscription_data):
+    if cancel_subscription_data and cancel_subscription_data['status'] == 'canceled':
+        return success_response({'status': 'success', 'message': 'Subscription successfully canceled..!', 'data': cancel_subscription_data})
+    return error_response("Something went wrong..! Can't able to cancel subscription..!", data=cancel_subscription_data)
@@ -1,49 +1,65 @@
 # From utils
-from utils import handle_exceptions
+from azure_api_app.utils import handle_exceptions
 
 # From assemblyai_operation
-from assemblyai_operation import AssemblyAIOperation
+from azure_api_app.assemblyai_operation import AssemblyAIOperation
 
 # From whisperai_operation
-from whisperai_operation import WhisperAIOperation
+from azure_api_app.whisperai_operation import WhisperAIOperation
 
 # From openai_operation
-from openai_operation import OpenAIOperation
+from azure_api_app.openai_operation import OpenAIOperation
 
 # Firebase Authorization
-from firebase_operation import FirebaseOperations
+from azure_api_app.firebase_operation import FirebaseOperations
 
-# From stripe operations
-from stripe_operation import StripeOperation
+# System prompt builder
+from azure_api_app.prompt_builder import load_static_prompts
+
+# Stage timers and counters
+from azure_api_app import metrics
+
+# Tracing
+from azure_api_app.tracing import trace_methods
+
+# Transcript cache
+from azure_api_app.transcript_cache import get_cache_key, get_cached_transcript, cache_transcript
+
+# Job store
+from azure_api_app import job_store
+from azure_api_app.models import ScribeJob
+
+# From django
+from django.conf import settings
 
 # Other
 import os
-import sys
-import time
-import json
 import logging
 import datetime
-from pathlib import Path
-
 
-# Configure the logging settings
-BASE_DIR = Path(__file__).resolve().parent.parent
+# Logging is configured by settings.LOGGING, also in the job worker processes
 logger = logging.getLogger(__name__)
-log_file_path = f"{BASE_DIR}/error.log"  
-
-logging.basicConfig(
-    filename=log_file_path,
-    level=logging.ERROR,  
-)
 
 
+# perform_operation runs inside the job's span, only the pipeline stages get their own
+@trace_methods(exclude=(
+    'perform_operation', 'update_job_stage', 'generate_default_clinical_data_for_firebase',
+    'get_webhook_url', 'estimate_audio_duration', 'touch_job', 'delete_temp_file', 'sequences', 'can_fall_back_to_whisper_ai',
+))
 class TranscriptGPTOperation:
 
-    def __init__(self, file_path, patient_name, user_id, visit_type):
+    def __init__(self, file_path, patient_name, user_id, visit_type, job_id=None, transcript_id='', upload_url='', visit_sections=None, audio_sha256='', audio_size=0):
         self.file_path = file_path
         self.patient_name = patient_name
         self.user_id = user_id
         self.visit_type = visit_type
+        self.job_id = job_id
+        self.transcript_id = transcript_id
+        self.upload_url = upload_url
+        self.visit_sections = visit_sections
+        self.audio_sha256 = audio_sha256
+        self.audio_size = audio_size
+        self.is_transcript_pending = False
 
         self.transcription_data = ''
         self.clinical_note = []
@@ -71,35 +87,58 @@ class TranscriptGPTOperation:
     def perform_operation(self):
         self.generate_default_clinical_data_for_firebase()
 
+        self.update_job_stage(ScribeJob.STAGE_TRANSCRIBING)
         is_transcript_generated = self.generate_transcript()
+        if is_transcript_generated and self.is_transcript_pending:
+            # Assembly AI webhook resumes the job once the transcript is ready
+            return True
+
         if not is_transcript_generated:
+            self.update_job_stage(ScribeJob.STAGE_PERSISTING)
             self.firebase_operation()
+            self.update_job_stage(ScribeJob.STAGE_FAILED, error='Transcript not generated')
             return True
 
+        self.update_job_stage(ScribeJob.STAGE_GENERATING)
         is_response_generated = self.generate_transcript_gpt_response()
         if not is_response_generated:
+            self.update_job_stage(ScribeJob.STAGE_PERSISTING)
             self.firebase_operation()
+            self.update_job_stage(ScribeJob.STAGE_FAILED, error='GPT response not generated')
             return True
         
         self.data_to_update_in_db['is_succeed'] = True
+        self.update_job_stage(ScribeJob.STAGE_PERSISTING)
         fb_operation = self.firebase_operation()
+        if fb_operation:
+            self.update_job_stage(ScribeJob.STAGE_BILLED)
+        else:
+            self.update_job_stage(ScribeJob.STAGE_FAILED, error='History or balance not updated')
         return fb_operation
 
 
+    @handle_exceptions(is_status=True)
+    def update_job_stage(self, stage, **fields):
+        """Record progress in the job store (no-op when run without a job)"""
+        if stage in ScribeJob.FINISHED_STAGES:
+            metrics.increment('scribe_jobs_total', stage=stage)
+
+        if not self.job_id:
+            return False
+
+        job_store.update_job_stage(self.job_id, stage, **fields)
+        return True
+
+
     def generate_default_clinical_data_for_firebase(self):
         # Retrieve default system prompt information for provider recommandations and patient instructions
-        pr_pi_prompts_data_list = []
-        current_directory = os.path.dirname(os.path.realpath(__file__))
-        system_prompt_file = os.path.join(current_directory, "system_prompt/system_prompt.json")
-        if os.path.isfile(system_prompt_file):
-            with open(system_prompt_file, 'r') as file:
-                pr_pi_prompts_data_list = json.load(file)
-
-        # Retrieve visit type data from firebase
-        fb_operation_obj = FirebaseOperations()
-        visit_type_document = fb_operation_obj.get_visit_type(self.visit_type, self.user_id)
-        visit_type_data = visit_type_document.to_dict() if visit_type_document else {}
-        visit_type_section_data_list = visit_type_data.get('sections', [])
+        pr_pi_prompts_data_list = load_static_prompts()
+
+        # Visit type sections are resolved by the view, retrieve them from firebase only if the job has none
+        visit_type_section_data_list = self.visit_sections
+        if visit_type_section_data_list is None:
+            fb_operation_obj = FirebaseOperations()
+            visit_type_section_data_list = fb_operation_obj.get_visit_type_sections(self.visit_type, self.user_id) or []
         
         self.system_prompt_data = visit_type_section_data_list + pr_pi_prompts_data_list
 
@@ -135,13 +174,13 @@ class TranscriptGPTOperation:
 
     @handle_exceptions(is_status=True)
     def generate_transcript_using_whisper_ai(self):
-        """Perform Audio To Text Translation using whisper AI"""
+        """Perform Audio To Text Translation using whisper AI, the fallback when Assembly AI fails"""
 
         # Create Whisper AI object
         assembly_object = WhisperAIOperation()
 
-        # Generate transcript
-        transcript_data = assembly_object.generate_transcription(self.file_path)
+        # Generate transcript (long recordings are split and transcribed in parallel)
+        transcript_data = assembly_object.generate_chunked_transcription(self.file_path)
          
         # Delete temporary file after completing all operations
         self.delete_temp_file(self.file_path)
@@ -154,55 +193,110 @@ class TranscriptGPTOperation:
         self.transcription_data = formatted_transcript_data
         return True
 
-    @handle_exceptions(is_status=True)
+    @metrics.timed_stage('generate_transcript')
     def generate_transcript(self):
-        """Perform Audio To Text Translation"""
+        """Perform Audio To Text Translation, with Whisper AI when Assembly AI fails and SCRIBE_WHISPER_FALLBACK is on"""
+        is_transcript_generated = self.generate_transcript_using_assembly_ai()
+        if is_transcript_generated or not self.can_fall_back_to_whisper_ai():
+            return is_transcript_generated
+
+        logger.error('Assembly AI transcript failed, falling back to Whisper AI', extra={'job_id': str(self.job_id)})
+        metrics.increment('scribe_fallbacks_total', kind='whisper_after_assembly_ai')
+        return self.generate_transcript_using_whisper_ai()
 
+
+    def can_fall_back_to_whisper_ai(self):
+        return settings.SCRIBE_WHISPER_FALLBACK and bool(self.file_path) and os.path.exists(self.file_path)
+
+
+    @handle_exceptions(is_status=True)
+    def generate_transcript_using_assembly_ai(self):
         # Create Assembly AI object
         assembly_object = AssemblyAIOperation()
 
-        # Upload file using Assembly
-        upload_response = assembly_object.upload_file(self.file_path)
-        if not upload_response:
-            return False
-        upload_url = upload_response.get("upload_url", '')
-        
-        # Transcript file uploaded
-        transcribe_response = assembly_object.transcribe_file(upload_url)
-        if not transcribe_response:
-            return False
-        
-        # Delete temporary file after completing all operations
-        self.delete_temp_file(self.file_path)
+        # The same recording was transcribed before (e.g. re-uploaded after a network error)
+        cache_key = get_cache_key(self.audio_sha256, AssemblyAIOperation.TRANSCRIPTION_SETTINGS) if self.audio_sha256 else None
+        cached_transcript = get_cached_transcript(cache_key) if cache_key else None
+        if cache_key:
+            metrics.increment('transcript_cache_requests_total', result='hit' if cached_transcript else 'miss')
+        if cached_transcript:
+            if self.file_path:
+                self.delete_temp_file(self.file_path)
+            self.audio_duration = cached_transcript.get("audio_duration", 0)
+            self.transcription_data = cached_transcript.get("transcription", '')
+            return True
 
-        # Get transcript id
-        transcript_id = transcribe_response.get('id', None)
+        # A resumed job already has a transcript at Assembly AI, only polling is left
+        transcript_id = self.transcript_id
+        audio_duration = self.estimate_audio_duration(self.audio_size)
         if not transcript_id:
-            return False
+            # Upload file using Assembly, unless the view already streamed it there
+            upload_url = self.upload_url
+            if not upload_url:
+                upload_response = assembly_object.upload_file(self.file_path)
+                if not upload_response:
+                    return False
+                upload_url = upload_response.get("upload_url", '')
+            
+            # Transcript file uploaded
+            webhook_url = self.get_webhook_url()
+            transcribe_response = assembly_object.transcribe_file(upload_url, webhook_url=webhook_url, webhook_secret=settings.ASSEMBLY_AI_WEBHOOK_SECRET)
+            if not transcribe_response:
+                return False
+            
+            # Delete temporary file after completing all operations, the Whisper AI fallback needs it until the transcript is done
+            if self.file_path and not settings.SCRIBE_WHISPER_FALLBACK:
+                self.delete_temp_file(self.file_path)
+
+            # Get transcript id
+            transcript_id = transcribe_response.get('id', None)
+            if not transcript_id:
+                return False
+
+            self.transcript_id = transcript_id
+            self.update_job_stage(ScribeJob.STAGE_TRANSCRIBING, transcript_id=transcript_id)
+
+            # Free the worker, the webhook view resubmits the job when Assembly AI is done
+            if webhook_url:
+                self.is_transcript_pending = True
+                return True
         
         # Get polling data
-        while (True):
-            transcription_result = assembly_object.polling_transcript(transcript_id)
-            transcription_status = transcription_result.get('status', None)
+        transcription_result = assembly_object.wait_for_transcript(transcript_id, audio_duration, on_poll=self.touch_job)
+        transcription_status = transcription_result.get('status', None)
 
-            if not transcription_status:
-                return False
+        if transcription_status != 'completed':
+            logger.error('Transcription failed', extra={'job_id': str(self.job_id), 'transcript_id': transcript_id, 'error': transcription_result.get('error', '')})
+            return False
 
-            if transcription_status == 'completed':
-                self.audio_duration = transcription_result.get("audio_duration", 0)
-                utterances = self.sequences(transcription_result.get('utterances', []))
-                self.transcription_data = utterances or transcription_result.get('text', '')
-                break
+        self.audio_duration = transcription_result.get("audio_duration", 0)
+        utterances = self.sequences(transcription_result.get('utterances', []))
+        self.transcription_data = utterances or transcription_result.get('text', '')
 
-            elif transcription_status == 'error':
-                message = f"Transcription failed: {transcription_result['error']}"
-                return False
+        # Kept for the Whisper AI fallback until now
+        if self.file_path and os.path.exists(self.file_path):
+            self.delete_temp_file(self.file_path)
 
-            else:
-                time.sleep(2)
+        if cache_key and self.transcription_data:
+            cache_transcript(cache_key, {"transcription": self.transcription_data, "audio_duration": self.audio_duration})
         return True
 
 
+    def get_webhook_url(self):
+        """Completion webhook for this job, None when webhooks are not configured"""
+        # Without a secret anyone knowing the ids could resume the job, so it is polled instead
+        if not settings.ASSEMBLY_AI_WEBHOOK_URL or not settings.ASSEMBLY_AI_WEBHOOK_SECRET or not self.job_id:
+            return None
+        return f"{settings.ASSEMBLY_AI_WEBHOOK_URL}?job_id={self.job_id}"
+
+
+    @staticmethod
+    def estimate_audio_duration(audio_size, bitrate=128000):
+        """Rough duration in seconds from the audio's byte count, used to pace transcript polling"""
+        return audio_size * 8 / bitrate
+
+
+    @metrics.timed_stage('generate_transcript_gpt_response')
     @handle_exceptions(is_status=True)
     def generate_transcript_gpt_response(self):
         """Generate user_prompt for all system prompts like Subjective, Objective etc"""
@@ -219,6 +313,7 @@ class TranscriptGPTOperation:
         return True
 
 
+    @metrics.timed_stage('firebase_operation')
     @handle_exceptions(is_status=True)
     def firebase_operation(self):
         """Add document in firebase"""
@@ -243,18 +338,27 @@ class TranscriptGPTOperation:
         self.data_to_update_in_db['audio_duration'] = self.audio_duration
 
         fb_operation_obj = FirebaseOperations()
+
+        # Billed jobs write the history and the balance change in one transaction
+        if self.transcription_data and self.gpt_response_generated:
+            is_managed = fb_operation_obj.manage_user_balance(self.data_to_update_in_db, self.user_id)
+            return is_managed
+
         fb_status = fb_operation_obj.create_user_history(self.data_to_update_in_db, self.user_id)
         if not fb_status:
             return False
-        
-        if self.transcription_data and self.gpt_response_generated:
-            stripe_obj = StripeOperation()
-            is_managed = fb_operation_obj.manage_user_balance(self.data_to_update_in_db, self.user_id, stripe_obj)
-            return is_managed
 
         return True
 
 
+    @handle_exceptions(is_status=True)
+    def touch_job(self):
+        """Mark the job as still alive so recovery leaves it alone"""
+        if self.job_id:
+            job_store.touch_job(self.job_id)
+        return True
+
+
     @handle_exceptions(is_status=True)
     def delete_temp_file(self, file_path):
         os.remove(file_path)
@@ -271,21 +375,3 @@ class TranscriptGPTOperation:
             return transcript
         except:
             return []
-
-
-def main():
-    arguments = sys.argv[1].split(',')
-    audio_file_path = arguments[0]
-    patient_name = arguments[1]
-    user_id = arguments[2]
-    visit_type = arguments[3]
-
-    # Create an instance of TranscriptGPTTask
-    transcript_gpt_task = TranscriptGPTOperation(audio_file_path, patient_name, user_id, visit_type)
-
-    # Perform the operation
-    transcript_gpt_task.perform_operation()
-
-
-if __name__ == "__main__":
-   main()
\ No newline at end of file
@@ -1,3 +1,981 @@
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+# From models
+from azure_api_app.models import ScribeJob
+
+# From utils
+from azure_api_app import job_store
+from azure_api_app.firebase_operation import FirebaseOperations
+from azure_api_app.firebase_auth import FirebaseUser
+from azure_api_app.job_executor import recover_unfinished_jobs, run_scribe_job, try_lock_top_up_worker
+from azure_api_app.openai_operation import OpenAIOperation, AsyncOpenAIOperation
+from azure_api_app import prompt_builder
+from azure_api_app import completion_cache
+from azure_api_app import transcript_cache
+from azure_api_app import tracing
+from azure_api_app.profiling import ProfilingMiddleware
+from azure_api_app.task import TranscriptGPTOperation
+from azure_api_app.views import AssemblyAIWebhook, FineTuneModelOperation, Metrics
+from azure_api_app import metrics
+from azure_api_app.stripe_operation import AsyncStripeOperation
+from azure_api_app.stripe_responses import get_customer_data_response, get_cancel_subscription_response
+from azure_api_app.token_counter import count_tokens, split_transcript
+from azure_api_app.upstream_limiter import UpstreamBusy, UpstreamLimiter, get_retry_after, get_retry_delay, request_with_retries
+from azure_api_app.whisperai_operation import WhisperAIOperation
+
+# Other
+import os
+import json
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import httpx
+import requests
+from datetime import timedelta
+from email.utils import formatdate
+from unittest import mock
+from cachetools import TTLCache
+from google.cloud.firestore_v1 import Increment
+from requests.structures import CaseInsensitiveDict
+from http.client import RemoteDisconnected
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+LEASE_SECONDS = 120
+
+
+def create_test_job():
+    return job_store.create_job('user-1', 'Patient', 'consult', upload_url='https://cdn.example.com/audio')
+
+
+class ScribeJobLeaseTests(TestCase):
+
+    def test_running_job_cannot_be_claimed_twice(self):
+        job = create_test_job()
+
+        first_claim = job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        second_claim = job_store.claim_job(job.id, 'worker-2', LEASE_SECONDS)
+
+        self.assertIsNotNone(first_claim)
+        self.assertIsNone(second_claim)
+        job.refresh_from_db()
+        self.assertEqual(job.worker, 'worker-1')
+        self.assertEqual(job.attempts, 1)
+
+    def test_expired_lease_can_be_claimed(self):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        ScribeJob.objects.filter(pk=job.id).update(claimed_until=timezone.now() - timedelta(seconds=1))
+
+        claimed_job = job_store.claim_job(job.id, 'worker-2', LEASE_SECONDS)
+
+        self.assertIsNotNone(claimed_job)
+        self.assertEqual(claimed_job.worker, 'worker-2')
+        self.assertEqual(claimed_job.attempts, 2)
+
+    def test_queued_lease_is_only_handed_to_its_worker(self):
+        job = create_test_job()
+        self.assertTrue(job_store.lease_job(job.id, 'queue-1', LEASE_SECONDS))
+        self.assertFalse(job_store.lease_job(job.id, 'queue-2', LEASE_SECONDS))
+
+        self.assertIsNone(job_store.claim_job(job.id, 'worker-2', LEASE_SECONDS, 'queue-2'))
+        self.assertIsNotNone(job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS, 'queue-1'))
+
+    def test_webhook_resume_does_not_start_an_attempt(self):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        job_store.hand_job_to_webhook(job.id, 'worker-1', 3600)
+
+        self.assertFalse(job_store.lease_job(job.id, 'queue-2', LEASE_SECONDS))
+        self.assertTrue(job_store.lease_job(job.id, 'queue-2', LEASE_SECONDS, job_store.WEBHOOK_LEASE_OWNER))
+        resumed_job = job_store.claim_job(job.id, 'worker-2', LEASE_SECONDS, 'queue-2', is_resume=True)
+
+        self.assertIsNotNone(resumed_job)
+        self.assertEqual(resumed_job.attempts, 1)
+
+    def test_released_job_cannot_be_renewed_by_old_owner(self):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        job_store.release_job(job.id, 'worker-1')
+
+        self.assertFalse(job_store.renew_job_lease(job.id, 'worker-1', LEASE_SECONDS))
+
+
+@mock.patch('azure_api_app.job_executor.get_job_executor')
+class RecoverUnfinishedJobsTests(TestCase):
+
+    def test_running_job_is_not_recovered(self, get_job_executor):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        # No stage update for a long time, e.g. a long transcription, but the lease is still being renewed
+        ScribeJob.objects.filter(pk=job.id).update(updated_at=timezone.now() - timedelta(days=1))
+
+        recover_unfinished_jobs()
+
+        get_job_executor.return_value.submit.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.worker, 'worker-1')
+
+    def test_job_with_expired_lease_is_recovered(self, get_job_executor):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        ScribeJob.objects.filter(pk=job.id).update(claimed_until=timezone.now() - timedelta(seconds=1))
+
+        recover_unfinished_jobs()
+
+        get_job_executor.return_value.submit.assert_called_once()
+        job.refresh_from_db()
+        self.assertNotEqual(job.worker, 'worker-1')
+        self.assertGreater(job.claimed_until, timezone.now())
+
+    def test_job_waiting_for_webhook_is_not_recovered(self, get_job_executor):
+        job = create_test_job()
+        job_store.claim_job(job.id, 'worker-1', LEASE_SECONDS)
+        job_store.hand_job_to_webhook(job.id, 'worker-1', 3600)
+        ScribeJob.objects.filter(pk=job.id).update(updated_at=timezone.now() - timedelta(days=1))
+
+        recover_unfinished_jobs()
+
+        get_job_executor.return_value.submit.assert_not_called()
+
+    def test_job_is_recovered_once(self, get_job_executor):
+        job = create_test_job()
+        ScribeJob.objects.filter(pk=job.id).update(updated_at=timezone.now() - timedelta(days=1))
+
+        recover_unfinished_jobs()
+        recover_unfinished_jobs()
+
+        get_job_executor.return_value.submit.assert_called_once()
+
+
+@override_settings(ASSEMBLY_AI_WEBHOOK_URL='https://scribe.example.com/assemblyai/webhook/')
+class AssemblyAIWebhookTests(TestCase):
+
+    def test_no_webhook_is_registered_without_secret(self):
+        task = TranscriptGPTOperation('', 'Patient', 'user-1', 'consult', job_id='job-1')
+
+        with override_settings(ASSEMBLY_AI_WEBHOOK_SECRET=''):
+            self.assertIsNone(task.get_webhook_url())
+        with override_settings(ASSEMBLY_AI_WEBHOOK_SECRET='secret'):
+            self.assertEqual(task.get_webhook_url(), 'https://scribe.example.com/assemblyai/webhook/?job_id=job-1')
+
+    @mock.patch('azure_api_app.views.submit_scribe_job')
+    def test_webhook_is_refused_without_secret(self, submit_scribe_job):
+        job = create_test_job()
+        job_store.update_job_stage(job.id, ScribeJob.STAGE_TRANSCRIBING, transcript_id='transcript-1')
+        request = APIRequestFactory().post(f'/assemblyai/webhook/?job_id={job.id}', {'transcript_id': 'transcript-1', 'status': 'completed'}, format='json')
+
+        with override_settings(ASSEMBLY_AI_WEBHOOK_SECRET=''):
+            response = AssemblyAIWebhook.as_view()(request)
+
+        self.assertEqual(response.status_code, 403)
+        submit_scribe_job.assert_not_called()
+
+
+@mock.patch('azure_api_app.firebase_auth.get_firebase_app', mock.Mock())
+@mock.patch('azure_api_app.firebase_auth.auth.get_user')
+class FirebaseUserTests(SimpleTestCase):
+
+    def test_unknown_attribute_does_not_load_the_record(self, get_user):
+        user = FirebaseUser('user-1', {'uid': 'user-1'})
+
+        self.assertFalse(hasattr(user, 'emial'))
+        self.assertEqual(str(user), 'user-1')
+        get_user.assert_not_called()
+
+    def test_record_is_loaded_once(self, get_user):
+        get_user.return_value = mock.Mock(email='doctor@example.com', display_name='Doctor')
+        user = FirebaseUser('user-1', {'uid': 'user-1'})
+
+        self.assertEqual((user.email, user.display_name), ('doctor@example.com', 'Doctor'))
+        get_user.assert_called_once()
+
+
+@override_settings(SCRIBE_STREAMING_UPLOAD=True)
+@mock.patch.object(FineTuneModelOperation, 'permission_classes', [])
+@mock.patch('azure_api_app.upload_handlers.AssemblyAIOperation.upload_stream')
+@mock.patch('azure_api_app.views.FirebaseOperations')
+class StreamingUploadTests(SimpleTestCase):
+
+    def post_audio(self, query_string):
+        request = APIRequestFactory().post(f'/scribe/?{query_string}', {'file': SimpleUploadedFile('visit.mp3', b'audio')}, format='multipart')
+        request.user_id = 'user-1'
+        request.db = mock.Mock()
+        return FineTuneModelOperation.as_view()(request)
+
+    def test_unknown_visit_type_is_rejected_before_streaming(self, FirebaseOperations, upload_stream):
+        FirebaseOperations.return_value.get_visit_type_sections.return_value = False
+
+        response = self.post_audio('patient_name=Patient&visit_type=unknown')
+
+        self.assertEqual(response.status_code, 400)
+        upload_stream.assert_not_called()
+
+    def test_missing_patient_name_is_rejected_without_streaming(self, FirebaseOperations, upload_stream):
+        FirebaseOperations.return_value.get_visit_type_sections.return_value = []
+
+        response = self.post_audio('visit_type=consult')
+
+        self.assertEqual(response.status_code, 400)
+        upload_stream.assert_not_called()
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        metrics_dir = tempfile.mkdtemp(prefix='metrics-')
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        for patcher in (
+            mock.patch.object(metrics, 'METRICS_DIR', metrics_dir),
+            mock.patch.object(metrics, 'METRICS_STALE_SECONDS', 0),
+            mock.patch.object(metrics, 'metrics_file_name', None),
+            mock.patch.dict(metrics.counters, clear=True),
+            mock.patch.dict(metrics.histograms, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.metrics_dir = metrics_dir
+
+    def write_exited_process(self, pid, value):
+        data = metrics.get_metrics_data({metrics.get_key('scribe_jobs_total', {}): value}, {})
+        metrics.write_metrics_file(os.path.join(self.metrics_dir, f"{metrics.METRICS_FILE_PREFIX}{pid}-1.json"), data)
+
+    @mock.patch.object(metrics, 'is_process_alive', lambda pid: pid == os.getpid())
+    def test_counters_of_exited_processes_are_kept(self):
+        key = metrics.get_key('scribe_jobs_total', {})
+        metrics.increment('scribe_jobs_total', 2)
+        self.write_exited_process(999998, 3)
+        self.write_exited_process(999999, 5)
+
+        self.assertEqual(metrics.collect_metrics()[0][key], 10)
+        # Folded into the dead processes' totals and removed, the sum stays the same
+        self.assertEqual(metrics.collect_metrics()[0][key], 10)
+        self.assertEqual(sorted(name for name in os.listdir(self.metrics_dir) if name.endswith('.json')),
+                         [metrics.DEAD_PROCESSES_FILE, metrics.metrics_file_name])
+
+    def get_metrics(self, token=''):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        return Metrics.as_view()(APIRequestFactory().get('/metrics/', **headers))
+
+    @override_settings(METRICS_TOKEN='')
+    def test_metrics_are_closed_without_token_setting(self):
+        self.assertEqual(self.get_metrics().status_code, 403)
+
+    @override_settings(METRICS_TOKEN='token')
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.get_metrics('wrong').status_code, 403)
+        self.assertEqual(self.get_metrics('token').status_code, 200)
+
+
+class UsageChargeTests(SimpleTestCase):
+
+    AUTO_PAY = {'enable_auto_pay': True, 'threshold': 10, 'credit': 50}
+
+    def test_subscription_is_free(self):
+        user_data = {'add_on_balance': 100, 'remaining_trials': 3}
+        self.assertEqual(FirebaseOperations.get_usage_charge(user_data, True), 'subscription')
+
+    def test_balance_covering_the_charge(self):
+        user_data = {'add_on_balance': 2, 'remaining_trials': 3}
+        self.assertEqual(FirebaseOperations.get_usage_charge(user_data, False), 'balance')
+
+    def test_positive_balance_overdraws_while_top_up_is_due(self):
+        user_data = {'add_on_balance': 1, 'remaining_trials': 3, 'auto_pay': self.AUTO_PAY}
+        self.assertEqual(FirebaseOperations.get_usage_charge(user_data, False), 'balance')
+
+    def test_overdrawn_balance_falls_back_to_trial(self):
+        user_data = {'add_on_balance': -0.5, 'remaining_trials': 1, 'auto_pay': self.AUTO_PAY}
+        self.assertEqual(FirebaseOperations.get_usage_charge(user_data, False), 'trial')
+
+    def test_short_balance_without_auto_pay_uses_trial(self):
+        user_data = {'add_on_balance': 1, 'remaining_trials': 1}
+        self.assertEqual(FirebaseOperations.get_usage_charge(user_data, False), 'trial')
+
+    def test_nothing_left_is_not_charged(self):
+        self.assertIsNone(FirebaseOperations.get_usage_charge({'add_on_balance': 1}, False))
+        self.assertIsNone(FirebaseOperations.get_usage_charge({'add_on_balance': 0, 'auto_pay': self.AUTO_PAY}, False))
+
+    def test_overdraft_is_refused_once_balance_is_used_up(self):
+        for add_on_balance in (0, -0.5, -5):
+            user_data = {'add_on_balance': add_on_balance, 'remaining_trials': 0, 'auto_pay': self.AUTO_PAY}
+            self.assertTrue(FirebaseOperations.is_top_up_due(user_data))
+            self.assertIsNone(FirebaseOperations.get_usage_charge(user_data, False))
+
+
+class TopUpWorkerLockTests(SimpleTestCase):
+
+    def setUp(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        self.lock_file = os.path.join(lock_dir, 'top_up_worker.lock')
+
+    def test_only_one_process_holds_the_lock(self):
+        with override_settings(TOP_UP_LOCK_FILE=self.lock_file):
+            lock_fd = try_lock_top_up_worker()
+            self.assertIsNotNone(lock_fd)
+            self.assertIsNone(try_lock_top_up_worker())
+
+            os.close(lock_fd)
+            next_lock_fd = try_lock_top_up_worker()
+            self.assertIsNotNone(next_lock_fd)
+            os.close(next_lock_fd)
+
+
+class FakeTransaction:
+    """Records the writes of a Firestore transaction, documents it created read back as existing"""
+
+    def __init__(self):
+        self.created = {}
+        self.updates = []
+
+    def create(self, document_ref, data):
+        if document_ref in self.created:
+            raise AssertionError('Document already exists')
+        self.created[document_ref] = data
+
+    def update(self, document_ref, data):
+        self.updates.append((document_ref, data))
+
+
+def create_user_ref(user_data, has_active_subscription=False):
+    user_ref = mock.Mock()
+    user_ref.get.return_value.to_dict.return_value = user_data
+    subscriptions = [mock.Mock()] if has_active_subscription else []
+    user_ref.collection.return_value.where.return_value.limit.return_value.get.return_value = subscriptions
+    return user_ref
+
+
+class RecordUsageTests(SimpleTestCase):
+
+    def charge(self, user_data, has_active_subscription=False):
+        transaction = FakeTransaction()
+        user_ref = create_user_ref(user_data, has_active_subscription)
+        history_ref = mock.Mock()
+        usage = FirebaseOperations.charge_usage(transaction, user_ref, history_ref, {'patient_name': 'Patient'})
+
+        self.assertEqual(transaction.created, {history_ref: {'patient_name': 'Patient'}})
+        return usage, transaction.updates, user_ref
+
+    def test_subscription(self):
+        usage, updates, _user_ref = self.charge({'add_on_balance': 5, 'remaining_trials': 1}, True)
+        self.assertEqual(usage['charged'], 'subscription')
+        self.assertEqual(updates, [])
+
+    def test_balance(self):
+        usage, updates, user_ref = self.charge({'add_on_balance': 5, 'remaining_trials': 1})
+        self.assertEqual(usage['charged'], 'balance')
+        self.assertEqual(updates, [(user_ref, {'add_on_balance': Increment(-FirebaseOperations.JOB_CHARGE)})])
+        self.assertFalse(usage['top_up'])
+
+    def test_balance_at_threshold_queues_top_up(self):
+        auto_pay = {'enable_auto_pay': True, 'threshold': 10, 'credit': 50}
+        usage, _updates, _user_ref = self.charge({'add_on_balance': 5, 'auto_pay': auto_pay, 'stripeId': 'cus_1'})
+        self.assertEqual(usage, {'charged': 'balance', 'top_up': True, 'stripe_customer_id': 'cus_1', 'credit': 50.0})
+
+    def test_trial(self):
+        usage, updates, user_ref = self.charge({'add_on_balance': 1, 'remaining_trials': 1})
+        self.assertEqual(usage['charged'], 'trial')
+        self.assertEqual(updates, [(user_ref, {'remaining_trials': Increment(-1)})])
+
+    def test_no_charge(self):
+        usage, updates, _user_ref = self.charge({'add_on_balance': 0, 'remaining_trials': 0})
+        self.assertIsNone(usage['charged'])
+        self.assertEqual(updates, [])
+
+
+class ApplyTopUpTests(SimpleTestCase):
+
+    def test_repeated_top_up_is_credited_once(self):
+        transaction = FakeTransaction()
+        user_ref = mock.Mock()
+        top_up_ref = mock.Mock()
+        top_up_ref.get.side_effect = lambda transaction: mock.Mock(exists=top_up_ref in transaction.created)
+
+        self.assertTrue(FirebaseOperations.credit_top_up(transaction, user_ref, top_up_ref, 50.0))
+        self.assertFalse(FirebaseOperations.credit_top_up(transaction, user_ref, top_up_ref, 50.0))
+
+        self.assertEqual(transaction.updates, [(user_ref, {'add_on_balance': Increment(50.0)})])
+
+
+@mock.patch('azure_api_app.whisperai_operation.get_openai_client', mock.Mock())
+@mock.patch.multiple(WhisperAIOperation, CHUNK_SECONDS=600, CHUNK_OVERLAP_SECONDS=5, SILENCE_SEARCH_SECONDS=30)
+class WhisperChunkTests(SimpleTestCase):
+
+    def test_plan_chunks_cuts_at_last_silence_before_target(self):
+        chunks = WhisperAIOperation().plan_chunks(1500, [100, 580, 590, 1150, 1195])
+
+        self.assertEqual(chunks, [
+            (0, 595, 0, 590),
+            (585, 1195, 590, 1190),
+            (1185, 1500, 1190, 1500),
+        ])
+
+    def test_plan_chunks_without_silence_cuts_at_target(self):
+        chunks = WhisperAIOperation().plan_chunks(1300, [])
+
+        self.assertEqual([chunk[2:] for chunk in chunks], [(0, 600), (600, 1200), (1200, 1300)])
+
+    def test_merge_segments_drops_overlap_duplicates(self):
+        chunks = [(0, 605, 0, 600), (595, 1000, 600, 1000)]
+        chunk_segments = [
+            [{"id": 0, "start": 0, "end": 590, "text": "first"}, {"id": 1, "start": 590, "end": 604, "text": "shared"}],
+            # The second chunk starts 595 seconds in, so "shared" is heard again at its start
+            [{"id": 0, "start": 0, "end": 9, "text": "shared"}, {"id": 1, "start": 9, "end": 405, "text": "last"}],
+        ]
+
+        segments = WhisperAIOperation.merge_segments(chunks, chunk_segments)
+
+        self.assertEqual([segment["text"] for segment in segments], ["first", "shared", "last"])
+        self.assertEqual([segment["id"] for segment in segments], [0, 1, 2])
+        self.assertEqual((segments[2]["start"], segments[2]["end"]), (604, 1000))
+
+
+@mock.patch('azure_api_app.task.WhisperAIOperation')
+@mock.patch.object(TranscriptGPTOperation, 'generate_transcript_using_assembly_ai', return_value=False)
+class WhisperFallbackTests(SimpleTestCase):
+
+    def setUp(self):
+        audio_file, self.file_path = tempfile.mkstemp(suffix='.mp3')
+        os.close(audio_file)
+        self.addCleanup(lambda: os.path.exists(self.file_path) and os.remove(self.file_path))
+
+    @override_settings(SCRIBE_WHISPER_FALLBACK=True)
+    def test_failed_assembly_ai_transcript_falls_back_to_whisper(self, assembly_ai_transcript, whisper_operation):
+        whisper_operation.return_value.generate_chunked_transcription.return_value = [
+            {"id": 1, "text": " second "}, {"id": 0, "text": "first"},
+        ]
+        task = TranscriptGPTOperation(self.file_path, 'Patient', 'user-1', 'consult')
+
+        self.assertTrue(task.generate_transcript())
+        self.assertEqual(task.transcription_data, 'first\nsecond')
+        self.assertFalse(os.path.exists(self.file_path))
+
+    @override_settings(SCRIBE_WHISPER_FALLBACK=False)
+    def test_fallback_is_off_by_default(self, assembly_ai_transcript, whisper_operation):
+        task = TranscriptGPTOperation(self.file_path, 'Patient', 'user-1', 'consult')
+
+        self.assertFalse(task.generate_transcript())
+        whisper_operation.assert_not_called()
+
+    @override_settings(SCRIBE_WHISPER_FALLBACK=True)
+    def test_streamed_upload_cannot_fall_back(self, assembly_ai_transcript, whisper_operation):
+        task = TranscriptGPTOperation('', 'Patient', 'user-1', 'consult', upload_url='https://cdn.example.com/audio')
+
+        self.assertFalse(task.generate_transcript())
+        whisper_operation.assert_not_called()
+
+
+class SplitTranscriptTests(SimpleTestCase):
+
+    def test_chunks_are_cut_between_lines_within_the_limit(self):
+        lines = [f"Speaker {index % 2}: line number {index} of the visit" for index in range(40)]
+
+        chunks = split_transcript('\n'.join(lines), 50)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(count_tokens(chunk) <= 50 for chunk in chunks))
+        self.assertEqual('\n'.join(chunks).splitlines(), lines)
+
+    def test_long_line_is_split_between_words(self):
+        line = ' '.join(f"word{index}" for index in range(200))
+
+        chunks = split_transcript(line, 30)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(count_tokens(chunk) <= 30 for chunk in chunks))
+        self.assertEqual(' '.join(chunks).split(), line.split())
+
+
+@mock.patch('azure_api_app.upstream_limiter.RETRY_MAX_DELAY', 30)
+@mock.patch('azure_api_app.upstream_limiter.RETRY_BASE_DELAY', 1)
+class RetryDelayTests(SimpleTestCase):
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(get_retry_after(CaseInsensitiveDict({'Retry-After': '7'})), 7)
+
+    def test_retry_after_http_date(self):
+        headers = CaseInsensitiveDict({'Retry-After': formatdate(time.time() + 20, usegmt=True)})
+        self.assertAlmostEqual(get_retry_after(headers), 20, delta=2)
+
+    def test_retry_after_date_in_the_past(self):
+        headers = CaseInsensitiveDict({'Retry-After': formatdate(time.time() - 60, usegmt=True)})
+        self.assertEqual(get_retry_after(headers), 0)
+
+    def test_retry_after_ms_takes_precedence(self):
+        headers = CaseInsensitiveDict({'retry-after-ms': '1500', 'Retry-After': '7'})
+        self.assertEqual(get_retry_after(headers), 1.5)
+
+    def test_missing_or_invalid_retry_after(self):
+        self.assertIsNone(get_retry_after(CaseInsensitiveDict()))
+        self.assertIsNone(get_retry_after(CaseInsensitiveDict({'Retry-After': 'soon'})))
+
+    def test_retry_delay_follows_retry_after(self):
+        response = mock.Mock(headers=CaseInsensitiveDict({'Retry-After': '7'}))
+        self.assertEqual(get_retry_delay(0, response), 7)
+
+    def test_retry_delay_gives_up_on_long_retry_after(self):
+        response = mock.Mock(headers=CaseInsensitiveDict({'Retry-After': '120'}))
+        self.assertIsNone(get_retry_delay(0, response))
+
+    def test_retry_delay_backs_off_without_retry_after(self):
+        response = mock.Mock(headers=CaseInsensitiveDict())
+        for attempt in range(8):
+            self.assertTrue(0 <= get_retry_delay(attempt, response) <= min(30, 2 ** attempt))
+
+
+def create_response(status_code):
+    return mock.Mock(status_code=status_code, headers=CaseInsensitiveDict())
+
+
+@mock.patch('azure_api_app.upstream_limiter.time.sleep')
+@mock.patch('azure_api_app.upstream_limiter.get_limiter', lambda upstream: UpstreamLimiter(upstream))
+class RequestWithRetriesTests(SimpleTestCase):
+
+    def test_retryable_status_is_resent(self, sleep):
+        failed_response, response = create_response(503), create_response(200)
+        send = mock.Mock(side_effect=[failed_response, response])
+
+        self.assertIs(request_with_retries('test', send), response)
+        self.assertEqual(send.call_count, 2)
+        failed_response.close.assert_called_once()
+        sleep.assert_called_once()
+
+    def test_last_response_is_returned_after_max_retries(self, sleep):
+        responses = [create_response(429) for _ in range(3)]
+        send = mock.Mock(side_effect=responses)
+
+        self.assertIs(request_with_retries('test', send, max_retries=2), responses[-1])
+        self.assertEqual(send.call_count, 3)
+        for failed_response in responses[:-1]:
+            failed_response.close.assert_called_once()
+        responses[-1].close.assert_not_called()
+
+    def test_other_status_is_returned_at_once(self, sleep):
+        response = create_response(500)
+        send = mock.Mock(return_value=response)
+
+        self.assertIs(request_with_retries('test', send, retry_statuses=(429, 502, 503, 504)), response)
+        send.assert_called_once()
+        sleep.assert_not_called()
+
+    def test_failed_connect_is_resent(self, sleep):
+        connect_error = requests.ConnectionError(MaxRetryError(None, '/v1', NewConnectionError(None, 'Connection refused')))
+        response = create_response(200)
+        send = mock.Mock(side_effect=[connect_error, response])
+
+        self.assertIs(request_with_retries('test', send), response)
+        self.assertEqual(send.call_count, 2)
+
+    def test_dropped_connection_is_not_resent(self, sleep):
+        dropped_error = requests.ConnectionError(ProtocolError('Connection aborted.', RemoteDisconnected('Remote end closed connection')))
+        send = mock.Mock(side_effect=dropped_error)
+
+        with self.assertRaises(requests.ConnectionError):
+            request_with_retries('test', send)
+        send.assert_called_once()
+
+
+@mock.patch('azure_api_app.upstream_limiter.UPSTREAM_ACQUIRE_TIMEOUT', 0.3)
+class UpstreamLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        limit_dir = tempfile.mkdtemp(prefix='upstream-limits-')
+        self.addCleanup(shutil.rmtree, limit_dir)
+        limit_dir_patcher = mock.patch('azure_api_app.upstream_limiter.UPSTREAM_LIMIT_DIR', limit_dir)
+        limit_dir_patcher.start()
+        self.addCleanup(limit_dir_patcher.stop)
+
+    def test_taken_slot_raises_upstream_busy(self):
+        limiter = UpstreamLimiter('test', concurrency=1)
+
+        with limiter.slot():
+            with self.assertRaises(UpstreamBusy):
+                with limiter.slot():
+                    pass
+
+        # Free again once the holder is done
+        with limiter.slot():
+            pass
+
+    def test_waiter_gets_the_released_slot(self):
+        limiter = UpstreamLimiter('test', concurrency=1)
+        acquired = threading.Event()
+
+        def wait_for_slot():
+            with limiter.slot():
+                acquired.set()
+
+        with limiter.slot():
+            waiter = threading.Thread(target=wait_for_slot)
+            waiter.start()
+            time.sleep(0.1)
+            self.assertFalse(acquired.is_set())
+        waiter.join()
+
+        self.assertTrue(acquired.is_set())
+
+    def test_empty_bucket_raises_upstream_busy(self):
+        limiter = UpstreamLimiter('test', requests_per_minute=60, burst=1)
+
+        with limiter.slot():
+            pass
+        # The next token is a second away, more than the acquire timeout
+        with self.assertRaises(UpstreamBusy):
+            with limiter.slot():
+                pass
+
+
+class StripeResponseTests(SimpleTestCase):
+
+    def test_default_payment_method_is_moved_next_to_the_customer(self):
+        customer_data = {'id': 'cus_1', 'invoice_settings': {'default_payment_method': {'id': 'pm_1', 'type': 'card'}}}
+
+        response = get_customer_data_response(customer_data)
+
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(response['data']['customer_data']['invoice_settings']['default_payment_method'], 'pm_1')
+        self.assertEqual(response['data']['default_payment_method'], {'id': 'pm_1', 'type': 'card'})
+
+    def test_missing_customer_data_is_an_error(self):
+        self.assertEqual(get_customer_data_response({})['status'], 400)
+
+    def test_subscription_not_canceled_is_an_error(self):
+        response = get_cancel_subscription_response({'status': 'active'})
+        self.assertEqual(response['status'], 400)
+        self.assertEqual(response['data']['data'], {'status': 'active'})
+
+
+@mock.patch('azure_api_app.upstream_limiter.asyncio.sleep', mock.AsyncMock())
+@mock.patch('azure_api_app.upstream_limiter.get_limiter', lambda upstream: UpstreamLimiter(upstream))
+class AsyncStripeOperationTests(SimpleTestCase):
+
+    def create_stripe_operation(self, responses):
+        self.requests = []
+
+        def handle(request):
+            self.requests.append(request)
+            return responses.pop(0)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        with mock.patch('azure_api_app.stripe_operation.get_async_client', return_value=client):
+            return AsyncStripeOperation()
+
+    async def test_post_is_resent_with_the_same_idempotency_key(self):
+        stripe_operation = self.create_stripe_operation([
+            httpx.Response(503, json={'error': {'message': 'Unavailable'}}),
+            httpx.Response(200, json={'id': 'bps_1'}),
+        ])
+
+        self.assertEqual(await stripe_operation.get_billing_portal_session('cus_1'), {'id': 'bps_1'})
+        self.assertEqual(len(self.requests), 2)
+        idempotency_keys = {request.headers['Idempotency-Key'] for request in self.requests}
+        self.assertEqual(len(idempotency_keys), 1)
+
+    async def test_get_has_no_idempotency_key(self):
+        stripe_operation = self.create_stripe_operation([httpx.Response(200, json={'data': []})])
+
+        await stripe_operation.get_payment_methods('cus_1')
+        self.assertNotIn('Idempotency-Key', self.requests[0].headers)
+
+
+class GptStreamTests(SimpleTestCase):
+
+    def test_data_lines_are_relayed_as_events(self):
+        response = mock.Mock()
+        response.iter_lines.return_value = [b'data: {"id": 1}', b'', b': keep-alive', b'data: [DONE]']
+
+        events = list(OpenAIOperation.iter_gpt_stream(response))
+
+        self.assertEqual(events, [b'data: {"id": 1}\n\n', b'data: [DONE]\n\n'])
+        response.close.assert_called_once()
+
+    def test_interrupted_stream_ends_with_error_event(self):
+        def iter_lines(chunk_size=None):
+            yield b'data: {"id": 1}'
+            raise requests.ConnectionError('Connection reset')
+
+        response = mock.Mock()
+        response.iter_lines.side_effect = iter_lines
+
+        events = list(OpenAIOperation.iter_gpt_stream(response))
+
+        self.assertEqual(events[0], b'data: {"id": 1}\n\n')
+        self.assertTrue(events[1].startswith(b'event: error\n'))
+        response.close.assert_called_once()
+
+    def test_closed_stream_closes_the_upstream(self):
+        response = mock.Mock()
+        response.iter_lines.return_value = iter([b'data: {"id": 1}', b'data: {"id": 2}'])
+
+        events = OpenAIOperation.iter_gpt_stream(response)
+        next(events)
+        events.close()
+
+        response.close.assert_called_once()
+
+    async def test_async_data_lines_are_relayed_as_events(self):
+        async def aiter_lines():
+            for line in ['data: {"id": 1}', '', 'data: [DONE]']:
+                yield line
+
+        response = mock.Mock(aiter_lines=aiter_lines, aclose=mock.AsyncMock())
+
+        events = [event async for event in AsyncOpenAIOperation.iter_gpt_stream(response)]
+
+        self.assertEqual(events, ['data: {"id": 1}\n\n', 'data: [DONE]\n\n'])
+        response.aclose.assert_awaited_once()
+
+
+class ScribeSystemPromptTests(SimpleTestCase):
+
+    SECTIONS = [
+        {"title": "Subjective", "body_text": "What the patient reports"},
+        {"title": "Patient instruction", "body_text": "What the patient has to do"},
+    ]
+
+    def setUp(self):
+        cache_patcher = mock.patch('azure_api_app.prompt_builder.compiled_prompts', {})
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def test_same_sections_are_compiled_once(self):
+        with mock.patch('azure_api_app.prompt_builder.compile_scribe_system_prompt', wraps=prompt_builder.compile_scribe_system_prompt) as compile_prompt:
+            first_prompt = prompt_builder.build_scribe_system_prompt(self.SECTIONS)
+            second_prompt = prompt_builder.build_scribe_system_prompt([dict(section) for section in self.SECTIONS])
+
+        self.assertEqual(first_prompt, second_prompt)
+        compile_prompt.assert_called_once()
+
+    def test_section_order_is_kept(self):
+        prompt = prompt_builder.build_scribe_system_prompt(self.SECTIONS)
+        reversed_prompt = prompt_builder.build_scribe_system_prompt(self.SECTIONS[::-1])
+
+        self.assertNotEqual(prompt, reversed_prompt)
+        self.assertLess(prompt.index('"subjective"'), prompt.index('"patient_instruction"'))
+        self.assertIn("`'Subjective'` and `'Patient instruction'`", prompt)
+
+    def test_single_section_is_one_json_object(self):
+        prompt = prompt_builder.build_scribe_system_prompt(self.SECTIONS[:1])
+
+        self.assertIn('```json\n{\n    "subjective": "What the patient reports"\n}\n```', prompt)
+        self.assertIn("for the sections `'Subjective'`.", prompt)
+
+    def test_fact_extraction_prompt_is_cached_apart(self):
+        scribe_prompt = prompt_builder.build_scribe_system_prompt(self.SECTIONS)
+        fact_prompt = prompt_builder.build_fact_extraction_prompt(self.SECTIONS)
+
+        self.assertNotEqual(scribe_prompt, fact_prompt)
+        self.assertEqual(len(prompt_builder.compiled_prompts), 2)
+
+
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=True, CHAT_COMPLETION_CACHE_MAX_TEMPERATURE=0.2)
+class CompletionCacheTests(SimpleTestCase):
+
+    PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "Hi"}], "temperature": 0, "presence_penalty": 0}
+
+    def setUp(self):
+        # Room for two of the responses below
+        cache = TTLCache(maxsize=100, ttl=60, getsizeof=lambda entry: entry[1])
+        cache_patcher = mock.patch('azure_api_app.completion_cache.completion_cache', cache)
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def create_payload(self, content):
+        return {**self.PAYLOAD, "messages": [{"role": "user", "content": content}]}
+
+    def test_key_ignores_key_order(self):
+        reordered_payload = dict(reversed(list(self.PAYLOAD.items())))
+        self.assertEqual(completion_cache.get_cache_key(self.PAYLOAD), completion_cache.get_cache_key(reordered_payload))
+        self.assertNotEqual(completion_cache.get_cache_key(self.PAYLOAD), completion_cache.get_cache_key(self.create_payload("Hello")))
+
+    def test_cached_completion_is_replayed(self):
+        response = {"id": "chatcmpl-1", "text": "x" * 10}
+        completion_cache.cache_completion(self.PAYLOAD, response)
+
+        self.assertEqual(completion_cache.get_cached_completion(dict(reversed(list(self.PAYLOAD.items())))), response)
+
+    def test_warm_or_streamed_completion_is_not_cached(self):
+        for payload in ({**self.PAYLOAD, "temperature": 0.8}, {**self.PAYLOAD, "stream": True}):
+            completion_cache.cache_completion(payload, {"id": "chatcmpl-1"})
+            self.assertIsNone(completion_cache.get_cached_completion(payload))
+        self.assertEqual(len(completion_cache.completion_cache), 0)
+
+    def test_oldest_completion_is_evicted_by_size(self):
+        # Each response is 40 bytes of JSON
+        for content in ("first", "second", "third"):
+            completion_cache.cache_completion(self.create_payload(content), {"text": content.ljust(28, ".")})
+
+        self.assertIsNone(completion_cache.get_cached_completion(self.create_payload("first")))
+        self.assertIsNotNone(completion_cache.get_cached_completion(self.create_payload("second")))
+        self.assertIsNotNone(completion_cache.get_cached_completion(self.create_payload("third")))
+        self.assertLessEqual(completion_cache.completion_cache.currsize, 100)
+
+    def test_response_larger_than_the_cache_is_skipped(self):
+        completion_cache.cache_completion(self.PAYLOAD, {"text": "x" * 200})
+        self.assertIsNone(completion_cache.get_cached_completion(self.PAYLOAD))
+
+
+class TranscriptCacheTests(SimpleTestCase):
+
+    SETTINGS = {"speaker_labels": True}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='transcript-cache-')
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        for patcher in (
+            mock.patch('azure_api_app.transcript_cache.TRANSCRIPT_CACHE_DIR', self.cache_dir),
+            mock.patch('azure_api_app.transcript_cache.TRANSCRIPT_CACHE_MAX_BYTES', 2 ** 20),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def cache(self, name):
+        cache_key = transcript_cache.get_cache_key(name, self.SETTINGS)
+        self.assertTrue(transcript_cache.cache_transcript(cache_key, {"transcription": f"Transcript of {name}", "audio_duration": 60}))
+        return cache_key
+
+    def test_transcript_round_trip(self):
+        cache_key = self.cache('audio-1')
+
+        self.assertEqual(transcript_cache.get_cached_transcript(cache_key), {"transcription": "Transcript of audio-1", "audio_duration": 60})
+        self.assertEqual(os.listdir(self.cache_dir), [f"{cache_key}.json.gz"])
+
+    def test_other_settings_miss(self):
+        self.cache('audio-1')
+
+        other_key = transcript_cache.get_cache_key('audio-1', {"speaker_labels": False})
+        self.assertIsNone(transcript_cache.get_cached_transcript(other_key))
+
+    def test_least_recently_read_transcript_is_evicted(self):
+        first_key, second_key = self.cache('audio-1'), self.cache('audio-2')
+        os.utime(transcript_cache.get_cache_path(first_key), (1000, 1000))
+        os.utime(transcript_cache.get_cache_path(second_key), (2000, 2000))
+
+        # Reading the first one makes the second the least recently used
+        self.assertIsNotNone(transcript_cache.get_cached_transcript(first_key))
+
+        file_size = os.path.getsize(transcript_cache.get_cache_path(first_key))
+        with mock.patch('azure_api_app.transcript_cache.TRANSCRIPT_CACHE_MAX_BYTES', file_size * 2 + file_size // 2):
+            third_key = self.cache('audio-3')
+
+        self.assertIsNotNone(transcript_cache.get_cached_transcript(first_key))
+        self.assertIsNone(transcript_cache.get_cached_transcript(second_key))
+        self.assertIsNotNone(transcript_cache.get_cached_transcript(third_key))
+
+    def test_disabled_cache_stores_nothing(self):
+        with mock.patch('azure_api_app.transcript_cache.TRANSCRIPT_CACHE_MAX_BYTES', 0):
+            cache_key = transcript_cache.get_cache_key('audio-1', self.SETTINGS)
+            self.assertFalse(transcript_cache.cache_transcript(cache_key, {"transcription": "Transcript"}))
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TraceparentTests(SimpleTestCase):
+
+    TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+    SPAN_ID = '00f067aa0ba902b7'
+
+    def test_valid_traceparent_is_parsed(self):
+        remote_parent = tracing.parse_traceparent(f" 00-{self.TRACE_ID}-{self.SPAN_ID}-01 ")
+
+        self.assertEqual((remote_parent.trace_id, remote_parent.span_id), (self.TRACE_ID, self.SPAN_ID))
+        self.assertEqual(remote_parent.traceparent, f"00-{self.TRACE_ID}-{self.SPAN_ID}-01")
+
+    def test_malformed_traceparent_is_ignored(self):
+        for traceparent in (
+            None, '', 'garbage',
+            f"01-{self.TRACE_ID}-{self.SPAN_ID}-01",
+            f"00-{'0' * 32}-{self.SPAN_ID}-01",
+            f"00-{self.TRACE_ID}-{'0' * 16}-01",
+            f"00-{self.TRACE_ID[:-1]}-{self.SPAN_ID}-01",
+            f"00-{self.TRACE_ID[:-1]}x-{self.SPAN_ID}-01",
+        ):
+            self.assertIsNone(tracing.parse_traceparent(traceparent), traceparent)
+
+    def test_span_traceparent_round_trips(self):
+        new_span = tracing.Span('test', trace_id=self.TRACE_ID)
+        remote_parent = tracing.parse_traceparent(new_span.traceparent)
+
+        self.assertEqual((remote_parent.trace_id, remote_parent.span_id), (self.TRACE_ID, new_span.span_id))
+
+
+@mock.patch('azure_api_app.tracing.TRACING_ENABLED', True)
+@mock.patch('azure_api_app.tracing.start_exporter', mock.Mock())
+@mock.patch('azure_api_app.job_executor.tracing.flush_traces', mock.Mock())
+@mock.patch('azure_api_app.job_executor.metrics.flush_metrics', mock.Mock())
+@mock.patch('azure_api_app.job_executor.start_lease_heartbeat', lambda job_id, owner: threading.Event())
+@mock.patch('azure_api_app.task.TranscriptGPTOperation')
+class JobTracePropagationTests(TestCase):
+
+    def setUp(self):
+        export_queue_patcher = mock.patch('azure_api_app.tracing.export_queue', queue.Queue())
+        export_queue_patcher.start()
+        self.addCleanup(export_queue_patcher.stop)
+
+    def test_job_span_continues_the_upload_trace(self, transcript_task):
+        job_spans = []
+        transcript_task.return_value.is_transcript_pending = False
+        transcript_task.return_value.perform_operation.side_effect = lambda: job_spans.append(tracing.current_span.get()) or True
+
+        with tracing.span('POST /scribe') as request_span:
+            job = job_store.create_job('user-1', 'Patient', 'consult', upload_url='https://cdn.example.com/audio', traceparent=tracing.get_traceparent())
+
+        self.assertTrue(run_scribe_job(job.id))
+        self.assertEqual(job_spans[0].name, 'scribe_job')
+        self.assertEqual(job_spans[0].trace_id, request_span.trace_id)
+        self.assertEqual(job_spans[0].parent_id, request_span.span_id)
+        self.assertIsNone(tracing.current_span.get())
+
+
+@override_settings(PROFILE_TOKEN='profile-token', PROFILE_SAMPLE_RATE=0, PROFILE_INTERVAL=0.001)
+class ProfilingMiddlewareTests(SimpleTestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp(prefix='profiles-')
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        settings_override = override_settings(PROFILE_DIR=self.profile_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get_response(self, **headers):
+        middleware = ProfilingMiddleware(lambda request: HttpResponse('ok'))
+        response = middleware(RequestFactory().get('/scribe/jobs/1/', headers=headers))
+        # Wait for the profile files written in the background
+        for thread in threading.enumerate():
+            if thread.name == 'request-profile-save':
+                thread.join()
+        return response
+
+    @override_settings(PROFILE_TOKEN='', PROFILE_SAMPLE_RATE=0)
+    def test_middleware_is_off_without_token_or_sample_rate(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: HttpResponse('ok'))
+
+    def test_request_with_token_is_profiled(self):
+        response = self.get_response(**{'X-Profile-Token': 'profile-token'})
+
+        profile_id = response['X-Profile-Id']
+        self.assertEqual(sorted(os.listdir(self.profile_dir)), [f"{profile_id}.folded", f"{profile_id}.json"])
+        with open(os.path.join(self.profile_dir, f"{profile_id}.json")) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual((summary['reason'], summary['path'], summary['status_code']), ('token', '/scribe/jobs/1/', 200))
+        self.assertEqual(set(summary['breakdown']), {'auth', 'firestore', 'upstream', 'serialization', 'other'})
+
+    def test_wrong_token_is_not_profiled(self):
+        response = self.get_response(**{'X-Profile-Token': 'wrong-token'})
+
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    @override_settings(PROFILE_SAMPLE_RATE=0.25)
+    def test_sample_rate_share_is_profiled(self):
+        with mock.patch('azure_api_app.profiling.random.random', return_value=0.1):
+            self.assertIn('X-Profile-Id', self.get_response())
+        with mock.patch('azure_api_app.profiling.random.random', return_value=0.5):
+            self.assertNotIn('X-Profile-Id', self.get_response())
@@ -0,0 +1,77 @@
+# Other
+import math
+
+# tiktoken is optional, without it tokens are estimated from the text length
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARS_PER_TOKEN = 4
+
+# Global variables
+encoding = None
+
+
+def get_encoding():
+    global encoding
+    if encoding is None and tiktoken is not None:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding
+
+
+def count_tokens(text):
+    """Number of tokens the chat models see for `text` (estimated when tiktoken is not installed)"""
+    if not text:
+        return 0
+
+    text_encoding = get_encoding()
+    if text_encoding is not None:
+        return len(text_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def split_transcript(transcript, max_tokens):
+    """Split a transcript into chunks of at most `max_tokens`, cutting between lines (utterances/segments).
+
+    A single line longer than `max_tokens` is split between words.
+    """
+    chunks = []
+    chunk_lines = []
+    chunk_tokens = 0
+
+    for line in transcript.splitlines():
+        if not line.strip():
+            continue
+
+        line_parts = [line] if count_tokens(line) <= max_tokens else split_line(line, max_tokens)
+        for line_part in line_parts:
+            # +1 for the newline joining the lines
+            line_tokens = count_tokens(line_part) + 1
+            if chunk_lines and chunk_tokens + line_tokens > max_tokens:
+                chunks.append('\n'.join(chunk_lines))
+                chunk_lines, chunk_tokens = [], 0
+
+            chunk_lines.append(line_part)
+            chunk_tokens += line_tokens
+
+    if chunk_lines:
+        chunks.append('\n'.join(chunk_lines))
+    return chunks
+
+
+def split_line(line, max_tokens):
+    parts = []
+    part_words = []
+    part_tokens = 0
+    for word in line.split():
+        word_tokens = count_tokens(f" {word}")
+        if part_words and part_tokens + word_tokens > max_tokens:
+            parts.append(' '.join(part_words))
+            part_words, part_tokens = [], 0
+        part_words.append(word)
+        part_tokens += word_tokens
+
+    if part_words:
+        parts.append(' '.join(part_words))
+    return parts
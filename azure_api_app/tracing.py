@@ -0,0 +1,413 @@
+"""Lightweight tracing: W3C trace context, spans kept in a context variable and OTLP/JSON export to a file.
+
+A request span is opened by TracingMiddleware (continuing an incoming
+`traceparent` header). FineTuneModelOperation stores the current traceparent on
+the ScribeJob, and the job worker continues the same trace, so one trace covers
+the upload, every job attempt and each upstream call made by the classes
+decorated with `trace_methods`.
+
+Finished spans are appended to TRACE_EXPORT_FILE as OTLP/JSON lines (one
+`ExportTraceServiceRequest` per line), which the OpenTelemetry collector's
+otlpjsonfile receiver reads. Job workers call `flush_traces` after each job, as
+they may exit without running the exporter thread again.
+
+Nothing is recorded unless TRACING_ENABLED is set. ProfilingMiddleware sets
+`recording` to get the spans of a profiled request, which are then only handed
+to `span_listeners` and not exported.
+"""
+# Other
+import os
+import json
+import time
+import queue
+import socket
+import asyncio
+import inspect
+import logging
+import secrets
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() == 'true'
+TRACE_EXPORT_FILE = os.environ.get('TRACE_EXPORT_FILE', os.path.join(current_directory, "traces/traces.jsonl"))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'scribegenie-api')
+TRACE_EXPORT_BATCH_SIZE = 256
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+current_span = contextvars.ContextVar('current_span', default=None)
+# Set for a single request (e.g. one being profiled) to record its spans while tracing is disabled
+recording = contextvars.ContextVar('recording', default=False)
+
+# Global variables
+export_queue = queue.Queue()
+exporter_started = False
+exporter_lock = threading.Lock()
+
+
+class Span:
+
+    def __init__(self, name, trace_id, parent_id='', kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status_code = STATUS_CODE_OK
+        self.status_message = ''
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration(self):
+        """Seconds, up to now while the span is still open"""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status_code = STATUS_CODE_ERROR
+        self.status_message = str(message)[:500]
+
+    def to_otlp(self):
+        otlp_span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [get_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status_code, **({"message": self.status_message} if self.status_message else {})},
+        }
+        if self.parent_id:
+            otlp_span["parentSpanId"] = self.parent_id
+        return otlp_span
+
+
+class RemoteParent:
+    """Span context received from elsewhere (traceparent header, ScribeJob) to continue a trace from"""
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+def get_otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def parse_traceparent(traceparent):
+    """RemoteParent of a W3C `traceparent` value, None if it is missing or malformed"""
+    try:
+        version, trace_id, span_id, _flags = (traceparent or '').strip().split('-')
+        int(trace_id, 16), int(span_id, 16)
+    except ValueError:
+        return None
+
+    if version != '00' or len(trace_id) != 32 or len(span_id) != 16 or trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+    return RemoteParent(trace_id, span_id)
+
+
+def is_recording():
+    return TRACING_ENABLED or recording.get()
+
+
+def get_traceparent():
+    """traceparent of the current span, '' outside of any trace"""
+    parent = current_span.get()
+    return parent.traceparent if parent else ''
+
+
+@contextmanager
+def use_traceparent(traceparent):
+    """Spans opened inside continue the trace of `traceparent` (e.g. the one stored on a ScribeJob)"""
+    remote_parent = parse_traceparent(traceparent) if TRACING_ENABLED else None
+    if remote_parent is None:
+        yield
+        return
+
+    token = current_span.set(remote_parent)
+    try:
+        yield
+    finally:
+        current_span.reset(token)
+
+
+@contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """Open a child of the current span (or a new trace); yields None when tracing is disabled"""
+    if not is_recording():
+        yield None
+        return
+
+    new_span = start_detached_span(name, **attributes)
+    new_span.kind = kind
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current_span.reset(token)
+        end_span(new_span)
+
+
+def start_detached_span(name, **attributes):
+    """Child of the current span that is not made current itself; end it with `end_span`"""
+    parent = current_span.get()
+    return Span(
+        name,
+        trace_id=parent.trace_id if parent else secrets.token_hex(16),
+        parent_id=parent.span_id if parent else '',
+        attributes=attributes,
+    )
+
+
+def end_span(finished_span):
+    finished_span.end_ns = time.time_ns()
+    for listener in span_listeners:
+        listener(finished_span)
+    if TRACING_ENABLED:
+        export_queue.put(finished_span)
+        start_exporter()
+
+
+# Called with every finished span, e.g. to collect a request's timing breakdown
+span_listeners = []
+
+
+def in_current_context(func):
+    """Run `func` from a thread pool inside the caller's trace, so its spans keep their parent"""
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time, every call gets its own copy
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def trace_function(func, name):
+    """Wrap a function, coroutine function, generator or async generator in a span named `name`"""
+
+    def record_result(traced_span, result):
+        # The operation classes report failures by returning False instead of raising
+        if traced_span is not None and result is False:
+            traced_span.set_error('returned False')
+
+    # Generators are iterated later, possibly from another thread or context (e.g. a relayed SSE stream),
+    # so their span covers the whole iteration but is never made the current span
+    if inspect.isasyncgenfunction(func):
+        @wraps(func)
+        async def async_generator_wrapper(*args, **kwargs):
+            if not is_recording():
+                async for item in func(*args, **kwargs):
+                    yield item
+                return
+
+            generator_span = start_detached_span(name)
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            except BaseException as e:
+                generator_span.set_error(f"{type(e).__name__}: {e}")
+                raise
+            finally:
+                end_span(generator_span)
+        return async_generator_wrapper
+
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not is_recording():
+                return (yield from func(*args, **kwargs))
+
+            generator_span = start_detached_span(name)
+            try:
+                return (yield from func(*args, **kwargs))
+            except BaseException as e:
+                generator_span.set_error(f"{type(e).__name__}: {e}")
+                raise
+            finally:
+                end_span(generator_span)
+        return generator_wrapper
+
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def coroutine_wrapper(*args, **kwargs):
+            if not is_recording():
+                return await func(*args, **kwargs)
+            with span(name) as traced_span:
+                result = await func(*args, **kwargs)
+                record_result(traced_span, result)
+                return result
+        return coroutine_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_recording():
+            return func(*args, **kwargs)
+        with span(name) as traced_span:
+            result = func(*args, **kwargs)
+            record_result(traced_span, result)
+            return result
+    return wrapper
+
+
+def trace_methods(cls=None, exclude=()):
+    """Class decorator: a span around every public method defined on the class, named `Class.method`
+
+    Use as `@trace_methods`, or `@trace_methods(exclude=(...))` to leave cheap helpers out.
+    """
+    if cls is None:
+        return lambda decorated_cls: trace_methods(decorated_cls, exclude)
+
+    for attribute_name, attribute in list(vars(cls).items()):
+        if attribute_name.startswith('_') or attribute_name in exclude:
+            continue
+
+        span_name = f"{cls.__name__}.{attribute_name}"
+        if isinstance(attribute, staticmethod):
+            setattr(cls, attribute_name, staticmethod(trace_function(attribute.__func__, span_name)))
+        elif isinstance(attribute, classmethod):
+            setattr(cls, attribute_name, classmethod(trace_function(attribute.__func__, span_name)))
+        elif inspect.isfunction(attribute):
+            setattr(cls, attribute_name, trace_function(attribute, span_name))
+    return cls
+
+
+class TracingMiddleware:
+    """Opens the request span, continuing the caller's `traceparent`, and returns the trace id as X-Trace-Id"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not TRACING_ENABLED:
+            return self.get_response(request)
+
+        with use_traceparent(request.META.get('HTTP_TRACEPARENT')):
+            with span(f"{request.method} {request.path}", kind=SPAN_KIND_SERVER, **self.get_request_attributes(request)) as request_span:
+                response = self.get_response(request)
+                self.record_response(request, request_span, response)
+        return response
+
+    async def __acall__(self, request):
+        if not TRACING_ENABLED:
+            return await self.get_response(request)
+
+        with use_traceparent(request.META.get('HTTP_TRACEPARENT')):
+            with span(f"{request.method} {request.path}", kind=SPAN_KIND_SERVER, **self.get_request_attributes(request)) as request_span:
+                response = await self.get_response(request)
+                self.record_response(request, request_span, response)
+        return response
+
+    @staticmethod
+    def get_request_attributes(request):
+        return {"http.method": request.method, "http.target": request.path}
+
+    @staticmethod
+    def record_response(request, request_span, response):
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is not None:
+            # The route pattern keeps ids out of the span name
+            request_span.name = f"{request.method} /{resolver_match.route}"
+            request_span.set_attribute("http.route", f"/{resolver_match.route}")
+
+        request_span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            request_span.set_error(f"HTTP {response.status_code}")
+        response['X-Trace-Id'] = request_span.trace_id
+
+
+def start_exporter():
+    global exporter_started
+    if exporter_started:
+        return
+
+    with exporter_lock:
+        if exporter_started:
+            return
+        exporter_started = True
+
+    threading.Thread(target=export_loop, name='trace-exporter', daemon=True).start()
+
+
+def export_loop():
+    while True:
+        spans = [export_queue.get()]
+        export_spans(spans + get_queued_spans())
+
+
+def get_queued_spans():
+    spans = []
+    while len(spans) < TRACE_EXPORT_BATCH_SIZE:
+        try:
+            spans.append(export_queue.get_nowait())
+        except queue.Empty:
+            break
+    return spans
+
+
+def flush_traces():
+    """Export the queued spans now, e.g. before a job worker goes idle"""
+    spans = get_queued_spans()
+    while spans:
+        export_spans(spans)
+        spans = get_queued_spans()
+
+
+def export_spans(spans):
+    resource = {"attributes": [
+        get_otlp_attribute("service.name", TRACE_SERVICE_NAME),
+        get_otlp_attribute("host.name", socket.gethostname()),
+        get_otlp_attribute("process.pid", os.getpid()),
+    ]}
+    export_request = {"resourceSpans": [{
+        "resource": resource,
+        "scopeSpans": [{"scope": {"name": "azure_api_app.tracing"}, "spans": [finished_span.to_otlp() for finished_span in spans]}],
+    }]}
+    try:
+        os.makedirs(os.path.dirname(TRACE_EXPORT_FILE), exist_ok=True)
+        # One write per line in append mode, lines from concurrent processes don't interleave
+        with open(TRACE_EXPORT_FILE, 'a') as export_file:
+            export_file.write(json.dumps(export_request, separators=(',', ':')) + '\n')
+    except Exception as e:
+        logger.error('Trace export failed', extra={'error': str(e)})
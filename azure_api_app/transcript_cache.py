@@ -0,0 +1,95 @@
+# Other
+import os
+import json
+import gzip
+import hashlib
+import logging
+import tempfile
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+# Completed transcripts on disk, keyed by audio hash + transcription settings, least recently used evicted first (0 disables)
+current_directory = os.path.dirname(os.path.realpath(__file__))
+TRANSCRIPT_CACHE_DIR = os.environ.get('TRANSCRIPT_CACHE_DIR', os.path.join(current_directory, "transcript_cache"))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get('TRANSCRIPT_CACHE_MAX_BYTES', 512 * 2 ** 20))
+
+CACHE_FILE_SUFFIX = '.json.gz'
+
+
+def get_cache_key(audio_sha256, transcription_settings):
+    """Key of a transcript; changing the transcription settings never returns a transcript made with the old ones"""
+    settings_json = json.dumps(transcription_settings, sort_keys=True)
+    return hashlib.sha256(f"{audio_sha256}:{settings_json}".encode()).hexdigest()
+
+
+def get_cache_path(cache_key):
+    return os.path.join(TRANSCRIPT_CACHE_DIR, f"{cache_key}{CACHE_FILE_SUFFIX}")
+
+
+def get_cached_transcript(cache_key):
+    if TRANSCRIPT_CACHE_MAX_BYTES <= 0:
+        return None
+
+    cache_path = get_cache_path(cache_key)
+    try:
+        with gzip.open(cache_path, 'rt', encoding='utf-8') as cache_file:
+            transcript = json.load(cache_file)
+        # The modification time is the recency used by the eviction
+        os.utime(cache_path)
+        return transcript
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error('Transcript cache read failed', extra={'error': str(e)})
+        return None
+
+
+def cache_transcript(cache_key, transcript):
+    """Store the transcript atomically (write to a temporary file, then rename) and evict down to the size limit"""
+    if TRANSCRIPT_CACHE_MAX_BYTES <= 0:
+        return False
+
+    try:
+        os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=TRANSCRIPT_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temporary_file:
+                with gzip.GzipFile(fileobj=temporary_file, mode='wb') as cache_file:
+                    cache_file.write(json.dumps(transcript).encode('utf-8'))
+            os.replace(temporary_path, get_cache_path(cache_key))
+        except Exception:
+            os.remove(temporary_path)
+            raise
+
+        evict_transcripts()
+        return True
+    except Exception as e:
+        logger.error('Transcript cache write failed', extra={'error': str(e)})
+        return False
+
+
+def evict_transcripts():
+    cache_files = []
+    total_size = 0
+    with os.scandir(TRANSCRIPT_CACHE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cache_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+            total_size += entry_stat.st_size
+
+    for _mtime, size, path in sorted(cache_files):
+        if total_size <= TRANSCRIPT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another worker evicted it first
+            pass
+        total_size -= size
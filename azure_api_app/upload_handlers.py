@@ -0,0 +1,109 @@
+# From django
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+# From assemblyai_operation
+from azure_api_app.assemblyai_operation import AssemblyAIOperation
+
+# Other
+import queue
+import hashlib
+import threading
+
+
+class StreamedAudioFile(UploadedFile):
+    """Audio that was forwarded to Assembly AI while being received, nothing is kept locally."""
+
+    def __init__(self, name, content_type, size, upload_url, sha256):
+        super().__init__(file=None, name=name, content_type=content_type, size=size)
+        self.upload_url = upload_url
+        self.sha256 = sha256
+
+
+class AssemblyAIStreamingUploadHandler(FileUploadHandler):
+    """Streams the `file` field of a multipart upload straight to the Assembly AI `/upload` endpoint.
+
+    Chunks are handed to a background thread that feeds them to a chunked
+    request body, and hashed on the way. `file_complete` waits for the upload to
+    finish, so the view gets a `StreamedAudioFile` with the `upload_url`.
+    """
+
+    chunk_size = 256 * 2 ** 10
+    audio_field_name = 'file'
+    max_buffered_chunks = 16
+    upload_timeout = 300
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.is_streaming = False
+        self.upload_response = False
+
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name != self.audio_field_name:
+            return
+
+        self.is_streaming = True
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.chunks = queue.Queue(maxsize=self.max_buffered_chunks)
+        self.upload_thread = threading.Thread(target=self.upload, name='assemblyai-stream-upload', daemon=True)
+        self.upload_thread.start()
+
+        # Keep the default handlers from spooling a second copy to memory or disk
+        raise StopFutureHandlers()
+
+
+    def upload(self):
+        self.upload_response = AssemblyAIOperation().upload_stream(self.iter_chunks())
+
+
+    def iter_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+    def put_chunk(self, chunk):
+        # Blocks while Assembly AI is slower than the client, gives up if the upload thread died
+        while self.upload_thread.is_alive():
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.is_streaming:
+            return raw_data
+
+        self.size += len(raw_data)
+        self.sha256.update(raw_data)
+        self.put_chunk(raw_data)
+        return None
+
+
+    def file_complete(self, file_size):
+        if not self.is_streaming:
+            return None
+
+        self.is_streaming = False
+        self.put_chunk(None)
+        self.upload_thread.join(self.upload_timeout)
+
+        upload_url = ''
+        if not self.upload_thread.is_alive() and self.upload_response:
+            upload_url = self.upload_response.get('upload_url', '')
+
+        return StreamedAudioFile(self.file_name, self.content_type, self.size, upload_url, self.sha256.hexdigest())
+
+
+    def upload_interrupted(self):
+        if self.is_streaming:
+            self.is_streaming = False
+            self.put_chunk(None)
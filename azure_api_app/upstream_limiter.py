@@ -0,0 +1,309 @@
+"""Per-upstream concurrency gate, token bucket and Retry-After aware retries, shared by every worker process.
+
+The limits of an upstream are enforced across processes with files in
+UPSTREAM_LIMIT_DIR:
+
+- `<upstream>.slot.<n>`: one file per concurrent request, a request holds an
+  exclusive flock on a free one (released by the kernel if the process dies)
+- `<upstream>.bucket`: token bucket state (tokens, updated) refilled at
+  `requests_per_minute`, read and written under an exclusive flock
+
+A request waits for a slot, then for a token, for up to UPSTREAM_ACQUIRE_TIMEOUT
+seconds before UpstreamBusy is raised. While every slot is taken it checks again
+after an exponentially growing interval (SLOT_POLL_INTERVAL up to
+SLOT_POLL_MAX_INTERVAL), so a crowd of waiters doesn't spin on the slot files. `request_with_retries` resends 429/5xx
+responses and failed connects up to UPSTREAM_MAX_RETRIES times, waiting for
+Retry-After when the upstream sends it and for a jittered exponential backoff
+otherwise. A slot is only held while a request is in flight, not while waiting
+to retry. Without fcntl (Windows) only the retries apply.
+"""
+# Retry counters
+from azure_api_app import metrics
+
+# Other
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import requests
+import httpx
+from urllib3.exceptions import NewConnectionError
+from contextlib import contextmanager, asynccontextmanager
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+UPSTREAM_LIMIT_DIR = os.environ.get('UPSTREAM_LIMIT_DIR', os.path.join(current_directory, "upstream_limits"))
+UPSTREAM_ACQUIRE_TIMEOUT = float(os.environ.get('UPSTREAM_ACQUIRE_TIMEOUT', 120))
+
+# Sized to the account quotas; 0 turns a limit off
+UPSTREAM_LIMITS = {
+    'openai': {
+        'concurrency': int(os.environ.get('OPENAI_MAX_CONCURRENCY', 16)),
+        'requests_per_minute': float(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 500)),
+    },
+    'assemblyai': {
+        'concurrency': int(os.environ.get('ASSEMBLY_AI_MAX_CONCURRENCY', 16)),
+        'requests_per_minute': float(os.environ.get('ASSEMBLY_AI_REQUESTS_PER_MINUTE', 600)),
+    },
+    # Used by the async Stripe calls, Stripe allows 25 requests per second in test mode
+    'stripe': {
+        'concurrency': int(os.environ.get('STRIPE_MAX_CONCURRENCY', 16)),
+        'requests_per_minute': float(os.environ.get('STRIPE_REQUESTS_PER_MINUTE', 1500)),
+    },
+}
+
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 3))
+RETRY_BASE_DELAY = float(os.environ.get('UPSTREAM_RETRY_BASE_DELAY', 1))
+# A longer Retry-After than this is not waited for, the response is returned as it is
+RETRY_MAX_DELAY = float(os.environ.get('UPSTREAM_RETRY_MAX_DELAY', 30))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Seconds between attempts to get a slot while all are taken, doubled after every miss up to the max
+SLOT_POLL_INTERVAL = 0.05
+SLOT_POLL_MAX_INTERVAL = 1.0
+
+# Global variables
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+class UpstreamBusy(Exception):
+    """Raised when no slot or token of an upstream was free within UPSTREAM_ACQUIRE_TIMEOUT."""
+
+
+class UpstreamLimiter:
+
+    def __init__(self, upstream, concurrency=0, requests_per_minute=0, burst=None):
+        self.upstream = upstream
+        self.concurrency = concurrency if fcntl else 0
+        self.requests_per_minute = requests_per_minute if fcntl else 0
+        # Up to 10 seconds worth of requests can go out at once after a quiet period
+        self.burst = burst or max(1.0, self.requests_per_minute / 6)
+        self.bucket_path = os.path.join(UPSTREAM_LIMIT_DIR, f"{upstream}.bucket")
+
+        if self.concurrency or self.requests_per_minute:
+            os.makedirs(UPSTREAM_LIMIT_DIR, exist_ok=True)
+
+    def try_acquire_slot(self):
+        """File descriptor of a slot now locked by this request, None when all are taken"""
+        # Starting at a random slot spreads the processes over the files instead of all contending for the first
+        first_slot = random.randrange(self.concurrency)
+        for index in range(self.concurrency):
+            slot_path = os.path.join(UPSTREAM_LIMIT_DIR, f"{self.upstream}.slot.{(first_slot + index) % self.concurrency}")
+            # A new descriptor per attempt, flock would let another thread of this process share an open one
+            slot_fd = os.open(slot_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(slot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_fd
+            except BlockingIOError:
+                os.close(slot_fd)
+        return None
+
+    @staticmethod
+    def release_slot(slot_fd):
+        if slot_fd is not None:
+            # Closing the descriptor drops its lock
+            os.close(slot_fd)
+
+    def try_take_token(self):
+        """Take a token from the bucket; seconds until one is available when it is empty (0 when taken)"""
+        with open(self.bucket_path, 'a+') as bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            bucket_file.seek(0)
+            try:
+                state = json.loads(bucket_file.read() or '{}')
+            except ValueError:
+                state = {}
+
+            now = time.time()
+            rate = self.requests_per_minute / 60
+            tokens = min(self.burst, state.get('tokens', self.burst) + max(now - state.get('updated', now), 0) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+
+            bucket_file.seek(0)
+            bucket_file.truncate()
+            bucket_file.write(json.dumps({'tokens': tokens, 'updated': now}))
+            return wait
+
+    def get_wait(self, slot_fd, slot_misses=0):
+        """(slot_fd, seconds to wait before trying again); a wait of 0 means the request can go
+
+        `slot_misses` is how often all slots were taken so far, the wait for the next check grows with it.
+        """
+        if self.concurrency and slot_fd is None:
+            slot_fd = self.try_acquire_slot()
+            if slot_fd is None:
+                return None, min(SLOT_POLL_INTERVAL * 2 ** slot_misses, SLOT_POLL_MAX_INTERVAL) * random.uniform(0.5, 1.5)
+
+        if self.requests_per_minute:
+            wait = self.try_take_token()
+            if wait:
+                return slot_fd, wait
+
+        return slot_fd, 0
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot and a token of the upstream while the block runs"""
+        start = time.monotonic()
+        slot_fd = None
+        slot_misses = 0
+        try:
+            while True:
+                slot_fd, wait = self.get_wait(slot_fd, slot_misses)
+                if not wait:
+                    break
+                slot_misses += slot_fd is None
+                self.check_timeout(start, wait)
+                time.sleep(wait)
+            self.record_wait(start)
+            yield
+        finally:
+            self.release_slot(slot_fd)
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """`slot` for the async views, waiting without blocking the event loop"""
+        start = time.monotonic()
+        slot_fd = None
+        slot_misses = 0
+        try:
+            while True:
+                # The bucket flock can wait on other processes and its file I/O blocks, so both run on a thread
+                slot_fd, wait = await asyncio.to_thread(self.get_wait, slot_fd, slot_misses)
+                if not wait:
+                    break
+                slot_misses += slot_fd is None
+                self.check_timeout(start, wait)
+                await asyncio.sleep(wait)
+            self.record_wait(start)
+            yield
+        finally:
+            self.release_slot(slot_fd)
+
+    def check_timeout(self, start, wait):
+        if time.monotonic() - start + wait > UPSTREAM_ACQUIRE_TIMEOUT:
+            metrics.increment('upstream_limiter_timeouts_total', upstream=self.upstream)
+            raise UpstreamBusy(f"No {self.upstream} capacity within {UPSTREAM_ACQUIRE_TIMEOUT} seconds")
+
+    def record_wait(self, start):
+        if self.concurrency or self.requests_per_minute:
+            metrics.observe('upstream_limiter_wait_seconds', time.monotonic() - start, upstream=self.upstream)
+
+
+def get_limiter(upstream):
+    limiter = limiters.get(upstream)
+    if limiter:
+        return limiter
+
+    with limiters_lock:
+        if upstream not in limiters:
+            limiters[upstream] = UpstreamLimiter(upstream, **UPSTREAM_LIMITS.get(upstream, {}))
+        return limiters[upstream]
+
+
+def get_retry_after(headers):
+    """Seconds asked for by `retry-after-ms` or `Retry-After` (seconds or an HTTP date), None when absent"""
+    try:
+        if headers.get('retry-after-ms'):
+            return max(float(headers['retry-after-ms']) / 1000, 0)
+
+        retry_after = headers.get('retry-after')
+        if not retry_after:
+            return None
+        if retry_after.strip().isdigit():
+            return float(retry_after)
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_delay(attempt, response=None):
+    """Delay before retry number `attempt` (from 0), None when Retry-After asks for more than RETRY_MAX_DELAY"""
+    retry_after = get_retry_after(response.headers) if response is not None else None
+    if retry_after is not None:
+        return retry_after if retry_after <= RETRY_MAX_DELAY else None
+
+    # Full jitter, so the workers that failed together don't retry together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_connect_error(error):
+    """True when a requests error happened before the request was sent, so resending can't duplicate it
+
+    A dropped connection (e.g. RemoteDisconnected) is a ConnectionError too, but the
+    upstream may already have acted on the request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests wraps urllib3's MaxRetryError, whose reason is the original error
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def request_with_retries(upstream, send, max_retries=None, retry_statuses=RETRY_STATUSES):
+    """Response of `send()` (a requests call) sent through the upstream's limiter, retried on 429/5xx and failed connects
+
+    The last response is returned even if it still has a retryable status.
+    """
+    max_retries = UPSTREAM_MAX_RETRIES if max_retries is None else max_retries
+    limiter = get_limiter(upstream)
+
+    for attempt in range(max_retries + 1):
+        with limiter.slot():
+            try:
+                response = send()
+            except requests.ConnectionError as e:
+                # Only resent when it never left, read timeouts and dropped connections may have reached the upstream
+                if attempt == max_retries or not is_connect_error(e):
+                    raise
+                delay = get_retry_delay(attempt)
+                reason = type(e).__name__
+            else:
+                delay = get_retry_delay(attempt, response) if response.status_code in retry_statuses else None
+                if delay is None or attempt == max_retries:
+                    return response
+                reason = str(response.status_code)
+                response.close()
+
+        metrics.increment('upstream_retries_total', upstream=upstream, reason=reason)
+        time.sleep(delay)
+
+
+async def async_request_with_retries(upstream, send, max_retries=None, retry_statuses=RETRY_STATUSES):
+    """`request_with_retries` for httpx.AsyncClient calls, `send` returns an awaitable"""
+    max_retries = UPSTREAM_MAX_RETRIES if max_retries is None else max_retries
+    limiter = get_limiter(upstream)
+
+    for attempt in range(max_retries + 1):
+        async with limiter.async_slot():
+            try:
+                response = await send()
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt == max_retries:
+                    raise
+                delay = get_retry_delay(attempt)
+                reason = type(e).__name__
+            else:
+                delay = get_retry_delay(attempt, response) if response.status_code in retry_statuses else None
+                if delay is None or attempt == max_retries:
+                    return response
+                reason = str(response.status_code)
+                await response.aclose()
+
+        metrics.increment('upstream_retries_total', upstream=upstream, reason=reason)
+        await asyncio.sleep(delay)
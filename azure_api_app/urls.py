@@ -1,12 +1,19 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# Upstream-bound endpoints have async twins for ASGI deployments (ASYNC_VIEWS=true)
+upstream_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     path('scribe-simple-operation/', views.FineTuneModelOperation.as_view(), name='FineTuneModelOperation'),
-    path('chat-bot/completions/', views.ChatBotCompletion.as_view(), name='ChatBotCompletion'),
-    path('scribe/stripe/customer/get', views.StripeCustomerData.as_view(), name='StripeCustomerData'),
-    path('scribe/stripe/payment-methods/list', views.StripeListPaymentMethods.as_view(), name='StripeListPaymentMethods'),
-    path('scribe/stripe/billing-portal/sessions', views.StripeBillingPortalSessions.as_view(), name='StripeBillingPortalSessions'),
-    path('scribe/stripe/checkout/sessions', views.StripeCheckoutSessions.as_view(), name='StripeCheckoutSessions'),
-    path('scribe/stripe/subscription/cancel', views.StripeCancelSubscription.as_view(), name='StripeCancelSubscription'),
+    path('scribe-simple-operation/<uuid:job_id>/', views.ScribeJobStatus.as_view(), name='ScribeJobStatus'),
+    path('assemblyai/webhook/', views.AssemblyAIWebhook.as_view(), name='AssemblyAIWebhook'),
+    path('metrics', views.Metrics.as_view(), name='Metrics'),
+    path('chat-bot/completions/', upstream_views.ChatBotCompletion.as_view(), name='ChatBotCompletion'),
+    path('scribe/stripe/customer/get', upstream_views.StripeCustomerData.as_view(), name='StripeCustomerData'),
+    path('scribe/stripe/payment-methods/list', upstream_views.StripeListPaymentMethods.as_view(), name='StripeListPaymentMethods'),
+    path('scribe/stripe/billing-portal/sessions', upstream_views.StripeBillingPortalSessions.as_view(), name='StripeBillingPortalSessions'),
+    path('scribe/stripe/checkout/sessions', upstream_views.StripeCheckoutSessions.as_view(), name='StripeCheckoutSessions'),
+    path('scribe/stripe/subscription/cancel', upstream_views.StripeCancelSubscription.as_view(), name='StripeCancelSubscription'),
 ]
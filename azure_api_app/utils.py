@@ -2,8 +2,11 @@
 from rest_framework.response import Response
 from rest_framework import status
 
+# From django
+from django.http import JsonResponse
+
 # Other
-from datetime import datetime
+from functools import wraps
 
 # Logger
 import logging
@@ -17,7 +20,7 @@ def handle_exceptions(is_status=False):
             try:
                 return view_func(*args, **kwargs)
             except Exception as e:
-                logger.error(f'\n--------------------- ERROR ---------------------\n{datetime.now()}\n{str(e)}\n-------------------------------------------------\n')
+                logger.error('Request failed', extra={'view': view_func.__qualname__, 'error': str(e)})
                 if is_status:
                     return False
                 
@@ -30,4 +33,26 @@ def handle_exceptions(is_status=False):
         
         return wrapped_view
     
-    return decorator
\ No newline at end of file
+    return decorator
+
+
+def handle_async_exceptions():
+    """handle_exceptions for the async views, which return JsonResponse instead of DRF Response"""
+
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapped_view(*args, **kwargs):
+            try:
+                return await view_func(*args, **kwargs)
+            except Exception as e:
+                logger.error('Request failed', extra={'view': view_func.__qualname__, 'error': str(e)})
+                response = {
+                    "status": "error",
+                    "message": "Something went wrong..!",
+                    "error": str(e),
+                }
+                return JsonResponse(response, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        return wrapped_view
+    
+    return decorator
@@ -17,13 +17,41 @@ from azure_api_app.firebase_operation import FirebaseOperations
 
 # Stripe Operations
 from azure_api_app.stripe_operation import StripeOperation
+from azure_api_app.stripe_responses import (
+    CUSTOMER_ID_NOT_FOUND, PRICE_ID_NOT_FOUND, SUBSCRIPTION_ID_NOT_FOUND, SUBSCRIPTION_NOT_FOUND, error_response, get_required_value,
+    get_customer_data_response, get_payment_methods_response, get_billing_portal_session_response, get_checkout_session_response,
+    get_cancel_subscription_response,
+)
+
+# From assemblyai_operation
+from azure_api_app.assemblyai_operation import AssemblyAIOperation
+
+# Streaming upload
+from azure_api_app.upload_handlers import AssemblyAIStreamingUploadHandler
+
+# Chat completion cache
+from azure_api_app.completion_cache import get_cached_completion, cache_completion, CACHE_HEADER
+
+# Metrics
+from azure_api_app.metrics import render_prometheus
+
+# Tracing
+from azure_api_app.tracing import get_traceparent
+
+# Background jobs
+from azure_api_app import job_store
+from azure_api_app.job_executor import submit_scribe_job, JobQueueFull
+
+# From django
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 
 # Other
 import os
-import sys
+import hmac
+import hashlib
 import json
 import logging
-import subprocess
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -36,6 +64,9 @@ class FineTuneModelOperation(APIView):
         patient_name: name of the patient (string) -> Required
         visit_type: name of visit_type (string) -> Required
 
+    patient_name and visit_type can also be sent in the query string, which the
+    streaming upload mode needs to validate them before the audio is uploaded.
+
     Returns:
         DRF Response
     """
@@ -45,38 +76,71 @@ class FineTuneModelOperation(APIView):
     @handle_exceptions()
     def post(self, request, *args, **kwargs):
         user_id = request.user_id
+        firebase_ope_obj = FirebaseOperations(request.db)
+
+        # Streaming mode: the audio goes to Assembly AI while the request body is parsed. Only used when the
+        # query string carries patient_name and visit_type, so a request that fails validation uploads nothing
+        patient_name = request.query_params.get('patient_name', '').strip()
+        visit_type = request.query_params.get('visit_type', '').strip()
+        is_streaming_upload = settings.SCRIBE_STREAMING_UPLOAD and bool(patient_name and visit_type)
+        visit_sections = None
+        if is_streaming_upload:
+            visit_sections = firebase_ope_obj.get_visit_type_sections(visit_type, user_id)
+            if visit_sections is False:
+                return self.visit_type_not_exist(visit_type, user_id)
+            request.upload_handlers = [AssemblyAIStreamingUploadHandler(request)]
 
         # Get data
         file = request.FILES.get('file', None)
-        patient_name = request.data.get('patient_name', '').strip()
-        visit_type = request.data.get('visit_type', '').strip()
+        patient_name = patient_name or request.data.get('patient_name', '').strip()
+        visit_type = visit_type or request.data.get('visit_type', '').strip()
         if not file or not patient_name or not visit_type:
             info_message = f"File: {file}, Patient Name: {patient_name}, Visit Type: {visit_type}"
-            logger.error(f'\n------------- INFO (Data not received) -------------\n{datetime.now()}\n{info_message}\n--------------------------------------------------------------\n')
+            logger.warning('Data not received', extra={'detail': info_message})
             return Response({'error': 'File or patient name or visit type not provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Test if visit type exists in firebase or not ?
-        firebase_ope_obj = FirebaseOperations(request.db)
-        is_visit_exist = firebase_ope_obj.get_visit_type(visit_type, user_id)
-        if not is_visit_exist:
-            info_message = f"Visit Type: {visit_type}, User Id: {user_id}"
-            logger.error(f'\n------------- INFO (Visit type not exist) -------------\n{datetime.now()}\n{info_message}\n--------------------------------------------------------------\n')
-            return Response({'error': 'Visit type not exist..!'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Save the file to a temporary location 
-        file_path = self.save_file(file)
-        if not file_path:
-            logger.error(f'\n------------- INFO (File not saved) -------------\n{datetime.now()}\n\n--------------------------------------------------------------\n')
-            return Response({'error': 'Something Went Wrong..! Please, Try Again..!'}, status=status.HTTP_400_BAD_REQUEST)
-
-        env_path = "/root/scribe_engine_api/env" 
-        os.environ["PATH"] = f"{env_path}/bin:{os.environ['PATH']}"
-        sys.path.append(env_path)
-
-        # Call your background task using subprocess
-        subprocess.Popen(['python3', 'azure_api_app/task.py', f'{file_path},{patient_name},{user_id},{visit_type}'])
-        
-        return Response({"status": "success", "message": "Audio uploaded and process started successfully..!"}, status=status.HTTP_200_OK)
+        # Test if visit type exists in firebase or not ? (sections are handed to the job)
+        if visit_sections is None:
+            visit_sections = firebase_ope_obj.get_visit_type_sections(visit_type, user_id)
+            if visit_sections is False:
+                return self.visit_type_not_exist(visit_type, user_id)
+
+        if is_streaming_upload:
+            # Already uploaded to Assembly AI, nothing to save
+            file_path = ''
+            upload_url = file.upload_url
+            audio_sha256 = file.sha256
+            if not upload_url:
+                logger.warning('File not streamed')
+                return Response({'error': 'Something Went Wrong..! Please, Try Again..!'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            # Save the file to a temporary location (hashed on the way, for the transcript cache)
+            upload_url = ''
+            saved_file = self.save_file(file)
+            if not saved_file:
+                logger.warning('File not saved')
+                return Response({'error': 'Something Went Wrong..! Please, Try Again..!'}, status=status.HTTP_400_BAD_REQUEST)
+            file_path, audio_sha256 = saved_file
+
+        # Record the job durably, then hand it over to the warm worker pool, push back if it is saturated
+        job = job_store.create_job(user_id, patient_name, visit_type, file_path, upload_url, audio_sha256, visit_sections, get_traceparent(), file.size or 0)
+        try:
+            submit_scribe_job(job.id)
+        except JobQueueFull as e:
+            job_store.delete_job(job.id)
+            if file_path:
+                os.remove(file_path)
+            logger.warning('Job queue full', extra={'job_id': str(job.id), 'error': str(e)})
+            return Response({'error': 'Server is busy..! Please, Try Again Later..!'}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '30'})
+
+        return Response({"status": "success", "message": "Audio uploaded and process started successfully..!", "job_id": str(job.id)}, status=status.HTTP_200_OK)
+
+
+    @staticmethod
+    def visit_type_not_exist(visit_type, user_id):
+        info_message = f"Visit Type: {visit_type}, User Id: {user_id}"
+        logger.warning('Visit type not exist', extra={'detail': info_message})
+        return Response({'error': 'Visit type not exist..!'}, status=status.HTTP_400_BAD_REQUEST)
 
 
     @handle_exceptions(is_status=True)
@@ -100,11 +164,105 @@ class FineTuneModelOperation(APIView):
             
             counter += 1
 
+        audio_hash = hashlib.sha256()
         with open(file_path, 'wb') as destination:
             for chunk in file.chunks():
                 destination.write(chunk)
+                audio_hash.update(chunk)
 
-        return file_path
+        return file_path, audio_hash.hexdigest()
+
+
+class ScribeJobStatus(APIView):
+    """Current stage of a scribe job started by FineTuneModelOperation, read from the local job store.
+
+    Args:
+        job_id: id returned when the audio was uploaded (uuid) -> Required
+
+    Returns:
+        DRF Response
+    """
+
+    permission_classes = [FirebaseAuthorization]
+
+    @handle_exceptions()
+    def get(self, request, job_id, *args, **kwargs):
+        job = job_store.get_user_job(job_id, request.user_id)
+        if not job:
+            return Response({'status': 'error', 'message': "Job not found..!"}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(job.status_data(), status=status.HTTP_200_OK)
+
+
+class AssemblyAIWebhook(APIView):
+    """Called by Assembly AI when a transcript registered by a scribe job is completed or failed.
+
+    Args:
+        job_id: scribe job id (query param set when the webhook was registered) -> Required
+        transcript_id: Assembly AI transcript id -> Required
+        status: transcript status -> Required
+
+    Returns:
+        DRF Response
+    """
+
+    authentication_classes = []
+    permission_classes = []
+
+    @handle_exceptions()
+    def post(self, request, *args, **kwargs):
+        # Validate shared secret registered along with the webhook, jobs never register one without it
+        webhook_secret = settings.ASSEMBLY_AI_WEBHOOK_SECRET
+        received_secret = request.headers.get(AssemblyAIOperation.WEBHOOK_AUTH_HEADER, '')
+        if not webhook_secret or not hmac.compare_digest(received_secret, webhook_secret):
+            return Response({'status': 'error', 'message': "Invalid webhook secret..!"}, status=status.HTTP_403_FORBIDDEN)
+
+        job_id = request.query_params.get('job_id', '')
+        transcript_id = request.data.get('transcript_id', '')
+        job = job_store.get_transcript_job(job_id, transcript_id)
+        if not job:
+            return Response({'status': 'error', 'message': "Job not found..!"}, status=status.HTTP_404_NOT_FOUND)
+
+        if job.is_finished:
+            return Response({'status': 'success', 'message': "Job already finished..!"}, status=status.HTTP_200_OK)
+
+        # Resume the job, it fetches the finished transcript once and goes on with the GPT response
+        try:
+            future = submit_scribe_job(job.id, is_resume=True)
+        except JobQueueFull as e:
+            # Assembly AI retries failed webhooks and the job recovery picks it up otherwise
+            logger.warning('Job queue full', extra={'job_id': str(job.id), 'error': str(e)})
+            return Response({'status': 'error', 'message': "Server is busy..!"}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '30'})
+
+        if future is None:
+            # Still running (the transcript finished before the job handed itself to the webhook) or already resumed,
+            # a retried webhook resumes it in the first case and finds it running or finished in the second
+            return Response({'status': 'error', 'message': "Job is running..!"}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '30'})
+
+        return Response({'status': 'success', 'message': "Job resumed..!"}, status=status.HTTP_200_OK)
+
+
+class Metrics(APIView):
+    """Pipeline stage timings, counters and upstream latencies of every worker, in Prometheus text format.
+
+    Args:
+        Authorization: `Bearer <METRICS_TOKEN>` header -> Required, the view is closed while METRICS_TOKEN is unset
+
+    Returns:
+        text/plain Prometheus exposition
+    """
+
+    authentication_classes = []
+    permission_classes = []
+
+    @handle_exceptions()
+    def get(self, request, *args, **kwargs):
+        metrics_token = settings.METRICS_TOKEN
+        received_token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not metrics_token or not hmac.compare_digest(received_token, metrics_token):
+            return Response({'status': 'error', 'message': "Invalid metrics token..!"}, status=status.HTTP_403_FORBIDDEN)
+
+        return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class ChatBotCompletion(APIView):
@@ -115,6 +273,7 @@ class ChatBotCompletion(APIView):
         messages: Message list (required)
         temperature: temperature value for gpt model
         presence_penalty: presence penalty value
+        stream: `true` to relay the completion as server-sent events while it is generated
 
     Returns:
         Response return by GPT model
@@ -129,6 +288,7 @@ class ChatBotCompletion(APIView):
         messages = json.loads(request.data.get('messages', []))  # Required
         temperature = float(request.data.get('temperature', 0.8))
         presence_penalty = float(request.data.get('presence_penalty', 0))
+        is_stream = str(request.data.get('stream', '')).strip().lower() == 'true'
 
         # Validation
         if (not model) or (not messages):
@@ -141,16 +301,38 @@ class ChatBotCompletion(APIView):
             "temperature": temperature,
             "presence_penalty": presence_penalty,
         }
-        payload = json.dumps(payload, indent=2)
         open_ai_object = OpenAIOperation()
-        res_status, response = open_ai_object.generate_gpt_response(payload=payload)
+
+        if is_stream:
+            return self.stream_response(open_ai_object, payload)
+
+        # Repeated deterministic requests are answered from the cache
+        cached_response = get_cached_completion(payload)
+        if cached_response is not None:
+            return Response(cached_response, status=status.HTTP_200_OK, headers={CACHE_HEADER: 'HIT'})
+
+        res_status, response = open_ai_object.generate_gpt_response(payload=json.dumps(payload, indent=2))
 
         # Return response
         if not res_status:
             return Response({'status': 'error', 'message': response or "Something Went Wrong..! Response Not Generated..!"}, 
                             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return Response(response, status=status.HTTP_200_OK)
+        cache_completion(payload, response)
+        return Response(response, status=status.HTTP_200_OK, headers={CACHE_HEADER: 'MISS'})
+
+
+    def stream_response(self, open_ai_object, payload):
+        payload["stream"] = True
+        res_status, response = open_ai_object.open_gpt_stream(json.dumps(payload))
+        if not res_status:
+            return Response({'status': 'error', 'message': response or "Something Went Wrong..! Response Not Generated..!"}, 
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        streaming_response = StreamingHttpResponse(open_ai_object.iter_gpt_stream(response), content_type='text/event-stream')
+        streaming_response['Cache-Control'] = 'no-cache'
+        streaming_response['X-Accel-Buffering'] = 'no'
+        return streaming_response
     
 
 class StripeCustomerData(APIView):
@@ -159,33 +341,15 @@ class StripeCustomerData(APIView):
 
     @handle_exceptions()
     def get(self, request, *args, **kwargs):
-        user_id = request.user_id
-        
         # Get customer_id of stripe from firebase
         firebase_ope_obj = FirebaseOperations(request.db)
-        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(user_id)
-        
-        # Validation for stripe_customer_id
+        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(request.user_id)
         if not stripe_customer_id:
-            return Response({'status': 'error', 'message': "Stripe customer id not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Get customer data using stripe_customer_id
-        stripe_operation_obj = StripeOperation()
-        customer_data = stripe_operation_obj.get_customer_data(stripe_customer_id)
-        response_data = {'customer_data': customer_data}
-       
-        # Validation for customer data found or not 
-        if not customer_data:
-            return Response({'status': 'error', 'message': "Stripe customer data not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Retrieve default payment method data
-        default_payment_method = customer_data.get('invoice_settings', {}).get('default_payment_method', '')
-        if default_payment_method:
-            default_payment_method_data = stripe_operation_obj.retrieve_payment_method_data(default_payment_method)
-            response_data.update({'default_payment_method': default_payment_method_data})
+            return Response(**error_response(CUSTOMER_ID_NOT_FOUND))
 
-        # Return success response
-        return Response(response_data, status=status.HTTP_200_OK)
+        # Get customer data (default payment method expanded in the same call) using stripe_customer_id
+        customer_data = StripeOperation().get_customer_data(stripe_customer_id, expand_payment_method=True)
+        return Response(**get_customer_data_response(customer_data))
 
 
 class StripeListPaymentMethods(APIView):
@@ -194,26 +358,14 @@ class StripeListPaymentMethods(APIView):
 
     @handle_exceptions()
     def get(self, request, *args, **kwargs):
-        user_id = request.user_id
-        
         # Get customer_id of stripe from firebase
         firebase_ope_obj = FirebaseOperations(request.db)
-        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(user_id)
-        
-        # Validation for stripe_customer_id
+        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(request.user_id)
         if not stripe_customer_id:
-            return Response({'status': 'error', 'message': "Stripe customer id not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Get customer data using stripe_customer_id
-        stripe_operation_obj = StripeOperation()
-        payment_method_data = stripe_operation_obj.get_payment_methods(stripe_customer_id)
-       
-        # Validation for customer data found or not 
-        if not payment_method_data:
-            return Response({'status': 'error', 'message': "Stripe customer payment methods not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Return success response
-        return Response(payment_method_data, status=status.HTTP_200_OK)
+            return Response(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        payment_method_data = StripeOperation().get_payment_methods(stripe_customer_id)
+        return Response(**get_payment_methods_response(payment_method_data))
 
 
 class StripeBillingPortalSessions(APIView):
@@ -222,26 +374,14 @@ class StripeBillingPortalSessions(APIView):
 
     @handle_exceptions()
     def get(self, request, *args, **kwargs):
-        user_id = request.user_id
-        
         # Get customer_id of stripe from firebase
         firebase_ope_obj = FirebaseOperations(request.db)
-        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(user_id)
-        
-        # Validation for stripe_customer_id
+        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(request.user_id)
         if not stripe_customer_id:
-            return Response({'status': 'error', 'message': "Stripe customer id not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Get customer data using stripe_customer_id
-        stripe_operation_obj = StripeOperation()
-        billing_portal_session_data = stripe_operation_obj.get_billing_portal_session(stripe_customer_id)
-       
-        # Validation for customer data found or not 
-        if not billing_portal_session_data:
-            return Response({'status': 'error', 'message': "Stripe billing portal session not created ..!"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Return success response
-        return Response(billing_portal_session_data, status=status.HTTP_200_OK)
+            return Response(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        billing_portal_session_data = StripeOperation().get_billing_portal_session(stripe_customer_id)
+        return Response(**get_billing_portal_session_response(billing_portal_session_data))
 
 
 class StripeCheckoutSessions(APIView):
@@ -250,32 +390,18 @@ class StripeCheckoutSessions(APIView):
 
     @handle_exceptions()
     def post(self, request, *args, **kwargs):
-        user_id = request.user_id
-        price_id = request.data.get('price_id', '').strip() # Required
-
-        # Validation
+        price_id = get_required_value(request.data, 'price_id') # Required
         if not price_id:
-            return Response({'status': 'error', 'message': "Price id not found..!"}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(**error_response(PRICE_ID_NOT_FOUND))
 
         # Get customer_id of stripe from firebase
         firebase_ope_obj = FirebaseOperations(request.db)
-        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(user_id)
-        
-        # Validation for stripe_customer_id
+        stripe_customer_id = firebase_ope_obj.get_stripe_customer_id(request.user_id)
         if not stripe_customer_id:
-            return Response({'status': 'error', 'message': "Stripe customer id not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Get checkout session data using stripe_customer_id and price id
-        stripe_operation_obj = StripeOperation()
-        checkout_session_data = stripe_operation_obj.checkout_session(stripe_customer_id, price_id)
-       
-        # Validation for checkout session data found or not 
-        if not checkout_session_data:
-            return Response({'status': 'error', 'message': "Checkout session data not found ..!"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Return success response
-        return Response(checkout_session_data, status=status.HTTP_200_OK)
-    
+            return Response(**error_response(CUSTOMER_ID_NOT_FOUND))
+
+        checkout_session_data = StripeOperation().checkout_session(stripe_customer_id, price_id)
+        return Response(**get_checkout_session_response(checkout_session_data))
 
 
 class StripeCancelSubscription(APIView):
@@ -284,26 +410,14 @@ class StripeCancelSubscription(APIView):
 
     @handle_exceptions()
     def post(self, request, *args, **kwargs):
-        user_id = request.user_id
-        subscription_id = request.data.get('subscription_id', '').strip() # Required
-
-        # Validation
+        subscription_id = get_required_value(request.data, 'subscription_id') # Required
         if not subscription_id:
-            return Response({'status': 'error', 'message': "Subscription id not found..!"}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(**error_response(SUBSCRIPTION_ID_NOT_FOUND))
 
-        # Check user has subscription with  provided subscription id ?
+        # Check user has subscription with provided subscription id
         firebase_ope_obj = FirebaseOperations(request.db)
-        is_active_subscription = firebase_ope_obj.check_subscription(user_id, subscription_id)
-        
-        # Validation for user has subscription with provided id or not
-        if not is_active_subscription:
-            return Response({'status': 'error', 'message': "User has not subscription with this id..!"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Cancel customer stripe subscription
-        stripe_operation_obj = StripeOperation()
-        cancel_subscription_data = stripe_operation_obj.cancel_subscription(subscription_id)
-       
-        if cancel_subscription_data and cancel_subscription_data['status'] == 'canceled':
-            return Response({'status': 'success', 'message': 'Subscription successfully canceled..!', 'data': cancel_subscription_data}, status=status.HTTP_200_OK)
-        return Response({'status': 'error', 'message': "Something went wrong..! Can't able to cancel subscription..!", 'data': cancel_subscription_data}, status=status.HTTP_400_BAD_REQUEST)
-        
\ No newline at end of file
+        if not firebase_ope_obj.check_subscription(request.user_id, subscription_id):
+            return Response(**error_response(SUBSCRIPTION_NOT_FOUND))
+
+        cancel_subscription_data = StripeOperation().cancel_subscription(subscription_id)
+        return Response(**get_cancel_subscription_response(cancel_subscription_data))
@@ -1,38 +1,169 @@
-from openai import OpenAI
+# Shared connection pools
+from azure_api_app.http_client import get_openai_client
+
+# Fallback counters
+from azure_api_app import metrics
+
+# Tracing
+from azure_api_app.tracing import trace_methods, in_current_context
+
+# Upstream concurrency and rate limit
+from azure_api_app.upstream_limiter import get_limiter
 
 # Other
 import os
-from datetime import datetime
+import re
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # Logger
 import logging
 logger = logging.getLogger(__name__)
 
+@trace_methods(exclude=('plan_chunks', 'merge_segments'))
 class WhisperAIOperation:
-    
+
+    # Chunked mode: long recordings are cut into overlapping windows (at silences when possible) and transcribed concurrently
+    CHUNK_SECONDS = float(os.environ.get('WHISPER_CHUNK_SECONDS', 600))
+    CHUNK_OVERLAP_SECONDS = float(os.environ.get('WHISPER_CHUNK_OVERLAP_SECONDS', 5))
+    SILENCE_SEARCH_SECONDS = float(os.environ.get('WHISPER_SILENCE_SEARCH_SECONDS', 30))
+    CONCURRENCY = int(os.environ.get('WHISPER_CONCURRENCY', 4))
+
+    FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+    FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+
     def __init__(self):
-        OPENAI_KEY = os.environ.get('OPENAI_KEY')
-        self.client = OpenAI(api_key=OPENAI_KEY)
+        self.client = get_openai_client()
+
 
-    
     def generate_transcription(self, audio_file_path):
         try:
-            audio_file = open(audio_file_path, "rb")
-            
-            transcript = self.client.audio.transcriptions.create(
-                                model="whisper-1",
-                                file=audio_file,
-                                response_format='verbose_json',
-                                language='en',
-                                temperature=0.3,
-                                prompt='correct all pronunciation, grammar, and spelling mistakes.'
-                            )
+            # The SDK retries by itself, the limiter only holds the request to the openai quota
+            with open(audio_file_path, "rb") as audio_file, get_limiter('openai').slot():
+                transcript = self.client.audio.transcriptions.create(
+                                    model="whisper-1",
+                                    file=audio_file,
+                                    response_format='verbose_json',
+                                    language='en',
+                                    temperature=0.3,
+                                    prompt='correct all pronunciation, grammar, and spelling mistakes.'
+                                )
             if transcript:
                 # return transcript.text
                 return transcript.segments
             return False
         except Exception as e:
-            logger.error(f'\n--------------------- ERROR (whisper ai) ---------------------\n{datetime.now()}\n{str(e)}\n--------------------------------------------------------------\n')
+            logger.error('Whisper ai failed', extra={'error': str(e)})
+            return False
+
+
+    def generate_chunked_transcription(self, audio_file_path):
+        """Transcribe long audio as concurrent overlapping chunks and merge the segments into one timeline.
+
+        Falls back to a single request for short audio or when ffmpeg/ffprobe are not installed.
+        """
+        try:
+            if not shutil.which(self.FFMPEG_BINARY) or not shutil.which(self.FFPROBE_BINARY):
+                metrics.increment('scribe_fallbacks_total', kind='whisper_without_ffmpeg')
+                return self.generate_transcription(audio_file_path)
+
+            duration = self.get_audio_duration(audio_file_path)
+            if duration <= self.CHUNK_SECONDS + self.CHUNK_OVERLAP_SECONDS:
+                return self.generate_transcription(audio_file_path)
+
+            silences = self.detect_silences(audio_file_path)
+            chunks = self.plan_chunks(duration, silences)
+
+            with tempfile.TemporaryDirectory(prefix='whisper_chunks_') as chunk_directory:
+                def transcribe_chunk(index_chunk):
+                    index, (start, end, _owned_start, _owned_end) = index_chunk
+                    chunk_path = os.path.join(chunk_directory, f"chunk_{index}.mp3")
+                    self.cut_chunk(audio_file_path, start, end, chunk_path)
+                    return self.generate_transcription(chunk_path)
+
+                with ThreadPoolExecutor(max_workers=self.CONCURRENCY, thread_name_prefix='whisper') as executor:
+                    chunk_segments = list(executor.map(in_current_context(transcribe_chunk), enumerate(chunks)))
+
+            if not all(chunk_segments):
+                return False
+            return self.merge_segments(chunks, chunk_segments)
+        except Exception as e:
+            logger.error('Whisper ai chunked failed', extra={'error': str(e)})
             return False
-    
 
+
+    def get_audio_duration(self, audio_file_path):
+        output = subprocess.run(
+            [self.FFPROBE_BINARY, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', audio_file_path],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        return float(output.strip())
+
+
+    def detect_silences(self, audio_file_path):
+        """Midpoints (seconds) of the silent stretches ffmpeg finds in the audio"""
+        output = subprocess.run(
+            [self.FFMPEG_BINARY, '-hide_banner', '-nostats', '-i', audio_file_path, '-af', 'silencedetect=noise=-35dB:d=0.5', '-f', 'null', '-'],
+            capture_output=True, text=True,
+        ).stderr
+
+        starts = [float(value) for value in re.findall(r'silence_start: (-?[\d.]+)', output)]
+        ends = [float(value) for value in re.findall(r'silence_end: ([\d.]+)', output)]
+        return [(start + end) / 2 for start, end in zip(starts, ends)]
+
+
+    def plan_chunks(self, duration, silences):
+        """(start, end, owned_start, owned_end) windows; each cut lands on the last silence before its target time.
+
+        Windows overlap by CHUNK_OVERLAP_SECONDS on each side of a cut, and every
+        segment is later kept only by the chunk that owns its midpoint.
+        """
+        cut_points = []
+        previous_cut = 0
+        while duration - previous_cut > self.CHUNK_SECONDS:
+            target = previous_cut + self.CHUNK_SECONDS
+            candidates = [point for point in silences if target - self.SILENCE_SEARCH_SECONDS <= point <= target]
+            cut = candidates[-1] if candidates else target
+            cut_points.append(cut)
+            previous_cut = cut
+
+        boundaries = [0] + cut_points + [duration]
+        chunks = []
+        for owned_start, owned_end in zip(boundaries, boundaries[1:]):
+            start = max(owned_start - self.CHUNK_OVERLAP_SECONDS, 0)
+            end = min(owned_end + self.CHUNK_OVERLAP_SECONDS, duration)
+            chunks.append((start, end, owned_start, owned_end))
+        return chunks
+
+
+    def cut_chunk(self, audio_file_path, start, end, chunk_path):
+        # Re-encoded to small mono mp3, well below the whisper upload limit
+        subprocess.run(
+            [self.FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', '-ss', f'{start:.3f}', '-t', f'{end - start:.3f}',
+             '-i', audio_file_path, '-ac', '1', '-ar', '16000', '-b:a', '32k', chunk_path],
+            check=True,
+        )
+
+
+    @staticmethod
+    def merge_segments(chunks, chunk_segments):
+        """Shift chunk segments onto the recording timeline and drop the duplicates from the overlaps"""
+        merged_segments = []
+        for (start, _end, owned_start, owned_end), segments in zip(chunks, chunk_segments):
+            for segment in sorted(segments, key=lambda x: x["start"]):
+                segment_start = segment["start"] + start
+                segment_end = segment["end"] + start
+                midpoint = (segment_start + segment_end) / 2
+                if not owned_start <= midpoint < owned_end:
+                    continue
+
+                merged_segments.append({
+                    **segment,
+                    "id": len(merged_segments),
+                    "start": segment_start,
+                    "end": segment_end,
+                })
+
+        return merged_segments
@@ -0,0 +1,294 @@
+"""End-to-end load test of /scribe-simple-operation/ and /chat-bot/completions/ against local upstream stubs.
+
+Boots the API under gunicorn with every upstream pointed at benchmarks/stubs.py
+(AssemblyAI, OpenAI, Stripe, Google token) and Firestore pointed at the
+Firestore emulator, runs concurrent upload and chat workloads side by side and
+prints latency percentiles, throughput and the peak RSS of the server's
+process tree (web workers plus scribe job workers):
+
+    gcloud emulators firestore start --host-port=127.0.0.1:8080 &
+    FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 python benchmarks/load_test.py --uploads 100 --chats 2000
+
+Without a Firestore emulator only the chat workload runs. Upstream behaviour is
+set per upstream, e.g. `--assemblyai-latency 2 --openai-error-rate 0.05`.
+Nothing is sent to the real services and the job store is a throwaway SQLite file.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import httpx
+
+from stubs import start_stub_server, write_service_account, mint_id_token
+from serving_modes import MODES, BASE_DIR, PROJECT_ID, free_port, server_env, start_api, percentile
+
+USER_ID = 'bench-user'
+VISIT_TYPE = 'Bench visit'
+VISIT_SECTIONS = [
+    {'title': 'Subjective', 'body_text': 'Symptoms and history as described by the patient.'},
+    {'title': 'Objective', 'body_text': 'Findings of the examination.'},
+    {'title': 'Assessment', 'body_text': 'Diagnosis and differential.'},
+    {'title': 'Plan', 'body_text': 'Treatment and follow up.'},
+]
+
+
+def load_test_env(args, stub_url, credentials_file, work_dir, api_port):
+    env = server_env(stub_url, credentials_file, args.mode == 'async')
+    env.update({
+        'ASSEMBLY_AI_BASE_URL': f'{stub_url}/v2',
+        'ASSEMBLY_AI_TOKEN': 'stub',
+        'STRIPE_API_BASE': f'{stub_url}/stripe',
+        'STRIPE_API_KEY': 'sk_test_stub',
+        'SQLITE_PATH': os.path.join(work_dir, 'db.sqlite3'),
+        'TRANSCRIPT_CACHE_DIR': os.path.join(work_dir, 'transcript_cache'),
+    })
+
+    # Without an emulator the stub host keeps the Firestore client offline (the chat workload never reads it)
+    if args.firestore_emulator:
+        env['FIRESTORE_EMULATOR_HOST'] = args.firestore_emulator
+
+    if args.webhook:
+        env['ASSEMBLY_AI_WEBHOOK_URL'] = f'http://127.0.0.1:{api_port}/assemblyai/webhook/'
+        env['ASSEMBLY_AI_WEBHOOK_SECRET'] = 'bench-secret'
+    return env
+
+
+def migrate(env):
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '--noinput'], cwd=BASE_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def seed_firestore(emulator_host):
+    """User with enough add-on balance for every job, and the visit type the uploads use"""
+    os.environ['FIRESTORE_EMULATOR_HOST'] = emulator_host
+    from google.cloud import firestore
+
+    db = firestore.Client(project=PROJECT_ID)
+    user_ref = db.collection('users').document(USER_ID)
+    user_ref.set({
+        'add_on_balance': 10 ** 6,
+        'remaining_trials': 0,
+        'stripeId': 'cus_bench',
+        'auto_pay': {'enable_auto_pay': False, 'threshold': 0, 'credit': 0},
+    })
+    user_ref.collection('visits').document('bench-visit').set({'name': VISIT_TYPE, 'sections': VISIT_SECTIONS})
+
+
+class RSSSampler:
+    """Peak resident memory of a process and all its descendants, sampled from /proc"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='rss-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak_bytes
+
+    def run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, sum(self.get_rss(pid) for pid in self.get_process_tree()))
+            self._stop.wait(self.interval)
+
+    def get_process_tree(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as file:
+                    # ppid is the 2nd field after the parenthesised command name
+                    parent_pid = int(file.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent_pid, []).append(int(entry))
+
+        tree, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            tree.append(pid)
+            pending.extend(children.get(pid, []))
+        return tree
+
+    @staticmethod
+    def get_rss(pid):
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+
+class WorkloadResult:
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.completed = 0
+        self.elapsed = 0
+
+
+async def run_chat_workload(client, base_url, headers, concurrency, total_requests):
+    result = WorkloadResult('chat')
+    semaphore = asyncio.Semaphore(concurrency)
+    data = {'model': 'gpt-3.5-turbo', 'messages': '[{"role": "user", "content": "Hello"}]', 'temperature': '0.8'}
+
+    async def one_request():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(f'{base_url}/chat-bot/completions/', data=data, headers=headers)
+                if response.status_code != 200:
+                    result.errors += 1
+            except httpx.HTTPError:
+                result.errors += 1
+            result.latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(total_requests)))
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+async def run_upload_workload(client, base_url, headers, concurrency, total_uploads, audio_bytes, job_timeout):
+    """Upload request latency, and time until the job is billed (end to end) per upload"""
+    upload_result = WorkloadResult('upload')
+    job_result = WorkloadResult('job')
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_upload():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # Distinct content per upload, the transcript cache would answer repeats
+                files = {'file': ('visit.mp3', os.urandom(audio_bytes), 'audio/mpeg')}
+                data = {'patient_name': 'Bench Patient', 'visit_type': VISIT_TYPE}
+                response = await client.post(f'{base_url}/scribe-simple-operation/', data=data, files=files, headers=headers)
+                upload_result.latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    upload_result.errors += 1
+                    return
+                job_id = response.json()['job_id']
+            except httpx.HTTPError:
+                upload_result.errors += 1
+                return
+
+        deadline = start + job_timeout
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(0.5)
+            try:
+                response = await client.get(f'{base_url}/scribe-simple-operation/{job_id}/', headers=headers)
+                job_status = response.json()
+            except (httpx.HTTPError, ValueError):
+                continue
+            if job_status.get('is_finished'):
+                job_result.latencies.append(time.perf_counter() - start)
+                if job_status.get('stage') == 'billed':
+                    job_result.completed += 1
+                else:
+                    job_result.errors += 1
+                return
+        job_result.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_upload() for _ in range(total_uploads)))
+    upload_result.elapsed = job_result.elapsed = time.perf_counter() - start
+    return upload_result, job_result
+
+
+async def run_workloads(args, base_url, token):
+    headers = {'Authorization': f'Bearer {token}'}
+    limits = httpx.Limits(max_connections=args.chat_concurrency + args.upload_concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        workloads = []
+        if args.chats:
+            workloads.append(run_chat_workload(client, base_url, headers, args.chat_concurrency, args.chats))
+        if args.uploads and args.firestore_emulator:
+            workloads.append(run_upload_workload(client, base_url, headers, args.upload_concurrency, args.uploads,
+                                                 args.audio_kb * 1024, args.job_timeout))
+
+        results = []
+        for workload_result in await asyncio.gather(*workloads):
+            results.extend(workload_result if isinstance(workload_result, tuple) else [workload_result])
+        return results
+
+
+def print_report(results, peak_rss):
+    print(f"{'workload':<8} {'count':>6} {'errors':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'throughput':>14}")
+    for result in results:
+        if not result.latencies:
+            print(f"{result.name:<8} {0:>6} {result.errors:>7}")
+            continue
+
+        throughput = f"{result.completed / result.elapsed * 60:.1f} jobs/min" if result.name == 'job' else f"{len(result.latencies) / result.elapsed:.1f} req/s"
+        print(f"{result.name:<8} {len(result.latencies):>6} {result.errors:>7} {percentile(result.latencies, 50):>7.2f}s "
+              f"{percentile(result.latencies, 95):>7.2f}s {percentile(result.latencies, 99):>7.2f}s {throughput:>14}")
+    print(f"peak RSS (server process tree): {peak_rss / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='sync', choices=list(MODES))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--uploads', type=int, default=50)
+    parser.add_argument('--upload-concurrency', type=int, default=10)
+    parser.add_argument('--audio-kb', type=int, default=512, help='size of each uploaded recording')
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--chat-concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.5, help='default stub upstream latency in seconds')
+    parser.add_argument('--transcript-seconds', type=float, default=5, help='time a stub transcript stays processing')
+    parser.add_argument('--webhook', action='store_true', help='use the Assembly AI webhook instead of polling')
+    parser.add_argument('--firestore-emulator', default=os.environ.get('FIRESTORE_EMULATOR_HOST', ''), help='host:port of the Firestore emulator')
+    for upstream in ('openai', 'assemblyai', 'stripe'):
+        parser.add_argument(f'--{upstream}-latency', type=float, default=None)
+        parser.add_argument(f'--{upstream}-error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    latencies = {upstream: getattr(args, f'{upstream}_latency') for upstream in ('openai', 'assemblyai', 'stripe') if getattr(args, f'{upstream}_latency') is not None}
+    error_rates = {upstream: getattr(args, f'{upstream}_error_rate') for upstream in ('openai', 'assemblyai', 'stripe')}
+    stub = start_stub_server(latency=args.latency, latencies=latencies, error_rates=error_rates, transcript_seconds=args.transcript_seconds)
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+
+    work_dir = tempfile.mkdtemp(prefix='scribe-load-test-')
+    credentials_file = write_service_account(os.path.join(work_dir, 'serviceAccountKey.json'), PROJECT_ID, f'{stub_url}/token')
+    token = mint_id_token(PROJECT_ID, USER_ID)
+
+    if args.firestore_emulator:
+        seed_firestore(args.firestore_emulator)
+    elif args.uploads:
+        print('No Firestore emulator (--firestore-emulator / FIRESTORE_EMULATOR_HOST), skipping the upload workload')
+
+    api_port = free_port()
+    env = load_test_env(args, stub_url, credentials_file, work_dir, api_port)
+    migrate(env)
+    process = start_api(args.mode, api_port, args.workers, env)
+    sampler = RSSSampler(process.pid).start()
+    try:
+        results = asyncio.run(run_workloads(args, f'http://127.0.0.1:{api_port}', token))
+    finally:
+        peak_rss = sampler.stop()
+        process.terminate()
+        process.wait()
+
+    print_report(results, peak_rss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Compare the sync (WSGI) and async (ASGI) serving modes on /chat-bot/completions/.
+
+Boots the API under gunicorn twice against a stub OpenAI server with a fixed
+upstream latency, fires the same concurrent load at each and prints latency
+percentiles and throughput:
+
+    python benchmarks/serving_modes.py --workers 4 --concurrency 200 --requests 2000 --latency 1.0
+
+sync:  gunicorn azure_api.wsgi (sync workers), ASYNC_VIEWS=false
+async: gunicorn azure_api.asgi -k uvicorn.workers.UvicornWorker, ASYNC_VIEWS=true
+
+Firebase runs in emulator mode (unsigned ID tokens) with a throwaway service account.
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+from stubs import start_stub_server, write_service_account, mint_id_token
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_ID = 'scribegenie-bench'
+
+MODES = {
+    'sync': ['azure_api.wsgi:application'],
+    'async': ['azure_api.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_env(stub_url, credentials_file, is_async):
+    stub_host = stub_url.replace('http://', '')
+    return {
+        **os.environ,
+        'SECRET_KEY': 'benchmark',
+        'SERVERNAMES': '127.0.0.1,localhost',
+        'OPENAI_KEY': 'stub',
+        'OPENAI_BASE_URL': f'{stub_url}/v1',
+        'FIREBASE_CREDENTIALS_FILE': credentials_file,
+        'FIREBASE_AUTH_EMULATOR_HOST': stub_host,
+        'FIRESTORE_EMULATOR_HOST': stub_host,
+        'ASYNC_VIEWS': 'true' if is_async else 'false',
+        # The stubs have no quota: measure the server, not the upstream limiter, and keep each run's slots and buckets apart
+        'OPENAI_MAX_CONCURRENCY': '0',
+        'OPENAI_REQUESTS_PER_MINUTE': '0',
+        'ASSEMBLY_AI_MAX_CONCURRENCY': '0',
+        'ASSEMBLY_AI_REQUESTS_PER_MINUTE': '0',
+        'UPSTREAM_LIMIT_DIR': tempfile.mkdtemp(prefix='scribe-upstream-limits-'),
+    }
+
+
+def start_api(mode, port, workers, env):
+    command = [sys.executable, '-m', 'gunicorn', *MODES[mode], '-w', str(workers), '-b', f'127.0.0.1:{port}', '--timeout', '120']
+    process = subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+async def run_load(url, token, concurrency, total_requests):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    data = {'model': 'gpt-3.5-turbo', 'messages': '[{"role": "user", "content": "Hello"}]', 'temperature': '0'}
+    headers = {'Authorization': f'Bearer {token}'}
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, data=data, headers=headers)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(total_requests)))
+        elapsed = time.perf_counter() - start
+
+    return latencies, errors, elapsed
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100)[pct - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=1.0, help='stub upstream latency in seconds')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    stub = start_stub_server(latency=args.latency)
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+    credentials_file = write_service_account(os.path.join(tempfile.mkdtemp(), 'serviceAccountKey.json'), PROJECT_ID, f'{stub_url}/token')
+    token = mint_id_token(PROJECT_ID, 'bench-user')
+
+    print(f"{'mode':<6} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}")
+    for mode in args.modes:
+        port = free_port()
+        process = start_api(mode, port, args.workers, server_env(stub_url, credentials_file, mode == 'async'))
+        try:
+            url = f'http://127.0.0.1:{port}/chat-bot/completions/'
+            latencies, errors, elapsed = asyncio.run(run_load(url, token, args.concurrency, args.requests))
+        finally:
+            process.terminate()
+            process.wait()
+
+        print(f"{mode:<6} {len(latencies) / elapsed:>8.1f} {percentile(latencies, 50):>7.2f}s "
+              f"{percentile(latencies, 95):>7.2f}s {percentile(latencies, 99):>7.2f}s {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
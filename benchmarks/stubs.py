@@ -0,0 +1,336 @@
+"""Local stand-ins for the upstream APIs, so benchmarks run without real accounts or spend.
+
+One threaded HTTP server answers every stubbed route. Each upstream gets its own
+latency (seconds slept before answering) and error rate (share of requests
+answered with 503 + Retry-After), defaulting to `latency` and 0:
+
+    OPENAI_BASE_URL=http://127.0.0.1:<port>/v1           chat completions (JSON mode, SSE streams) and audio
+    ASSEMBLY_AI_BASE_URL=http://127.0.0.1:<port>/v2      upload, transcript, polling and webhooks
+    STRIPE_API_BASE=http://127.0.0.1:<port>/stripe       customers, payment methods/intents, sessions, subscriptions
+    token_uri of the generated service account -> http://127.0.0.1:<port>/token
+
+Firestore is not stubbed here, point FIRESTORE_EMULATOR_HOST at the Firestore emulator.
+"""
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import threading
+import urllib.request
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+UPSTREAMS = ('google', 'openai', 'assemblyai', 'stripe')
+
+STUB_TRANSCRIPT = [
+    ('A', "Good morning, what brings you in today?"),
+    ('B', "I've had a sore throat and a mild fever for three days."),
+    ('A', "Any cough or trouble swallowing?"),
+    ('B', "A dry cough, swallowing hurts a little."),
+    ('A', "Your throat is red, no white patches. Rest, fluids, and come back if the fever lasts past the weekend."),
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        # Streamed uploads (AssemblyAIOperation.upload_stream) arrive chunked
+        if 'chunked' in (self.headers.get('Transfer-Encoding') or '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def read_json(self):
+        body = self.read_body()
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            return {}
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_upstream(self, path):
+        if path == '/token':
+            return 'google'
+        if path.startswith('/v1/'):
+            return 'openai'
+        if path.startswith('/v2/'):
+            return 'assemblyai'
+        if path.startswith('/stripe/'):
+            return 'stripe'
+        return None
+
+    def handle_request(self, method):
+        path = urlparse(self.path).path
+        upstream = self.get_upstream(path)
+
+        # Uploads are read whole before the simulated latency starts, like a real upstream
+        body = self.read_json() if 'json' in (self.headers.get('Content-Type') or '') else self.read_body()
+        time.sleep(self.server.latencies.get(upstream, self.server.latency))
+
+        if upstream and random.random() < self.server.error_rates.get(upstream, 0):
+            return self.send_json({'error': {'message': f'Stub {upstream} error'}}, status=503, headers={'Retry-After': '1'})
+
+        route = getattr(self, f'{upstream}_{method.lower()}', None) if upstream else None
+        if route is None:
+            return self.send_json({'error': {'message': f'No stub for {method} {path}'}}, status=404)
+        return route(path, body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    # Google OAuth (service account token refresh)
+    def google_post(self, path, body):
+        return self.send_json({'access_token': 'stub-access-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    # OpenAI
+    def openai_post(self, path, body):
+        if path == '/v1/chat/completions':
+            if body.get('stream'):
+                return self.send_chat_stream(body)
+            return self.send_json(chat_completion(body))
+
+        if path == '/v1/audio/transcriptions':
+            return self.send_json(whisper_transcription())
+
+        return self.send_json({'error': {'message': f'No stub for POST {path}'}}, status=404)
+
+    def send_chat_stream(self, payload):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        for word in ['Stub ', 'streamed ', 'completion.']:
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'model': payload.get('model', 'stub'),
+                     'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b'')
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    # Assembly AI
+    def assemblyai_post(self, path, body):
+        base_url = f'http://{self.headers.get("Host")}/v2'
+
+        if path == '/v2/upload':
+            return self.send_json({'upload_url': f'{base_url}/files/{uuid.uuid4().hex}'})
+
+        if path == '/v2/transcript':
+            transcript_id = uuid.uuid4().hex
+            with self.server.transcripts_lock:
+                self.server.transcripts[transcript_id] = time.monotonic() + self.server.transcript_seconds
+
+            webhook_url = body.get('webhook_url')
+            if webhook_url:
+                send_webhook_later(self.server.transcript_seconds, webhook_url, transcript_id,
+                                   body.get('webhook_auth_header_name'), body.get('webhook_auth_header_value'))
+            return self.send_json({'id': transcript_id, 'status': 'queued'})
+
+        return self.send_json({'error': f'No stub for POST {path}'}, status=404)
+
+    def assemblyai_get(self, path, body):
+        transcript_id = path.rsplit('/', 1)[-1]
+        with self.server.transcripts_lock:
+            ready_at = self.server.transcripts.get(transcript_id)
+
+        if ready_at is None:
+            return self.send_json({'error': 'Transcript not found'}, status=404)
+        if time.monotonic() < ready_at:
+            return self.send_json({'id': transcript_id, 'status': 'processing'})
+        return self.send_json(assemblyai_transcript(transcript_id))
+
+    # Stripe
+    def stripe_get(self, path, body):
+        # Before the customer itself, its payment methods share the /customers/{id} prefix
+        if path.startswith('/stripe/v1/customers/') and path.endswith('/payment_methods'):
+            return self.send_json({'object': 'list', 'data': [stripe_payment_method()], 'has_more': False, 'url': path.replace('/stripe', '', 1)})
+
+        if path.startswith('/stripe/v1/customers/'):
+            return self.send_json(stripe_customer(path.rsplit('/', 1)[-1]))
+
+        if path == '/stripe/v1/payment_methods':
+            return self.send_json({'object': 'list', 'data': [stripe_payment_method()], 'has_more': False, 'url': '/v1/payment_methods'})
+
+        return self.send_json({'error': {'message': f'No stub for GET {path}'}}, status=404)
+
+    def stripe_post(self, path, body):
+        if path == '/stripe/v1/payment_intents':
+            return self.send_json({'id': f'pi_{uuid.uuid4().hex[:24]}', 'object': 'payment_intent', 'status': 'succeeded'})
+
+        if path == '/stripe/v1/billing_portal/sessions':
+            return self.send_json({'id': f'bps_{uuid.uuid4().hex[:24]}', 'object': 'billing_portal.session', 'url': 'https://billing.stripe.invalid/session'})
+
+        if path == '/stripe/v1/checkout/sessions':
+            return self.send_json({'id': f'cs_{uuid.uuid4().hex[:24]}', 'object': 'checkout.session', 'url': 'https://checkout.stripe.invalid/session'})
+
+        return self.send_json({'error': {'message': f'No stub for POST {path}'}}, status=404)
+
+    def stripe_delete(self, path, body):
+        if path.startswith('/stripe/v1/subscriptions/'):
+            return self.send_json({'id': path.rsplit('/', 1)[-1], 'object': 'subscription', 'status': 'canceled'})
+
+        return self.send_json({'error': {'message': f'No stub for DELETE {path}'}}, status=404)
+
+
+def chat_completion(payload):
+    content = 'Stub completion.'
+    if (payload.get('response_format') or {}).get('type') == 'json_object':
+        # Answer every section the scribe prompt defines, so the JSON parsing paths are exercised
+        system_prompt = next((message.get('content', '') for message in payload.get('messages', []) if message.get('role') == 'system'), '')
+        section_keys = re.findall(r'^\s*"([a-z0-9_]+)":', system_prompt, flags=re.MULTILINE) or ['note']
+        content = json.dumps({key: f'Stub {key.replace("_", " ")}.' for key in section_keys})
+
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': payload.get('model', 'stub'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 3, 'total_tokens': 13},
+    }
+
+
+def whisper_transcription():
+    segments = []
+    for index, (_speaker, text) in enumerate(STUB_TRANSCRIPT):
+        segments.append({'id': index, 'seek': 0, 'start': index * 5.0, 'end': index * 5.0 + 4.5, 'text': f' {text}',
+                         'tokens': [], 'temperature': 0.3, 'avg_logprob': -0.2, 'compression_ratio': 1.2, 'no_speech_prob': 0.01})
+    return {'task': 'transcribe', 'language': 'english', 'duration': len(segments) * 5.0,
+            'text': ' '.join(text for _speaker, text in STUB_TRANSCRIPT), 'segments': segments}
+
+
+def assemblyai_transcript(transcript_id):
+    utterances = [
+        {'speaker': speaker, 'text': text, 'start': index * 5000, 'end': index * 5000 + 4500, 'confidence': 0.95}
+        for index, (speaker, text) in enumerate(STUB_TRANSCRIPT)
+    ]
+    return {
+        'id': transcript_id,
+        'status': 'completed',
+        'text': ' '.join(text for _speaker, text in STUB_TRANSCRIPT),
+        'utterances': utterances,
+        'audio_duration': len(utterances) * 5,
+    }
+
+
+def send_webhook_later(delay, webhook_url, transcript_id, header_name=None, header_value=None):
+    def send_webhook():
+        headers = {'Content-Type': 'application/json'}
+        if header_name:
+            headers[header_name] = header_value or ''
+        request = urllib.request.Request(webhook_url, data=json.dumps({'transcript_id': transcript_id, 'status': 'completed'}).encode(),
+                                         headers=headers, method='POST')
+        try:
+            urllib.request.urlopen(request, timeout=30).close()
+        except OSError:
+            pass
+
+    timer = threading.Timer(delay, send_webhook)
+    timer.daemon = True
+    timer.start()
+
+
+def stripe_payment_method():
+    return {'id': 'pm_stub', 'object': 'payment_method', 'type': 'card',
+            'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030}}
+
+
+def stripe_customer(customer_id):
+    return {'id': customer_id, 'object': 'customer', 'email': 'bench@example.invalid',
+            'invoice_settings': {'default_payment_method': stripe_payment_method()}}
+
+
+def start_stub_server(port=0, latency=0.5, handler_class=StubHandler, latencies=None, error_rates=None, transcript_seconds=2.0):
+    """Serve the stubs on a background thread.
+
+    `latencies` and `error_rates` map an upstream ('openai', 'assemblyai', 'stripe', 'google')
+    to its own latency / error rate; `transcript_seconds` is how long a transcript stays processing.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    server.daemon_threads = True
+    server.latency = latency
+    server.latencies = latencies or {}
+    server.error_rates = error_rates or {}
+    server.transcript_seconds = transcript_seconds
+    server.transcripts = {}
+    server.transcripts_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='upstream-stub', daemon=True).start()
+    return server
+
+
+def write_service_account(path, project_id, token_uri):
+    """Throwaway service account file so firebase_admin initializes against the stubs"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    ).decode()
+
+    with open(path, 'w') as file:
+        json.dump({
+            'type': 'service_account',
+            'project_id': project_id,
+            'private_key_id': uuid.uuid4().hex,
+            'private_key': private_key_pem,
+            'client_email': f'bench@{project_id}.iam.gserviceaccount.com',
+            'client_id': '1',
+            'token_uri': token_uri,
+        }, file)
+    return path
+
+
+def mint_id_token(project_id, uid):
+    """Unsigned ID token, accepted by firebase_admin when FIREBASE_AUTH_EMULATOR_HOST is set"""
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+    now = int(time.time())
+    header = {'alg': 'none', 'typ': 'JWT'}
+    claims = {
+        'iss': f'https://securetoken.google.com/{project_id}',
+        'aud': project_id,
+        'sub': uid,
+        'user_id': uid,
+        'iat': now,
+        'auth_time': now,
+        'exp': now + 3600,
+    }
+    return f"{encode(header)}.{encode(claims)}."